@@ -1,21 +1,52 @@
-from flask import Flask
-from flask.ext.bcrypt import Bcrypt
-from flask.ext.login import LoginManager
-from flask.ext.sqlalchemy import SQLAlchemy 
+# Imported first so the startup profiler can time everything below
+from .startup import phase, report_on_first_response
+
+import os
+
+with phase('import flask'):
+    from flask import Flask
+    from flask.ext.bcrypt import Bcrypt
+    from flask.ext.login import LoginManager
+    from jinja2 import FileSystemBytecodeCache
 
 # The main web app
-app = Flask(__name__)
-app.config.from_object('config') # Load config.py
+with phase('create app'):
+    app = Flask(__name__)
+    app.config.from_object('config') # Load config.py
 
-# SQLAlchemy DB interface
-db = SQLAlchemy(app)
+# Compiled templates are kept on disk so new workers skip compiling them.
+# 'manage.py precompile' fills the cache ahead of time.
+if app.config.get('TEMPLATE_BYTECODE_CACHE'):
+    try:
+        os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE'])
+    except OSError:
+        # Another worker got there first
+        if not os.path.isdir(app.config['TEMPLATE_BYTECODE_CACHE']):
+            raise
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE'])
+
+# SQLAlchemy DB interface. Views marked @read_only read through a separate
+# read-only connection, see routing.py
+with phase('sqlalchemy'):
+    from .routing import RoutingSQLAlchemy, attach_databases, use_wal
+    db = RoutingSQLAlchemy(app)
+    with app.app_context():
+        attach_databases(app, db.get_engine(app))
+        if app.config.get('SQLALCHEMY_READ_ROUTING'):
+            use_wal(db.get_engine(app))
 
 # Password encryption library
-bcrypt = Bcrypt(app)
+with phase('bcrypt and login manager'):
+    bcrypt = Bcrypt(app)
 
-# Login manager 
-login_manager = LoginManager()
-login_manager.init_app(app)
+    # Login manager
+    login_manager = LoginManager()
+    login_manager.init_app(app)
 
 # Start web app
-from app import views, models
+with phase('models'):
+    from app import models
+with phase('views'):
+    from app import views
+
+report_on_first_response(app)
@@ -0,0 +1,380 @@
+from functools import wraps
+
+from flask import abort, jsonify, request
+from flask.ext.login import current_user
+from sqlalchemy import func
+
+from app import db
+
+from .changes import changes_since, wait_for_changes
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, ArchivedPayment, Client, Order, OrderItem, Payment, Product
+)
+
+from helpers import chunked
+from orders import place_order
+from pricing import current_price
+from search import client_search
+
+# Rows per page when listing with a cursor, and the most a client may ask
+# for in one call, whether by page size or by id list
+PAGE_SIZE = 100
+MAX_BATCH = 1000
+
+
+class ApiError(Exception):
+    """Turned into a JSON error response by the API views."""
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def api_view(f):
+    """Requires a logged in user and turns the dict a view returns, or
+    an ApiError it raises, into a JSON response. Unlike login_required
+    an anonymous request gets 401 instead of a redirect to the login
+    page."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        if not current_user.is_authenticated():
+            abort(401)
+        try:
+            result = f(*args, **kwargs)
+        except ApiError, err:
+            response = jsonify(error=str(err))
+            response.status_code = err.status
+            return response
+        if isinstance(result, tuple):
+            (result, status) = result
+            response = jsonify(result)
+            response.status_code = status
+            return response
+        return jsonify(result)
+    return wrapped
+
+def id_list(name='ids'):
+    """Parses ?ids=1,2,3. Returns None when the argument is absent."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    ids = [i.strip() for i in value.split(',') if i.strip()]
+    if not all(i.isdigit() for i in ids):
+        raise ApiError('%s must be a comma separated list of ids' % (name))
+    if len(ids) > MAX_BATCH:
+        raise ApiError('At most %i ids per request' % (MAX_BATCH))
+    return sorted(set(int(i) for i in ids))
+
+def page_args():
+    """Returns (cursor, limit) from ?cursor=&limit=. The cursor is the
+    last id of the previous page."""
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        raise ApiError('cursor and limit must be integers')
+    if not 1 <= limit <= MAX_BATCH:
+        raise ApiError('limit must be between 1 and %i' % (MAX_BATCH))
+    return cursor, limit
+
+def page(rows, limit, key='id'):
+    """Wraps one page of serialized rows with the cursor for the next."""
+    next_cursor = rows[-1][key] if len(rows) == limit else None
+    return dict(results=rows, next_cursor=next_cursor)
+
+
+###############################################################################
+# Products
+###############################################################################
+PRODUCT_COLUMNS = (Product.id, Product.manufacturer, Product.name, Product.price,
+                   Product.quantity, Product.reserved, Product.active)
+
+def product_row(row):
+    (product_id, manufacturer, name, price, quantity, reserved, active) = row
+    return dict(id=product_id,
+                manufacturer=manufacturer,
+                name=name,
+                list_price=price,
+                price=round(current_price(product_id, price), 2),
+                available=quantity - (reserved or 0),
+                active=active)
+
+def products_query():
+    query = db.session.query(*PRODUCT_COLUMNS)
+    if not (current_user.is_employee and current_user.employee.title == 'Director'):
+        query = query.filter(Product.active == True)
+    return query
+
+def get_products(ids):
+    rows = []
+    for chunk in chunked(ids, 500):
+        rows.extend(product_row(row) for row in products_query().filter(Product.id.in_(chunk)))
+    found = set(row['id'] for row in rows)
+    return dict(results=sorted(rows, key=lambda row: row['id']),
+                missing=[i for i in ids if i not in found])
+
+def list_products(cursor, limit):
+    rows = products_query().filter(Product.id > cursor).order_by(Product.id).limit(limit)
+    return page([product_row(row) for row in rows], limit)
+
+
+###############################################################################
+# Clients
+###############################################################################
+def client_row(client):
+    return dict(id=client.client_id,
+                user_id=client.user_id,
+                company=client.company,
+                username=client.username,
+                salesperson_id=client.salesperson_id)
+
+def visible_client_ids(employee):
+    return sorted(client_search.visible_ids(employee))
+
+def get_clients(employee, ids):
+    visible = set(client_search.visible_ids(employee))
+    rows = []
+    for chunk in chunked([i for i in ids if i in visible], 500):
+        rows.extend(client_row(client) for client in
+                    Client.query.filter(Client.client_id.in_(chunk)))
+    found = set(row['id'] for row in rows)
+    return dict(results=sorted(rows, key=lambda row: row['id']),
+                missing=[i for i in ids if i not in found])
+
+def list_clients(employee, cursor, limit, query=None):
+    if query:
+        ids = client_search.visible_ids(employee, query, limit=limit)
+        clients = Client.query.filter(Client.client_id.in_(ids)).all() if ids else []
+        by_id = dict((client.client_id, client) for client in clients)
+        return dict(results=[client_row(by_id[i]) for i in ids if i in by_id], next_cursor=None)
+    ids = [i for i in visible_client_ids(employee) if i > cursor][:limit]
+    clients = Client.query.filter(Client.client_id.in_(ids)).order_by(Client.client_id).all() if ids else []
+    return page([client_row(client) for client in clients], limit)
+
+
+###############################################################################
+# Orders
+###############################################################################
+class OrderScope(object):
+    """Which orders the current user may see: a client sees their own,
+    an employee those sold by themselves or anyone below them."""
+    def __init__(self, user):
+        if user.is_employee:
+            self.client_id = None
+            self.salespeople = set(user.employee.subtree_ids())
+        else:
+            self.client_id = user.client.client_id
+            self.salespeople = None
+
+    def filter(self, query):
+        if self.client_id is not None:
+            return query.filter(Order.client == self.client_id)
+        if len(self.salespeople) <= 500:
+            return query.filter(Order.salesperson.in_(self.salespeople))
+        # Too many for one IN list; the rows are checked by allows()
+        return query
+
+    def allows(self, client_id, salesperson_id):
+        if self.client_id is not None:
+            return client_id == self.client_id
+        return salesperson_id in self.salespeople
+
+ORDER_COLUMNS = (Order.id, Order.timestamp, Order.client, Order.salesperson, Order.commission)
+
+def order_rows(rows, items=OrderItem, payments=Payment):
+    """Serializes (id, timestamp, client, salesperson, commission) rows
+    with their items and payments, two grouped queries per 500 orders.
+    Pass the archive models as items and payments for archived orders."""
+    orders = [dict(id=order_id,
+                   timestamp=timestamp.isoformat(),
+                   client_id=client_id,
+                   salesperson_id=salesperson_id,
+                   commission=commission,
+                   items=[],
+                   total=0.0,
+                   paid=0.0)
+              for (order_id, timestamp, client_id, salesperson_id, commission) in rows]
+    by_id = dict((order['id'], order) for order in orders)
+    for chunk in chunked(by_id.keys(), 500):
+        for (order_id, product_id, price, quantity) in \
+                db.session.query(items.order_id, items.product_id, items.price, items.quantity).\
+                filter(items.order_id.in_(chunk)):
+            by_id[order_id]['items'].append(dict(product_id=product_id, price=price, quantity=quantity))
+            by_id[order_id]['total'] += price * quantity
+        for (order_id, paid) in db.session.query(payments.order_id, func.sum(payments.amount)).\
+                                filter(payments.order_id.in_(chunk)).\
+                                group_by(payments.order_id):
+            by_id[order_id]['paid'] = paid or 0.0
+    for order in orders:
+        order['total'] = round(order['total'], 2)
+        order['balance'] = round(order['total'] - order['paid'], 2)
+    return orders
+
+def get_orders(scope, ids):
+    rows = []
+    for chunk in chunked(ids, 500):
+        rows.extend(row for row in scope.filter(db.session.query(*ORDER_COLUMNS)).
+                    filter(Order.id.in_(chunk))
+                    if scope.allows(row[2], row[3]))
+    orders = order_rows(sorted(rows))
+    found = set(order['id'] for order in orders)
+    return dict(results=orders, missing=[i for i in ids if i not in found])
+
+def list_orders(scope, cursor, limit):
+    rows = []
+    query = scope.filter(db.session.query(*ORDER_COLUMNS)).order_by(Order.id)
+    while len(rows) < limit:
+        batch = query.filter(Order.id > cursor).limit(limit).all()
+        if not batch:
+            break
+        rows.extend(row for row in batch if scope.allows(row[2], row[3]))
+        cursor = batch[-1][0]
+    return page(order_rows(rows[:limit]), limit)
+
+def create_orders(salesperson, specs):
+    """Places each order in specs, a list of {"client_id": ..., "lines":
+    [{"product_id": ..., "quantity": ..., "discount": ...}]}, through
+    place_order. Every order commits or fails on its own; the result for
+    each says which."""
+    if not isinstance(specs, list) or not specs:
+        raise ApiError('orders must be a non-empty list')
+    if len(specs) > MAX_BATCH:
+        raise ApiError('At most %i orders per request' % (MAX_BATCH))
+
+    client_ids = set()
+    product_ids = set()
+    for spec in specs:
+        if not isinstance(spec, dict) or not isinstance(spec.get('lines'), list):
+            raise ApiError('Each order needs a client_id and a list of lines')
+        client_ids.add(spec.get('client_id'))
+        for line in spec['lines']:
+            if not isinstance(line, dict):
+                raise ApiError('Each line needs a product_id and a quantity')
+            product_ids.add(line.get('product_id'))
+    clients = {}
+    for chunk in chunked([i for i in client_ids if isinstance(i, (int, long))], 500):
+        clients.update((client.client_id, client) for client in
+                       Client.query.filter(Client.client_id.in_(chunk),
+                                           Client.salesperson_id == salesperson.employee_id))
+    products = {}
+    for chunk in chunked([i for i in product_ids if isinstance(i, (int, long))], 500):
+        products.update((product.id, product) for product in
+                        Product.query.filter(Product.id.in_(chunk)))
+
+    results = []
+    for (index, spec) in enumerate(specs):
+        client = clients.get(spec.get('client_id'))
+        if client is None:
+            results.append(dict(index=index, errors={'client_id': ['Unknown client']}))
+            continue
+        lines = []
+        errors = {}
+        for line in spec['lines']:
+            product = products.get(line.get('product_id'))
+            quantity = line.get('quantity')
+            discount = line.get('discount', 0)
+            if product is None:
+                errors.setdefault('product_id', []).append('Unknown product %r' % (line.get('product_id')))
+            elif not isinstance(quantity, (int, long)) or not isinstance(discount, (int, long, float)):
+                errors.setdefault(product.description, []).append('Invalid quantity or discount')
+            else:
+                lines.append((product, quantity, discount))
+        if not errors:
+            (order, errors) = place_order(salesperson, client, lines)
+            if order is not None:
+                results.append(dict(index=index, order_id=order.id))
+                continue
+        results.append(dict(index=index,
+                            errors=dict((field, [unicode(message) for message in messages])
+                                        for (field, messages) in errors.items())))
+    return results
+
+
+###############################################################################
+# Change feed
+###############################################################################
+# Longest a request may wait for the next change
+MAX_WAIT = 30
+
+def change_args():
+    """Returns (since, limit, wait) from ?since=&limit=&wait=."""
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit', PAGE_SIZE))
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        raise ApiError('since, limit and wait must be numbers')
+    if not 1 <= limit <= MAX_BATCH:
+        raise ApiError('limit must be between 1 and %i' % (MAX_BATCH))
+    if not 0 <= wait <= MAX_WAIT:
+        raise ApiError('wait must be between 0 and %i seconds' % (MAX_WAIT))
+    return since, limit, wait
+
+def changed_orders(ids):
+    found = {}
+    for chunk in chunked(ids, 500):
+        found.update((order['id'], order) for order in
+                     order_rows(db.session.query(*ORDER_COLUMNS).filter(Order.id.in_(chunk)).all()))
+    archived_columns = (ArchivedOrder.id, ArchivedOrder.timestamp, ArchivedOrder.client,
+                        ArchivedOrder.salesperson, ArchivedOrder.commission)
+    for chunk in chunked([i for i in ids if i not in found], 500):
+        for order in order_rows(db.session.query(*archived_columns).
+                                filter(ArchivedOrder.id.in_(chunk)).all(),
+                                ArchivedOrderItem, ArchivedPayment):
+            order['archived'] = True
+            found[order['id']] = order
+    return found
+
+def changed_payments(order_ids):
+    found = {}
+    for (model, archived) in ((Payment, False), (ArchivedPayment, True)):
+        for chunk in chunked([i for i in order_ids if i not in found], 500):
+            rows = db.session.query(model.order_id, model.timestamp, model.amount).\
+                   filter(model.order_id.in_(chunk)).order_by(model.order_id, model.timestamp)
+            for (order_id, timestamp, amount) in rows:
+                found.setdefault(order_id, dict(order_id=order_id, archived=archived, payments=[]))
+                found[order_id]['payments'].append(dict(timestamp=timestamp.isoformat(), amount=amount))
+    return found
+
+def changed_products(ids):
+    found = {}
+    for chunk in chunked(ids, 500):
+        found.update((row['id'], row) for row in
+                     map(product_row, db.session.query(*PRODUCT_COLUMNS).filter(Product.id.in_(chunk))))
+    return found
+
+def changed_clients(ids):
+    found = {}
+    for chunk in chunked(ids, 500):
+        found.update((client.client_id, client_row(client)) for client in
+                     Client.query.filter(Client.client_id.in_(chunk)))
+    return found
+
+CHANGE_LOADERS = dict(order=changed_orders,
+                      payment=changed_payments,
+                      product=changed_products,
+                      client=changed_clients)
+
+def change_feed(since, limit, wait=0):
+    """The changes after since, in commit order, each with the current
+    state of its row (null once the row is gone). A row changed several
+    times appears once per change with its latest state. With wait, an
+    empty feed is held open for up to that many seconds until something
+    changes. cursor is the since to pass next time."""
+    if wait:
+        wait_for_changes(since, wait)
+    rows = changes_since(since, limit)
+    ids = {}
+    for (_seq, entity, entity_id, _op, _timestamp) in rows:
+        ids.setdefault(entity, set()).add(entity_id)
+    state = dict((entity, CHANGE_LOADERS[entity](sorted(entity_ids)))
+                 for (entity, entity_ids) in ids.items())
+    changes = [dict(seq=seq,
+                    entity=entity,
+                    id=entity_id,
+                    op=op,
+                    timestamp=timestamp.isoformat(),
+                    data=state[entity].get(entity_id))
+               for (seq, entity, entity_id, op, timestamp) in rows]
+    return dict(changes=changes,
+                cursor=rows[-1][0] if rows else since,
+                more=len(rows) == limit)
@@ -0,0 +1,148 @@
+import datetime
+
+from sqlalchemy import DateTime, exists, func, literal, select
+
+from app import app, db
+
+from .cache import bump_version, user_version
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, ArchivedPayment, Client, Employee, Order, OrderItem, Payment
+)
+
+from reports import CENT
+
+# Orders moved per transaction
+CHUNK_SIZE = 500
+
+ARCHIVE_TABLES = [ArchivedOrder.__table__, ArchivedOrderItem.__table__, ArchivedPayment.__table__]
+
+# Hot tables, their archive copies and the column holding the order id,
+# in the order rows are copied
+COPIES = ((Order.__table__, ArchivedOrder.__table__, 'id'),
+          (OrderItem.__table__, ArchivedOrderItem.__table__, 'order_id'),
+          (Payment.__table__, ArchivedPayment.__table__, 'order_id'))
+
+
+def ensure_archive():
+    """Creates the archive tables if the attached database is new."""
+    db.metadata.create_all(bind=db.get_engine(app), tables=ARCHIVE_TABLES)
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = app.config.get('ARCHIVE_AFTER_DAYS', 365)
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+def fully_paid(order_ids):
+    """The subset of order_ids whose payments cover their total."""
+    totals = dict((order_id, 0.0) for order_id in order_ids)
+    totals.update(db.session.query(OrderItem.order_id, func.sum(OrderItem.price * OrderItem.quantity)).
+                  filter(OrderItem.order_id.in_(order_ids)).
+                  group_by(OrderItem.order_id))
+    paid = dict(db.session.query(Payment.order_id, func.sum(Payment.amount)).
+                filter(Payment.order_id.in_(order_ids)).
+                group_by(Payment.order_id))
+    return [order_id for order_id in order_ids
+            if totals[order_id] - (paid.get(order_id) or 0.0) <= CENT]
+
+def archive_chunk(order_ids):
+    """Moves the orders with their items and payments in one transaction.
+
+    Rows are copied with INSERT OR IGNORE before the hot rows are deleted.
+    With the main database in WAL mode SQLite makes a transaction across
+    attached files atomic only per file, so a crash can leave a chunk
+    copied but not deleted; running again copies nothing twice and
+    finishes the delete. Order ids are never reused, so a row the archive
+    already holds is always a copy of the same order."""
+    now = datetime.datetime.now()
+    user_ids = set()
+    for (client_user, salesperson_user) in \
+            db.session.query(Client.user_id, Employee.user_id).\
+            select_from(Order).\
+            join(Client, Client.client_id == Order.client).\
+            join(Employee, Employee.employee_id == Order.salesperson).\
+            filter(Order.id.in_(order_ids)).distinct():
+        user_ids.update((client_user, salesperson_user))
+    try:
+        for (hot, archived, key) in COPIES:
+            columns = [column.name for column in hot.columns]
+            source = [hot.c[name] for name in columns]
+            if 'archived_at' in archived.c:
+                columns.append('archived_at')
+                source.append(literal(now, type_=DateTime))
+            db.session.execute(archived.insert().prefix_with('OR IGNORE').
+                               from_select(columns, select(source).where(hot.c[key].in_(order_ids))))
+        for (hot, archived, key) in reversed(COPIES):
+            db.session.execute(hot.delete().where(hot.c[key].in_(order_ids)))
+        bump_version('orders', 'payments',
+                     *[user_version('orders', user_id) for user_id in sorted(user_ids)])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def archive_orders(before=None, chunk_size=CHUNK_SIZE, limit=None, progress=None):
+    """Archives fully paid orders placed before `before` (by default
+    ARCHIVE_AFTER_DAYS ago), chunk_size orders per transaction and at most
+    limit in total. Every chunk commits on its own, so an interrupted run
+    keeps what it moved and the next run carries on with the rest.
+    Returns (orders scanned, orders archived)."""
+    ensure_archive()
+    if before is None:
+        before = archive_cutoff()
+    scanned = archived = 0
+    after_id = 0
+    while limit is None or archived < limit:
+        order_ids = [order_id for (order_id,) in
+                     db.session.query(Order.id).
+                     filter(Order.timestamp < before, Order.id > after_id).
+                     order_by(Order.id).limit(chunk_size)]
+        if not order_ids:
+            break
+        after_id = order_ids[-1]
+        scanned += len(order_ids)
+        paid = fully_paid(order_ids)
+        if limit is not None:
+            paid = paid[:limit - archived]
+        if paid:
+            archive_chunk(paid)
+            archived += len(paid)
+        if progress is not None:
+            progress(scanned, archived)
+    return scanned, archived
+
+
+###############################################################################
+# Reading across hot and archived orders
+###############################################################################
+def archive_horizon():
+    """When the newest archived order was placed, or None if nothing has
+    been archived. Queries over a range that starts after it can skip the
+    archive."""
+    return db.session.query(func.max(ArchivedOrder.timestamp)).scalar()
+
+def not_hot():
+    """Condition on ArchivedOrder that leaves out orders still in the hot
+    tables, which a crash between archive_chunk's copy and its delete
+    leaves in both. Queries that read both must not count them twice."""
+    return ~exists().where(Order.id == ArchivedOrder.id)
+
+def reaches_archive(begin):
+    """Whether a query over orders placed from begin on (None: all time)
+    has to include archived orders."""
+    horizon = archive_horizon()
+    return horizon is not None and (begin is None or begin <= horizon)
+
+def find_order(order_id, client_id=None, salesperson_ids=None):
+    """Looks an order up in the hot tables and then in the archive,
+    limited to one client's orders or those sold by salesperson_ids.
+    Returns an Order, an ArchivedOrder or None."""
+    for model in (Order, ArchivedOrder):
+        query = model.query.filter(model.id == order_id)
+        if client_id is not None:
+            query = query.filter(model.client == client_id)
+        if salesperson_ids is not None:
+            query = query.filter(model.salesperson.in_(salesperson_ids))
+        order = query.first()
+        if order is not None:
+            return order
+    return None
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from app import db
+
+
+class PeriodicTask(threading.Thread):
+    """Calls func every interval seconds inside an app context. Errors are
+    logged and the session is reset so one bad run does not stop the
+    thread."""
+    def __init__(self, app, name, interval, func):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.app = app
+        self.interval = interval
+        self.func = func
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.func()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('%s failed' % (self.name))
+                finally:
+                    db.session.remove()
+
+_tasks = {}
+_tasks_lock = threading.Lock()
+
+def start_periodic(app, name, interval, func):
+    """Starts the named task in this process unless it is already running
+    or interval is not set."""
+    if not interval:
+        return
+    with _tasks_lock:
+        if name not in _tasks:
+            _tasks[name] = PeriodicTask(app, name, interval, func)
+            _tasks[name].start()
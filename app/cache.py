@@ -0,0 +1,70 @@
+import datetime
+import threading
+
+from app import db
+
+from .models import DataVersion
+
+
+###############################################################################
+# Data versions
+###############################################################################
+def bump_version(*names):
+    """Marks the named classes of data as changed. Runs inside the
+    caller's transaction so the bump commits (or rolls back) together
+    with the change itself."""
+    now = datetime.datetime.now()
+    table = DataVersion.__table__
+    for name in names:
+        result = db.session.execute(table.update().
+                                    where(table.c.name == name).
+                                    values(version=table.c.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(name=name, version=1, updated_at=now))
+
+def data_versions(*names):
+    """Returns a tuple with the current version of each name, in order.
+    Names that have never been bumped are at version 0."""
+    found = dict(db.session.query(DataVersion.name, DataVersion.version).
+                 filter(DataVersion.name.in_(names)))
+    return tuple(found.get(name, 0) for name in names)
+
+def version_stamps(*names):
+    """Like data_versions, but also returns when the most recent of them
+    was bumped (None if none ever was)."""
+    found = dict((name, (version, updated_at)) for (name, version, updated_at) in
+                 db.session.query(DataVersion.name, DataVersion.version, DataVersion.updated_at).
+                 filter(DataVersion.name.in_(names)))
+    versions = tuple(found.get(name, (0, None))[0] for name in names)
+    stamps = [updated_at for (_version, updated_at) in found.values()]
+    return versions, (max(stamps) if stamps else None)
+
+def user_version(name, user_id):
+    """The data_version name for one user's share of a class of data."""
+    return '%s:user:%s' % (name, user_id)
+
+
+###############################################################################
+# Version-checked cache
+###############################################################################
+class VersionedCache(object):
+    """A process-local cache whose entries are only returned while the
+    data versions they were computed from are still current."""
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,232 @@
+import csv
+
+from sqlalchemy import and_, bindparam
+
+from app import db
+
+from .cache import bump_version
+from .models import Product
+
+from replenishment import mark_received
+
+# Catalog row outcomes
+CREATED = 'created'         # New product added
+UPDATED = 'updated'         # Existing product restocked and/or repriced
+UNCHANGED = 'unchanged'     # Row matches the product as it already is
+REJECTED = 'rejected'       # Nothing changed for this row
+STATUSES = (CREATED, UPDATED, UNCHANGED, REJECTED)
+
+# Products are looked up with two bound parameters per row, which keeps
+# each chunk under SQLite's limit. Every chunk is its own transaction.
+CHUNK_SIZE = 400
+
+NAME_MAX_LEN = 64
+
+
+class CatalogRow(object):
+    """One manufacturer,name,quantity[,price] row from a supplier sheet
+    and the outcome of importing it."""
+    def __init__(self, line_no, manufacturer=None, name=None, quantity=None, price=None):
+        self.line_no = line_no
+        self.manufacturer = manufacturer
+        self.name = name
+        self.quantity = quantity
+        self.price = price
+        self.status = None
+        self.message = ''
+
+    @property
+    def key(self):
+        return (self.manufacturer, self.name)
+
+    def reject(self, message):
+        self.status = REJECTED
+        self.message = message
+
+
+class CatalogImport(object):
+    """Counts per outcome for a whole import plus the rejected rows.
+    Accepted rows are not kept so large sheets stay cheap."""
+    def __init__(self):
+        self.counts = dict((status, 0) for status in STATUSES)
+        self.rejected = []
+
+    def add(self, row):
+        self.counts[row.status] += 1
+        if row.status == REJECTED:
+            self.rejected.append(row)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+def parse_row(line_no, cells):
+    row = CatalogRow(line_no)
+    if len(cells) < 3:
+        row.reject('Expected manufacturer,name,quantity[,price]')
+        return row
+    row.manufacturer, row.name = cells[0], cells[1]
+    if not row.manufacturer or not row.name:
+        row.reject('Manufacturer and name are required')
+        return row
+    if len(row.manufacturer) > NAME_MAX_LEN or len(row.name) > NAME_MAX_LEN:
+        row.reject('Manufacturer and name must be at most %i characters long' % (NAME_MAX_LEN))
+        return row
+    try:
+        row.quantity = int(cells[2])
+    except ValueError:
+        row.reject('Invalid quantity %r' % (cells[2]))
+        return row
+    if row.quantity < 0:
+        row.reject('Quantity cannot be negative')
+        return row
+    if len(cells) > 3 and cells[3]:
+        try:
+            row.price = round(float(cells[3].lstrip('$')), 2)
+        except ValueError:
+            row.reject('Invalid price %r' % (cells[3]))
+            return row
+        if row.price < 0.01:
+            row.reject('Price must be at least $0.01')
+    return row
+
+def parse_catalog(fileobj):
+    """Yields a CatalogRow for every non-blank line of a CSV of
+    manufacturer,name,quantity[,price] rows without reading the whole file
+    first. A header row is skipped if present. Rows that cannot be parsed
+    come back already rejected."""
+    for line_no, cells in enumerate(csv.reader(fileobj), 1):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        if line_no == 1 and len(cells) > 2 and not cells[2].lstrip('-').isdigit():
+            continue
+        yield parse_row(line_no, cells)
+
+def existing_products(keys):
+    """Returns {(manufacturer, name): (id, quantity, price)} for the keys
+    that already exist. If a key matches several products the oldest one
+    wins, as it would for a reorder."""
+    found = {}
+    if not keys:
+        return found
+    for (product_id, manufacturer, name, quantity, price) in \
+            db.session.query(Product.id, Product.manufacturer, Product.name,
+                             Product.quantity, Product.price).\
+            filter(Product.manufacturer.in_(set(m for (m, n) in keys)),
+                   Product.name.in_(set(n for (m, n) in keys))).\
+            order_by(Product.id.desc()):
+        if (manufacturer, name) in keys:
+            found[(manufacturer, name)] = (product_id, quantity, price)
+    return found
+
+def import_chunk(rows):
+    """Upserts one chunk of parsed rows with one bulk INSERT and one bulk
+    UPDATE and commits. Stock may only go up, the same rule as reordering
+    a single product. The UPDATE only applies where the quantity is still
+    the one that was read, so stock an order took in the meantime is not
+    overwritten; such rows are rejected instead."""
+    pending = [row for row in rows if row.status is None]
+    existing = existing_products(set(row.key for row in pending))
+    inserts = []
+    updates = []
+    updated = {}    # product id -> row
+    for row in pending:
+        match = existing.get(row.key)
+        if match is None:
+            if row.price is None:
+                row.reject('Price is required for new products')
+                continue
+            row.status = CREATED
+            inserts.append(dict(manufacturer=row.manufacturer,
+                                name=row.name,
+                                price=row.price,
+                                quantity=row.quantity,
+                                active=True))
+            continue
+        (product_id, quantity, price) = match
+        new_price = price if row.price is None else row.price
+        if row.quantity < quantity:
+            row.reject('New quantity must be greater than current quantity of %i' % (quantity))
+        elif row.quantity == quantity and new_price == price:
+            row.status = UNCHANGED
+        else:
+            row.status = UPDATED
+            updates.append(dict(b_id=product_id, b_old_quantity=quantity,
+                                b_quantity=row.quantity, b_price=new_price))
+            updated[product_id] = row
+
+    if not inserts and not updates:
+        return
+    table = Product.__table__
+    try:
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+        if updates:
+            result = db.session.execute(table.update().
+                                        where(and_(table.c.id == bindparam('b_id'),
+                                                   table.c.quantity == bindparam('b_old_quantity'))).
+                                        values(quantity=bindparam('b_quantity'),
+                                               price=bindparam('b_price')),
+                                        updates)
+            if result.rowcount != len(updates):
+                reject_changed(updates, updated)
+            received = [product_id for (product_id, row) in updated.items() if row.status == UPDATED]
+            if received:
+                mark_received(received)
+        bump_version('products')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def reject_changed(updates, updated):
+    """Finds the updates the guarded UPDATE skipped because an order
+    changed the product's stock after it was read, and rejects their rows.
+    Runs inside the import's transaction, which holds the write lock, so
+    what it reads is what the UPDATE left."""
+    wanted = dict((update['b_id'], (update['b_quantity'], update['b_price'])) for update in updates)
+    found = dict((product_id, (quantity, price)) for (product_id, quantity, price) in
+                 db.session.query(Product.id, Product.quantity, Product.price).
+                 filter(Product.id.in_(wanted.keys())))
+    for (product_id, target) in wanted.items():
+        if product_id not in found:
+            updated[product_id].reject('Product was removed during the import')
+        elif found[product_id] != target:
+            updated[product_id].reject('Stock changed to %i during the import; '
+                                       'upload the row again' % (found[product_id][0]))
+
+def import_catalog(fileobj, chunk_size=CHUNK_SIZE):
+    """Streams a supplier sheet into the product table, upserting by
+    (manufacturer, name). Chunks already imported stay committed if a
+    later chunk fails. Returns a CatalogImport."""
+    result = CatalogImport()
+    seen = set()
+    chunk = []
+    def flush():
+        import_chunk(chunk)
+        for row in chunk:
+            result.add(row)
+        del chunk[:]
+    for row in parse_catalog(fileobj):
+        if row.status is None:
+            if row.key in seen:
+                row.reject('Product listed twice')
+            else:
+                seen.add(row.key)
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return result
+
+def write_import_report(result, fileobj):
+    writer = csv.writer(fileobj)
+    writer.writerow(('Line', 'Manufacturer', 'Product Name', 'Quantity', 'Price', 'Message'))
+    for row in result.rejected:
+        writer.writerow((row.line_no, row.manufacturer or '', row.name or '',
+                         '' if row.quantity is None else row.quantity,
+                         '' if row.price is None else '%.2f' % (row.price),
+                         row.message))
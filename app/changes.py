@@ -0,0 +1,77 @@
+import time
+
+from sqlalchemy import event, func
+
+from app import app, db
+
+from .models import Change
+
+# The change log behind the /api/v1/changes feed. Triggers on the tracked
+# tables append a Change row for every insert, update and delete, so ORM
+# flushes and Core bulk statements (stock updates, batch payments,
+# catalog imports, archiving) are all recorded without each write path
+# having to remember to. The triggers run inside the writing transaction,
+# and SQLite commits one writer at a time, so seq is the commit order.
+
+# (entity, table, key column) for the rows the feed covers
+TRACKED = (('order', 'order', 'id'),
+           ('payment', 'payment', 'order_id'),
+           ('product', 'product', 'id'),
+           ('client', 'client', 'client_id'))
+
+# (op, trigger event, row the key is read from)
+OPS = (('insert', 'INSERT', 'NEW'),
+       ('update', 'UPDATE', 'NEW'),
+       ('delete', 'DELETE', 'OLD'))
+
+# Seconds between checks while a long poll waits for changes
+POLL_INTERVAL = 0.5
+
+
+def trigger_statements():
+    for (entity, table, key) in TRACKED:
+        for (op, trigger_event, row) in OPS:
+            yield ('CREATE TRIGGER IF NOT EXISTS change_%s_%s AFTER %s ON "%s" FOR EACH ROW BEGIN '
+                   'INSERT INTO change (entity, entity_id, op, timestamp) '
+                   "VALUES ('%s', %s.%s, '%s', datetime('now', 'localtime')); END" %
+                   (entity, op, trigger_event, table, entity, row, key, op))
+
+def install_triggers(target, connection, **kw):
+    """Creates the triggers once the change table exists. Also runs
+    after db.create_all()."""
+    tables = kw.get('tables')
+    if connection.dialect.name != 'sqlite' or (tables is not None and Change.__table__ not in tables):
+        return
+    for statement in trigger_statements():
+        connection.execute(statement)
+
+event.listen(db.metadata, 'after_create', install_triggers)
+
+def ensure_change_log():
+    """Creates the change table and its triggers in a database that
+    predates them."""
+    engine = db.get_engine(app)
+    Change.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        install_triggers(None, connection)
+
+
+def latest_seq():
+    return db.session.query(func.max(Change.seq)).scalar() or 0
+
+def changes_since(since, limit):
+    """(seq, entity, entity_id, op, timestamp) of the changes after since."""
+    return db.session.query(Change.seq, Change.entity, Change.entity_id, Change.op, Change.timestamp).\
+           filter(Change.seq > since).order_by(Change.seq).limit(limit).all()
+
+def wait_for_changes(since, timeout):
+    """Blocks until there is a change after since or timeout seconds have
+    passed. Returns whether there is one."""
+    deadline = time.time() + timeout
+    while latest_seq() <= since:
+        if time.time() >= deadline:
+            return False
+        # End the read transaction so the next check sees new commits
+        db.session.rollback()
+        time.sleep(POLL_INTERVAL)
+    return True
@@ -0,0 +1,141 @@
+import csv
+import datetime
+
+import numpy as np
+from sqlalchemy import and_, select, union_all
+
+from app import db
+
+from .archive import not_hot, reaches_archive
+from .models import ArchivedOrder, ArchivedOrderItem, CommissionStatement, Employee, Order, OrderItem
+
+from helpers import chunked
+
+# Rows pulled from the database per round trip while loading order lines
+FETCH_SIZE = 100000
+
+
+def period_bounds(start, end):
+    """Turns an inclusive date range into a half-open datetime range."""
+    return (datetime.datetime.combine(start, datetime.time()),
+            datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()))
+
+def load_hierarchy():
+    """Returns (employee_ids, parents, rates, is_salesperson) arrays. The
+    ids are sorted; parents holds the array index of each employee's
+    manager, or -1 for the top of the hierarchy."""
+    rows = db.session.query(Employee.employee_id, Employee.managed_by,
+                            Employee.commission, Employee.title).\
+           order_by(Employee.employee_id).all()
+    if not rows:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.float64), np.zeros(0, dtype=bool)
+    employee_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    managers = np.array([row[1] if row[1] is not None else -1 for row in rows], dtype=np.int64)
+    rates = np.array([row[2] for row in rows], dtype=np.float64) / 100.0
+    is_salesperson = np.array([row[3] == 'Salesperson' for row in rows], dtype=bool)
+
+    parents = np.searchsorted(employee_ids, managers)
+    parents = np.minimum(parents, len(employee_ids) - 1)
+    known = (managers >= 0) & (employee_ids[parents] == managers)
+    parents = np.where(known, parents, -1)
+    return employee_ids, parents, rates, is_salesperson
+
+def load_sales(employee_ids, start, end):
+    """Sums price * quantity of every order line in the period per
+    employee, archived ones included when the period reaches back into
+    the archive. Lines are streamed from a Core select into NumPy arrays a
+    chunk at a time, so no ORM objects are created."""
+    (begin, finish) = period_bounds(start, end)
+    def lines(order, item, *conditions):
+        return select([order.salesperson, item.price, item.quantity]).\
+               select_from(item.__table__.join(order.__table__, order.id == item.order_id)).\
+               where(and_(order.timestamp >= begin, order.timestamp < finish, *conditions))
+    statement = lines(Order, OrderItem)
+    if reaches_archive(begin):
+        statement = union_all(statement, lines(ArchivedOrder, ArchivedOrderItem, not_hot()))
+    sales = np.zeros(len(employee_ids), dtype=np.float64)
+    if len(employee_ids) == 0:
+        return sales
+    result = db.session.execute(statement)
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        lines = np.array(rows, dtype=np.float64)
+        salespeople = lines[:, 0].astype(np.int64)
+        index = np.minimum(np.searchsorted(employee_ids, salespeople), len(employee_ids) - 1)
+        known = employee_ids[index] == salespeople
+        sales += np.bincount(index[known], weights=(lines[:, 1] * lines[:, 2])[known],
+                             minlength=len(employee_ids))
+    result.close()
+    return sales
+
+def subtree_totals(values, parents):
+    """Adds every employee's value to all of their managers, one
+    hierarchy level per vectorized pass."""
+    depth = np.zeros(len(parents), dtype=np.int64)
+    ancestor = parents.copy()
+    # A well formed hierarchy is never deeper than its number of employees
+    for _ in range(len(parents)):
+        if not (ancestor >= 0).any():
+            break
+        has_ancestor = ancestor >= 0
+        depth += has_ancestor
+        ancestor = np.where(has_ancestor, parents[np.maximum(ancestor, 0)], -1)
+
+    totals = values.copy()
+    for level in range(depth.max() if len(depth) else 0, 0, -1):
+        nodes = np.nonzero(depth == level)[0]
+        np.add.at(totals, parents[nodes], totals[nodes])
+    return totals
+
+def compute_statements(start, end):
+    """Computes commission statements for the whole hierarchy for the
+    period. Returns a list of dicts ready to insert into
+    commission_statement."""
+    (employee_ids, parents, rates, is_salesperson) = load_hierarchy()
+    own_sales = load_sales(employee_ids, start, end)
+    team_sales = subtree_totals(own_sales, parents) - own_sales
+    own_commission = own_sales * rates
+    override_commission = np.where(is_salesperson, 0.0, team_sales * rates)
+    total = own_commission + override_commission
+
+    now = datetime.datetime.now()
+    return [dict(period_start=start,
+                 period_end=end,
+                 employee_id=int(employee_ids[i]),
+                 commission_rate=float(rates[i] * 100.0),
+                 own_sales=round(float(own_sales[i]), 2),
+                 own_commission=round(float(own_commission[i]), 2),
+                 team_sales=round(float(team_sales[i]), 2),
+                 override_commission=round(float(override_commission[i]), 2),
+                 total=round(float(total[i]), 2),
+                 created_at=now)
+            for i in range(len(employee_ids))]
+
+def run_payouts(start, end):
+    """Computes the period's statements and replaces any previously
+    written for the same period in one transaction."""
+    statements = compute_statements(start, end)
+    table = CommissionStatement.__table__
+    try:
+        db.session.execute(table.delete().where(and_(table.c.period_start == start,
+                                                     table.c.period_end == end)))
+        for chunk in chunked(statements, 5000):
+            db.session.execute(table.insert(), chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return statements
+
+def write_statements(statements, fileobj):
+    """Writes CommissionStatement rows as CSV."""
+    writer = csv.writer(fileobj)
+    writer.writerow(('Period Start', 'Period End', 'Employee', 'Title', 'Commission %',
+                     'Own Sales', 'Own Commission', 'Team Sales', 'Override Commission', 'Total'))
+    for s in statements:
+        writer.writerow((s.period_start, s.period_end, s.employee.username, s.employee.title,
+                         s.commission_rate, '%.2f' % s.own_sales, '%.2f' % s.own_commission,
+                         '%.2f' % s.team_sales, '%.2f' % s.override_commission, '%.2f' % s.total))
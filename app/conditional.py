@@ -0,0 +1,98 @@
+import datetime
+import hashlib
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask.ext.login import current_user
+
+from .cache import user_version, version_stamps
+
+from pricing import price_index
+
+# Pages are answered with 304 Not Modified when the data they are built
+# from has not changed since the client's copy. What a page is built from
+# is described by the data_version names below, so the check is a single
+# lookup in data_version and the view itself never runs.
+
+
+def resource_versions(resource, user_id):
+    """The data_version names behind a resource, for one user."""
+    if resource == 'catalog':
+        return ['products', 'promotions', 'stock']
+    if resource == 'promotions':
+        return ['promotions', 'products']
+    if resource == 'team':
+        return ['orders', 'employees']
+    if resource == 'popularity':
+        return ['popularity']
+    if resource in ('orders', 'feedback'):
+        return [user_version(resource, user_id)]
+    raise KeyError(resource)
+
+# Resources whose content also changes when a promotion window opens or
+# closes, without any write to the database
+PRICED_RESOURCES = ('catalog', 'promotions')
+
+def resource_stamp(resources, user_id):
+    """Returns (etag, last_modified) for the current state of resources.
+    last_modified is a naive UTC datetime, or None where it cannot be
+    known: priced pages change on the clock as well as on writes."""
+    names = []
+    for resource in resources:
+        names.extend(resource_versions(resource, user_id))
+    (versions, updated_at) = version_stamps(*names)
+    parts = [user_id, names, versions]
+    last_modified = None
+    if any(resource in PRICED_RESOURCES for resource in resources):
+        parts.append(price_index.valid_until())
+    elif updated_at is not None:
+        last_modified = datetime.datetime.utcfromtimestamp(time.mktime(updated_at.timetuple()))
+    return hashlib.sha1(repr(parts)).hexdigest(), last_modified
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return request.if_modified_since >= last_modified
+    return False
+
+def conditional(*resources):
+    """View decorator for read-mostly GET pages. resources name what the
+    page is built from; a callable is called with the view's arguments and
+    returns resource names, for pages that differ by user. The response
+    carries an ETag (and Last-Modified where possible), and a request
+    that already has the current copy gets 304 before the view runs.
+
+    Pages with flashed messages waiting are never cached, since the
+    messages are rendered into them."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                return f(*args, **kwargs)
+            names = []
+            for resource in resources:
+                names.extend(resource(**kwargs) if callable(resource) else [resource])
+            (etag, last_modified) = resource_stamp(names, getattr(current_user, 'id', None))
+            # The URL is part of the tag: one resource backs many pages
+            etag = hashlib.sha1(etag + request.full_path.encode('utf-8')).hexdigest()
+            if not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or session.get('_flashes'):
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return decorated
+    return decorator
+
+def stamps(resources, user_id):
+    """{resource: etag} for client-side polling."""
+    return dict((resource, resource_stamp([resource], user_id)[0]) for resource in resources)
@@ -0,0 +1,220 @@
+import datetime
+import time
+from collections import defaultdict
+
+from sqlalchemy import and_, func
+
+from app import db
+
+from .archive import not_hot
+from .models import (
+    ArchivedOrder, ArchivedOrderItem, Client, Employee, Order, OrderItem, Product, SalesCube
+)
+
+from helpers import chunked
+
+GRAINS = ('day', 'week', 'month')
+DIMENSIONS = ('product', 'salesperson', 'client')
+
+CUBE_COLUMNS = {
+    'product': SalesCube.product_id,
+    'salesperson': SalesCube.salesperson_id,
+    'client': SalesCube.client_id,
+}
+ORDER_ITEM_COLUMNS = {
+    'product': OrderItem.product_id,
+    'salesperson': Order.salesperson,
+    'client': Order.client,
+}
+
+
+def period_start(grain, date):
+    """Returns the first day of the bucket that date falls into. Weeks
+    start on Monday."""
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if grain == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if grain == 'month':
+        return date.replace(day=1)
+    return date
+
+def _to_date(value):
+    # func.date() comes back as a string from SQLite
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+###############################################################################
+# Maintenance
+###############################################################################
+def record_order_lines(order, lines):
+    """Adds an order's lines to every grain of the cube. lines is a list
+    of (product_id, price, quantity). Runs inside the caller's transaction
+    so the cube commits together with the order."""
+    cells = defaultdict(lambda: [0, 0.0, 0])
+    for (product_id, price, quantity) in lines:
+        for grain in GRAINS:
+            cell = cells[(grain, period_start(grain, order.timestamp), product_id)]
+            cell[0] += quantity
+            cell[1] += price * quantity
+            cell[2] += 1
+
+    table = SalesCube.__table__
+    for ((grain, period, product_id), (quantity, revenue, count)) in cells.items():
+        key = and_(table.c.grain == grain,
+                   table.c.period == period,
+                   table.c.product_id == product_id,
+                   table.c.salesperson_id == order.salesperson,
+                   table.c.client_id == order.client)
+        result = db.session.execute(table.update().where(key).
+                                    values(quantity=table.c.quantity + quantity,
+                                           revenue=table.c.revenue + revenue,
+                                           lines=table.c.lines + count))
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(grain=grain,
+                                                     period=period,
+                                                     product_id=product_id,
+                                                     salesperson_id=order.salesperson,
+                                                     client_id=order.client,
+                                                     quantity=quantity,
+                                                     revenue=revenue,
+                                                     lines=count))
+
+def rebuild(batch_size=5000):
+    """Recomputes the whole cube from OrderItem and the archived order
+    lines in one transaction. Order lines are grouped per day in SQL and
+    the day cells are rolled up into weeks and months in Python. Returns
+    the number of cells written."""
+    cells = defaultdict(lambda: [0, 0.0, 0])
+    for (order, item) in ((Order, OrderItem), (ArchivedOrder, ArchivedOrderItem)):
+        day = func.date(order.timestamp)
+        query = db.session.query(day, item.product_id, order.salesperson, order.client,
+                                 func.sum(item.quantity),
+                                 func.sum(item.price * item.quantity),
+                                 func.count()).\
+                join(order, order.id == item.order_id).\
+                group_by(day, item.product_id, order.salesperson, order.client)
+        if order is ArchivedOrder:
+            query = query.filter(not_hot())
+        for (date, product_id, salesperson_id, client_id, quantity, revenue, count) in query:
+            date = _to_date(date)
+            for grain in GRAINS:
+                cell = cells[(grain, period_start(grain, date), product_id, salesperson_id, client_id)]
+                cell[0] += quantity
+                cell[1] += revenue
+                cell[2] += count
+
+    rows = [dict(grain=grain, period=period, product_id=product_id,
+                 salesperson_id=salesperson_id, client_id=client_id,
+                 quantity=quantity, revenue=revenue, lines=count)
+            for ((grain, period, product_id, salesperson_id, client_id),
+                 (quantity, revenue, count)) in cells.iteritems()]
+    try:
+        db.session.execute(SalesCube.__table__.delete())
+        for chunk in chunked(rows, batch_size):
+            db.session.execute(SalesCube.__table__.insert(), chunk)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows)
+
+
+###############################################################################
+# Queries
+###############################################################################
+def query_cube(grain, start, end, dimensions=(), salesperson_ids=None,
+               product_id=None, client_id=None):
+    """Slices the cube. Returns (period, <dimension ids...>, quantity,
+    revenue) tuples for buckets starting between start and end, grouped
+    by period and the requested dimensions. salesperson_ids limits the
+    result to a part of the management hierarchy."""
+    columns = [CUBE_COLUMNS[d] for d in dimensions]
+    query = db.session.query(SalesCube.period, *(columns + [func.sum(SalesCube.quantity),
+                                                            func.sum(SalesCube.revenue)])).\
+            filter(SalesCube.grain == grain,
+                   SalesCube.period >= period_start(grain, start),
+                   SalesCube.period <= end)
+    if salesperson_ids is not None:
+        query = query.filter(SalesCube.salesperson_id.in_(salesperson_ids))
+    if product_id is not None:
+        query = query.filter(SalesCube.product_id == product_id)
+    if client_id is not None:
+        query = query.filter(SalesCube.client_id == client_id)
+    query = query.group_by(SalesCube.period, *columns).\
+            order_by(SalesCube.period, *columns)
+    return query.all()
+
+def aggregate_order_items(grain, start, end, dimensions=(), salesperson_ids=None,
+                          product_id=None, client_id=None):
+    """Computes the same result as query_cube directly from OrderItem.
+    Used by the benchmark and to check the cube against the base tables."""
+    columns = [ORDER_ITEM_COLUMNS[d] for d in dimensions]
+    day = func.date(Order.timestamp)
+    query = db.session.query(day, *(columns + [func.sum(OrderItem.quantity),
+                                               func.sum(OrderItem.price * OrderItem.quantity)])).\
+            join(Order, Order.id == OrderItem.order_id).\
+            filter(Order.timestamp >= datetime.datetime.combine(period_start(grain, start),
+                                                                datetime.time()),
+                   Order.timestamp < datetime.datetime.combine(end + datetime.timedelta(days=1),
+                                                               datetime.time()))
+    if salesperson_ids is not None:
+        query = query.filter(Order.salesperson.in_(salesperson_ids))
+    if product_id is not None:
+        query = query.filter(OrderItem.product_id == product_id)
+    if client_id is not None:
+        query = query.filter(Order.client == client_id)
+    query = query.group_by(day, *columns)
+
+    buckets = defaultdict(lambda: [0, 0.0])
+    for row in query:
+        key = (period_start(grain, _to_date(row[0])),) + tuple(row[1:-2])
+        buckets[key][0] += row[-2]
+        buckets[key][1] += row[-1]
+    return [key + tuple(totals) for (key, totals) in sorted(buckets.items())]
+
+def dimension_labels(rows, dimensions):
+    """Maps the ids in query_cube rows to display names, one query per
+    dimension. Returns {dimension: {id: label}}."""
+    labels = {}
+    for (position, dimension) in enumerate(dimensions, 1):
+        ids = sorted(set(row[position] for row in rows))
+        names = {}
+        for chunk in chunked(ids, 500):
+            if dimension == 'product':
+                names.update((product_id, '%s - %s' % (manufacturer, name))
+                             for (product_id, manufacturer, name) in
+                             db.session.query(Product.id, Product.manufacturer, Product.name).
+                             filter(Product.id.in_(chunk)))
+            elif dimension == 'salesperson':
+                names.update(db.session.query(Employee.employee_id, Employee.username).
+                             filter(Employee.employee_id.in_(chunk)))
+            else:
+                names.update(db.session.query(Client.client_id, Client.username).
+                             filter(Client.client_id.in_(chunk)))
+        labels[dimension] = names
+    return labels
+
+
+###############################################################################
+# Benchmark
+###############################################################################
+def benchmark(grain, start, end, dimensions=DIMENSIONS, repeat=5):
+    """Times query_cube against aggregate_order_items for the same slice.
+    Returns (cube seconds, on-the-fly seconds, result rows), taking the
+    best of repeat runs for each."""
+    def best_of(f):
+        timings = []
+        for _ in range(repeat):
+            began = time.time()
+            rows = f(grain, start, end, dimensions)
+            timings.append(time.time() - began)
+            db.session.rollback()
+        return min(timings), rows
+    (cube_time, rows) = best_of(query_cube)
+    (base_time, _rows) = best_of(aggregate_order_items)
+    return cube_time, base_time, len(rows)
@@ -0,0 +1,190 @@
+import datetime
+import json
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+from app import db
+
+from .archive import not_hot
+from .cache import bump_version
+from .models import ArchivedOrder, ArchivedOrderItem, Event, EventCheckpoint, Order, OrderItem
+
+# The event log. Write paths append a compact event to it in the same
+# transaction as the change itself, so the log holds exactly the changes
+# that committed. SQLite has one writer at a time, so events become visible
+# in seq order and a reader that has seen seq n never sees a smaller seq
+# show up later.
+#
+# Projections are derived tables kept up to date from the log by
+# consume(), which applies the events after the projection's checkpoint
+# and moves the checkpoint in one transaction. replay() rebuilds a
+# projection from the start of the log. New aggregates are added as
+# projections, without touching the write paths.
+
+ORDER_PLACED = 'order_placed'           # order_id, client_id, salesperson_id, lines: [[product_id, price, quantity]]
+PAYMENT_APPLIED = 'payment_applied'     # order_id, amount
+STOCK_RECEIVED = 'stock_received'       # product_id, quantity (new on hand), added
+PROMOTION_SAVED = 'promotion_saved'     # promotion_id, product_id or manufacturer, discount or percent_off, starts_at, ends_at
+PROMOTION_DELETED = 'promotion_deleted' # promotion_id
+BULK_PROMOTION = 'bulk_promotion'       # action, count, percent_off, starts_at, ends_at
+
+# Events read per consumer transaction
+BATCH_SIZE = 1000
+
+
+def _encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value))
+
+def _row(kind, now, data):
+    return dict(kind=kind, timestamp=now,
+                data=json.dumps(data, separators=(',', ':'), default=_encode))
+
+def record_event(kind, **data):
+    """Appends one event in the caller's transaction."""
+    db.session.execute(Event.__table__.insert().values(_row(kind, datetime.datetime.now(), data)))
+
+def record_events(kind, items):
+    """Appends one event per dict in items with a single executemany."""
+    now = datetime.datetime.now()
+    rows = [_row(kind, now, data) for data in items]
+    if rows:
+        db.session.execute(Event.__table__.insert(), rows)
+
+
+###############################################################################
+# Consumers
+###############################################################################
+class Projection(object):
+    """A table derived from the event log. Subclasses set name and kinds
+    and implement apply(); reset() empties the table before a replay.
+    Both run inside the consumer's transaction and must not commit."""
+    name = None
+    kinds = ()
+    # data_version bumped whenever the projection changes
+    version_name = None
+
+    def apply(self, events):
+        """events is a list of (seq, kind, timestamp, data) with data
+        already decoded, in seq order, of the kinds listed in kinds."""
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+projections = OrderedDict()
+
+def register(projection):
+    projections[projection.name] = projection
+    return projection
+
+def checkpoint(name):
+    """The last seq applied to the named projection."""
+    position = db.session.query(EventCheckpoint.position).filter_by(consumer=name).scalar()
+    return position or 0
+
+def _move_checkpoint(name, old, new):
+    """Moves the checkpoint from old to new. Returns False when another
+    consumer moved it first."""
+    table = EventCheckpoint.__table__
+    now = datetime.datetime.now()
+    result = db.session.execute(table.update().
+                                where(table.c.consumer == name).
+                                where(table.c.position == old).
+                                values(position=new, updated_at=now))
+    if result.rowcount == 0:
+        if old != 0 or db.session.query(EventCheckpoint.consumer).filter_by(consumer=name).first():
+            return False
+        db.session.execute(table.insert().values(consumer=name, position=new, updated_at=now))
+    return True
+
+def consume(projection, batch_size=BATCH_SIZE):
+    """Brings a projection up to the end of the log, one transaction per
+    batch. Several processes may run this at once: a batch whose
+    checkpoint was moved by someone else is rolled back and the loser
+    stops. Returns the number of events applied."""
+    applied = 0
+    while True:
+        position = checkpoint(projection.name)
+        rows = db.session.query(Event.seq, Event.kind, Event.timestamp, Event.data).\
+               filter(Event.seq > position).order_by(Event.seq).limit(batch_size).all()
+        if not rows:
+            db.session.rollback()
+            return applied
+        events = [(seq, kind, timestamp, json.loads(data))
+                  for (seq, kind, timestamp, data) in rows if kind in projection.kinds]
+        try:
+            if not _move_checkpoint(projection.name, position, rows[-1][0]):
+                db.session.rollback()
+                return applied
+            if events:
+                projection.apply(events)
+                if projection.version_name:
+                    bump_version(projection.version_name)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied += len(events)
+        if len(rows) < batch_size:
+            return applied
+
+def consume_all():
+    return dict((name, consume(projection)) for (name, projection) in projections.items())
+
+def replay(projection):
+    """Empties the projection and rebuilds it from the start of the log."""
+    table = EventCheckpoint.__table__
+    try:
+        projection.reset()
+        db.session.execute(table.delete().where(table.c.consumer == projection.name))
+        if projection.version_name:
+            bump_version(projection.version_name)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return consume(projection)
+
+
+###############################################################################
+# Seeding
+###############################################################################
+def seed_orders(batch_size=500):
+    """Appends an order_placed event for every order, hot and archived,
+    placed before the log was started, so projections also cover the
+    history. Only runs on an empty log, and in one transaction so an
+    interrupted run leaves it empty. Returns the number of events."""
+    if db.session.query(func.count(Event.seq)).scalar():
+        return 0
+    seeded = 0
+    try:
+        for (order, item) in ((ArchivedOrder, ArchivedOrderItem), (Order, OrderItem)):
+            after_id = 0
+            while True:
+                query = db.session.query(order.id, order.timestamp, order.client, order.salesperson).\
+                        filter(order.id > after_id)
+                if order is ArchivedOrder:
+                    query = query.filter(not_hot())
+                orders = query.order_by(order.id).limit(batch_size).all()
+                if not orders:
+                    break
+                after_id = orders[-1][0]
+                lines = dict((row[0], []) for row in orders)
+                for (order_id, product_id, price, quantity) in \
+                        db.session.query(item.order_id, item.product_id, item.price, item.quantity).\
+                        filter(item.order_id.in_(lines.keys())):
+                    lines[order_id].append([product_id, price, quantity])
+                db.session.execute(Event.__table__.insert(),
+                                   [_row(ORDER_PLACED, timestamp,
+                                         dict(order_id=order_id, client_id=client_id,
+                                              salesperson_id=salesperson_id, lines=lines[order_id]))
+                                    for (order_id, timestamp, client_id, salesperson_id) in orders])
+                seeded += len(orders)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return seeded
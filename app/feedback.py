@@ -0,0 +1,267 @@
+import datetime
+import threading
+from collections import deque
+
+from sqlalchemy import and_, bindparam, case, func, or_, select
+
+from app import app, db
+
+from .cache import bump_version, user_version
+from .models import SINCE_BAN_COUNTS, Employee, Feedback, User
+
+# Group-committed feedback. Likes and dislikes arrive in bursts, and writing
+# each one in its own transaction means one SQLite commit (and fsync) per
+# click. submit_feedback() instead hands the row to a writer thread per
+# process. An idle writer commits a row at once; rows that arrive while a
+# write is in flight queue up and go out together in the next transaction,
+# up to FEEDBACK_BATCH_SIZE rows each. So a lone click costs no more than
+# before, and under load many clicks share one commit. The submitting
+# request waits for its row to commit, so its next request reads its own
+# feedback whichever process serves it.
+#
+# Each user row carries a rolling window of the ratings they gave and
+# received, as bitmasks, and counts since their last banning. Writing a
+# rating shifts one bit into each window with a single UPDATE per side, and
+# the ban rules are one conditional UPDATE over the users in the batch, so
+# neither reads any feedback rows.
+
+# Ratings kept in each window
+WINDOW_SIZE = 16
+
+# A user who leaves this many pieces of feedback in a row since their last
+# banning, all likes or all dislikes, is banned
+ONE_SIDED_LIMIT = 9
+
+# Dislikes received since their last banning that get a user banned
+CLIENT_DISLIKE_LIMIT = 2
+SALESPERSON_DISLIKE_LIMIT = 9
+
+# The feedback page: rows of history per page, how many of the most recent
+# ratings make up the "recent" window, and how many weeks the trend shows
+HISTORY_PER_PAGE = 50
+RECENT_WINDOW = 20
+TREND_WEEKS = 12
+
+# How long a submitter waits for the writer before giving up
+WAIT_SECONDS = 30
+
+
+class FeedbackBatch(object):
+    """Rows written together, and whether the write is done."""
+    def __init__(self):
+        self.rows = []
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self, timeout):
+        if not self.done.wait(timeout):
+            raise RuntimeError('Feedback was not written within %i seconds' % (timeout))
+        if self.error is not None:
+            raise self.error
+
+
+class FeedbackBuffer(threading.Thread):
+    """Collects feedback rows and writes them in group commits."""
+    def __init__(self, app, max_size):
+        threading.Thread.__init__(self, name='feedback-writer')
+        self.daemon = True
+        self.app = app
+        self.max_size = max_size
+        self.cond = threading.Condition()
+        # Batches waiting to be written, oldest first; the last one is open
+        self.pending = deque([FeedbackBatch()])
+
+    def add(self, row):
+        """Adds row to the open batch and returns the batch."""
+        with self.cond:
+            batch = self.pending[-1]
+            if len(batch.rows) >= self.max_size:
+                batch = FeedbackBatch()
+                self.pending.append(batch)
+            batch.rows.append(row)
+            self.cond.notify()
+        return batch
+
+    def _take(self):
+        """Waits for a row and takes the oldest batch, leaving an open one."""
+        with self.cond:
+            while not self.pending[0].rows:
+                self.cond.wait()
+            batch = self.pending.popleft()
+            if not self.pending:
+                self.pending.append(FeedbackBatch())
+            return batch
+
+    def run(self):
+        while True:
+            batch = self._take()
+            with self.app.app_context():
+                try:
+                    write_feedback(batch.rows)
+                except Exception, err:
+                    db.session.rollback()
+                    self.app.logger.exception('Writing %i feedback rows failed' % (len(batch.rows)))
+                    batch.error = err
+                finally:
+                    db.session.remove()
+            batch.done.set()
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def feedback_buffer():
+    """This process's buffer, started on first use so that each forked
+    worker gets its own writer thread. None when batching is off."""
+    global _buffer
+    max_size = app.config.get('FEEDBACK_BATCH_SIZE')
+    if not max_size or max_size <= 1:
+        return None
+    with _buffer_lock:
+        if _buffer is None or not _buffer.is_alive():
+            _buffer = FeedbackBuffer(app, max_size)
+            _buffer.start()
+        return _buffer
+
+
+def submit_feedback(from_user_id, to_user_id, is_positive):
+    """Records a like or dislike from one user to another and returns once
+    it is committed. With batching off it is written in the request's own
+    transaction."""
+    row = dict(from_user=from_user_id, to_user=to_user_id,
+               timestamp=datetime.datetime.now(), is_positive=is_positive)
+    buffer = feedback_buffer()
+    if buffer is None:
+        try:
+            write_feedback([row])
+        except Exception:
+            db.session.rollback()
+            raise
+        return
+    # End this request's read transaction first: it would hold off the
+    # writer's commit, and later reads must not see a snapshot from
+    # before the batch
+    db.session.rollback()
+    batch = buffer.add(row)
+    batch.wait(WAIT_SECONDS)
+
+def write_feedback(rows):
+    """Inserts rows, moves the givers' and recipients' windows along, bans
+    the users the batch puts over a limit and bumps the recipients'
+    feedback versions, all in one transaction, and commits."""
+    now = datetime.datetime.now()
+    table = User.__table__
+    db.session.execute(Feedback.__table__.insert(), rows)
+    # executemany applies the rows in order, so the newest ends up in bit 0
+    db.session.execute(table.update().
+                       where(table.c.id == bindparam('b_id')).
+                       values(given_window=(table.c.given_window * 2 + bindparam('b_like')) % 2**WINDOW_SIZE,
+                              given_since_ban=table.c.given_since_ban + 1),
+                       [dict(b_id=row['from_user'], b_like=int(row['is_positive'])) for row in rows])
+    db.session.execute(table.update().
+                       where(table.c.id == bindparam('b_id')).
+                       values(received_window=(table.c.received_window * 2 + bindparam('b_like')) % 2**WINDOW_SIZE,
+                              received_since_ban=table.c.received_since_ban + 1,
+                              dislikes_since_ban=table.c.dislikes_since_ban + bindparam('b_dislike')),
+                       [dict(b_id=row['to_user'], b_like=int(row['is_positive']),
+                             b_dislike=int(not row['is_positive'])) for row in rows])
+    user_ids = set(row['from_user'] for row in rows) | set(row['to_user'] for row in rows)
+    db.session.execute(table.update().
+                       where(and_(table.c.id.in_(user_ids),
+                                  or_(table.c.banned == None, table.c.banned == False),
+                                  ban_rules(table))).
+                       values(banned=True, last_banning=now,
+                              **dict((name, 0) for name in SINCE_BAN_COUNTS)))
+    bump_version(*[user_version('feedback', user_id)
+                   for user_id in sorted(set(row['to_user'] for row in rows))])
+    db.session.commit()
+
+def ban_rules(table):
+    """True for a user row whose window breaks a ban rule."""
+    last_given = table.c.given_window % 2**ONE_SIDED_LIMIT
+    salespeople = select([Employee.__table__.c.user_id]).\
+                  where(Employee.__table__.c.title == 'Salesperson')
+    return or_(and_(table.c.given_since_ban >= ONE_SIDED_LIMIT,
+                    last_given.in_([0, 2**ONE_SIDED_LIMIT - 1])),
+               and_(table.c.is_employee == False,
+                    table.c.dislikes_since_ban >= CLIENT_DISLIKE_LIMIT),
+               and_(table.c.id.in_(salespeople),
+                    table.c.dislikes_since_ban >= SALESPERSON_DISLIKE_LIMIT))
+
+def rebuild_windows(batch_size=500):
+    """Recomputes every user's window from the feedback table, for
+    databases that predate the windows. Bans nobody. Returns the number of
+    users updated."""
+    last_banning = dict(db.session.query(User.id, User.last_banning))
+    windows = dict((user_id, dict(given_window=0, received_window=0,
+                                  **dict((name, 0) for name in SINCE_BAN_COUNTS)))
+                   for user_id in last_banning)
+    ratings = db.session.query(Feedback.from_user, Feedback.to_user, Feedback.timestamp, Feedback.is_positive).\
+              order_by(Feedback.timestamp, Feedback.id).yield_per(batch_size)
+    for (from_user, to_user, timestamp, is_positive) in ratings:
+        like = int(is_positive)
+        given = windows[from_user]
+        given['given_window'] = (given['given_window'] * 2 + like) % 2**WINDOW_SIZE
+        if last_banning[from_user] is None or timestamp > last_banning[from_user]:
+            given['given_since_ban'] += 1
+        received = windows[to_user]
+        received['received_window'] = (received['received_window'] * 2 + like) % 2**WINDOW_SIZE
+        if last_banning[to_user] is None or timestamp > last_banning[to_user]:
+            received['received_since_ban'] += 1
+            received['dislikes_since_ban'] += 1 - like
+    table = User.__table__
+    try:
+        if windows:
+            db.session.execute(table.update().
+                               where(table.c.id == bindparam('b_id')).
+                               values(**dict((name, bindparam('b_' + name))
+                                             for name in ('given_window', 'received_window') + SINCE_BAN_COUNTS)),
+                               [dict(b_id=user_id, **dict(('b_' + name, value) for (name, value) in window.items()))
+                                for (user_id, window) in windows.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(windows)
+
+
+###############################################################################
+# Feedback page
+###############################################################################
+def feedback_summary(user_id, weeks=TREND_WEEKS, window=RECENT_WINDOW):
+    """Likes and dislikes received by a user: all-time totals, the split
+    over the last window ratings and the last weeks weeks that had any,
+    oldest first, as (week starting Monday, likes, dislikes). The totals
+    and the trend come from one query grouped by week."""
+    # 'weekday 0' moves forward to Sunday, so six days back is Monday
+    week = func.date(Feedback.timestamp, 'weekday 0', '-6 days')
+    rows = db.session.query(week,
+                            func.sum(case([(Feedback.is_positive == True, 1)], else_=0)),
+                            func.count()).\
+           filter(Feedback.to_user == user_id).\
+           group_by(week).order_by(week).all()
+    trend = [(datetime.datetime.strptime(start, '%Y-%m-%d').date(), likes, count - likes)
+             for (start, likes, count) in rows]
+    likes = sum(row[1] for row in trend)
+    total = sum(row[1] + row[2] for row in trend)
+
+    recent = [is_positive for (is_positive,) in
+              db.session.query(Feedback.is_positive).
+              filter(Feedback.to_user == user_id).
+              order_by(Feedback.timestamp.desc()).limit(window)]
+    recent_likes = len([is_positive for is_positive in recent if is_positive])
+    return dict(likes=likes,
+                dislikes=total - likes,
+                total=total,
+                window=len(recent),
+                recent_likes=recent_likes,
+                recent_dislikes=len(recent) - recent_likes,
+                trend=trend[-weeks:])
+
+def feedback_history(user_id, page, per_page=HISTORY_PER_PAGE):
+    """One page of the feedback a user received, newest first, as
+    (Feedback, author username) with the authors joined in."""
+    return db.session.query(Feedback, User.username).\
+           join(User, User.id == Feedback.from_user).\
+           filter(Feedback.to_user == user_id).\
+           order_by(Feedback.timestamp.desc()).\
+           offset((page - 1) * per_page).limit(per_page).all()
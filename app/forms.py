@@ -1,24 +1,54 @@
 from flask.ext.wtf import Form
-from wtforms import BooleanField, DecimalField, IntegerField, PasswordField, SelectField, StringField
+from flask.ext.wtf.file import FileField, FileRequired
+from wtforms import BooleanField, DateTimeField, DecimalField, IntegerField, PasswordField, SelectField, StringField
 from wtforms.ext.sqlalchemy.orm import model_form
-from wtforms.validators import DataRequired, Length, NumberRange
+from wtforms.validators import DataRequired, Length, NumberRange, Optional
 
 import models
 from app import db
 
 
+class LazyModelForm(object):
+    """Stands in for a model_form class and only builds it, by
+    introspecting the model, the first time the form is used. Keeps the
+    model introspection off the import path of every new worker.
+
+    fields is an optional class of extra or overriding fields, as a
+    subclass of the model form would declare them. parent builds on
+    another LazyModelForm instead of a model."""
+    def __init__(self, name, model=None, parent=None, fields=None, **options):
+        self.__name__ = name
+        self._model = model
+        self._parent = parent
+        self._fields = fields
+        self._options = options
+        self._form_class = None
+
+    def form_class(self):
+        if self._form_class is None:
+            if self._parent is not None:
+                base = self._parent.form_class()
+            else:
+                base = model_form(self._model, base_class=Form, **self._options)
+            bases = (base,) if self._fields is None else (self._fields, base)
+            self._form_class = type(self.__name__, bases, {})
+        return self._form_class
+
+    def __call__(self, *args, **kwargs):
+        return self.form_class()(*args, **kwargs)
+
+
 class CreateUserForm(Form):
     username = StringField('Username', validators=[DataRequired()])
     password1 = StringField('Password', validators=[DataRequired(), Length(min=10)])
     password2 = StringField('Confirm Password', validators=[DataRequired(), Length(min=10)])
     is_employee = BooleanField('Employee?')
 
-EmployeeForm = model_form(models.Employee,
-                          base_class=Form,
-                          db_session=db.session,
-                          exclude=['password_hash', 'is_employee', 'active']) 
+EmployeeForm = LazyModelForm('EmployeeForm', models.Employee,
+                             db_session=db.session,
+                             exclude=['password_hash', 'is_employee', 'active'])
 
-class AddEmployeeForm(EmployeeForm):
+class AddEmployeeFields(object):
     password1 = StringField('Password', validators=[DataRequired(), Length(min=10)])
     password2 = StringField('Confirm Password', validators=[DataRequired(), Length(min=10)])
     managed_by = SelectField('ManagedBy',coerce=int)
@@ -26,44 +56,89 @@ class AddEmployeeForm(EmployeeForm):
     max_discount = DecimalField('Max Discount' , validators =[DataRequired(), NumberRange(0, 100)])
     title = SelectField(u'title', choices=[('Director', 'Director'), ('Manager', 'Manager'), ('Salesperson', 'Salesperson')])
 
-class EditEmployeeForm(EmployeeForm):
+AddEmployeeForm = LazyModelForm('AddEmployeeForm', parent=EmployeeForm, fields=AddEmployeeFields)
+
+class EditEmployeeFields(object):
     active     = SelectField('Current Employee?', choices = [('True', 'True'), ('False', 'False')], validators = [DataRequired()])
     managed_by = SelectField('ManagedBy',coerce=int)
     commission = StringField('Commission' , validators = [DataRequired()])
     max_discount = StringField('Max Discount' , validators =[DataRequired()])
     title = SelectField(u'Title', choices=[('Director', 'Director'), ('Manager', 'Manager'), ('Salesperson', 'Salesperson')])
-    
+
+EditEmployeeForm = LazyModelForm('EditEmployeeForm', parent=EmployeeForm, fields=EditEmployeeFields)
+
 class LoginForm(Form):
     username = StringField('Username', validators=[DataRequired()])
     password = StringField('Password', validators=[DataRequired()])
 
-ClientForm = model_form(models.Client,
-                        base_class=Form, 
-                        db_session=db.session,
-                        exclude=['password_hash', 'is_employee', 'active'])
-class AddClientForm(ClientForm):
+ClientForm = LazyModelForm('ClientForm', models.Client,
+                           db_session=db.session,
+                           exclude=['password_hash', 'is_employee', 'active'])
+class AddClientFields(object):
     password1 = StringField('Password', validators=[DataRequired(), Length(min=10)])
     password2 = StringField('Confirm Password', validators=[DataRequired(), Length(min=10)])
     salesperson_id = SelectField(u'Salesperson', coerce=int)
 
-class EditClientForm(ClientForm):
+AddClientForm = LazyModelForm('AddClientForm', parent=ClientForm, fields=AddClientFields)
+
+class EditClientFields(object):
     salesperson_id = SelectField(u'Salesperson', coerce=int)
 
+EditClientForm = LazyModelForm('EditClientForm', parent=ClientForm, fields=EditClientFields)
 
-ProductForm  = model_form(models.Product,
-                          base_class=Form,
-                          exclude=['active'],
-                          field_args = {
-                              'price' : { 'validators': [NumberRange(min=0.01)]},
-                              'quantity' : { 'validators': [NumberRange(min=1)]}
-                          })
-ReorderProductForm  = model_form(models.Product, base_class=Form, exclude=['active'])
+
+ProductForm  = LazyModelForm('ProductForm', models.Product,
+                             exclude=['active', 'reserved', 'reorder_point', 'reorder_quantity', 'lead_time_days'],
+                             field_args = {
+                                 'price' : { 'validators': [NumberRange(min=0.01)]},
+                                 'quantity' : { 'validators': [NumberRange(min=1)]}
+                             })
+ReorderProductForm  = LazyModelForm('ReorderProductForm', models.Product,
+                                    exclude=['active', 'reserved'],
+                                    field_args = {
+                                        'reorder_point' : { 'validators': [Optional(), NumberRange(min=0)]},
+                                        'reorder_quantity' : { 'validators': [Optional(), NumberRange(min=1)]},
+                                        'lead_time_days' : { 'validators': [Optional(), NumberRange(min=0)]}
+                                    })
 
 class PromotionForm(Form):
     discount = StringField('Discount Price', validators=[DataRequired(), NumberRange(min=0.01)])
+    starts_at = DateTimeField('Starts (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
+    ends_at = DateTimeField('Ends (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
+
+class ManufacturerPromotionForm(Form):
+    manufacturer = SelectField('Manufacturer')
+    percent_off = DecimalField('Percent Off', validators=[DataRequired(), NumberRange(0.01, 100)])
+    starts_at = DateTimeField('Starts (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
+    ends_at = DateTimeField('Ends (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
+
+class BulkPromotionForm(Form):
+    manufacturer = SelectField('Manufacturer')
+    min_price = DecimalField('Minimum List Price', validators=[Optional(), NumberRange(min=0)])
+    max_price = DecimalField('Maximum List Price', validators=[Optional(), NumberRange(min=0)])
+    product_ids = StringField('Product IDs (comma separated)')
+    action = SelectField('Action', choices=[('apply', 'Apply discount'), ('clear', 'Clear promotions')])
+    percent_off = DecimalField('Percent Off', validators=[Optional(), NumberRange(0.01, 100)])
+    starts_at = DateTimeField('Starts (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
+    ends_at = DateTimeField('Ends (YYYY-MM-DD HH:MM)', format='%Y-%m-%d %H:%M', validators=[Optional()])
 
 class OrderForm(Form):
     pass
 
 class PaymentForm(Form):
     amount = DecimalField('Amount' , validators = [DataRequired(), NumberRange(min=0.01)])
+
+class BatchPaymentForm(Form):
+    remittance = FileField('Remittance File (order_id, amount, timestamp)', validators=[FileRequired()])
+
+class CatalogImportForm(Form):
+    catalog = FileField('Supplier Sheet (manufacturer, name, quantity, price)', validators=[FileRequired()])
+
+class HoldForm(Form):
+    product_id = SelectField('Product', coerce=int)
+    quantity = IntegerField('Quantity', validators=[DataRequired(), NumberRange(min=1)])
+    discount = IntegerField('Discount (%)', default=0, validators=[NumberRange(min=0, max=100)])
+
+
+LAZY_FORMS = (EmployeeForm, AddEmployeeForm, EditEmployeeForm, ClientForm, AddClientForm,
+              EditClientForm, ProductForm, ReorderProductForm)
@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, has_request_context
+from jinja2 import Markup
+
+from app import app, db
+
+from .models import DataVersion
+
+from pricing import price_index
+
+
+class FragmentCache(object):
+    """A byte-bounded LRU of rendered template fragments.
+
+    Each entry remembers the data versions of the tags it depends on and
+    is only served while they are unchanged, so the write endpoints that
+    bump a tag (products, promotions, stock, one user's orders) invalidate
+    every fragment built from it, in every process. Stale entries are
+    replaced when next rendered; least recently used ones are evicted once
+    the cache holds more than max_bytes of HTML."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (version, html, render time, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != version:
+                self.stale += 1
+                self._discard(key)
+                return None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+            self.seconds_saved += entry[2]
+            return entry[1]
+
+    def set(self, key, version, html, seconds):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (version, html, seconds, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                (_key, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted[3]
+                self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.stale
+            return dict(entries=len(self._entries),
+                        bytes=self._bytes,
+                        max_bytes=self.max_bytes,
+                        hits=self.hits,
+                        misses=self.misses,
+                        stale=self.stale,
+                        evictions=self.evictions,
+                        hit_rate=(float(self.hits) / lookups) if lookups else 0.0,
+                        render_seconds_saved=round(self.seconds_saved, 3))
+
+fragment_cache = FragmentCache(app.config.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+def tag_versions(tags):
+    """Versions of the given tags. Looked up once per request however many
+    fragments a page has."""
+    known = {}
+    if has_request_context():
+        if not hasattr(g, 'fragment_versions'):
+            g.fragment_versions = {}
+        known = g.fragment_versions
+    missing = [tag for tag in tags if tag not in known]
+    if missing:
+        found = dict(db.session.query(DataVersion.name, DataVersion.version).
+                     filter(DataVersion.name.in_(missing)))
+        for tag in missing:
+            known[tag] = found.get(tag, 0)
+    return tuple(known[tag] for tag in tags)
+
+def cached_fragment(name, *key, **options):
+    """Jinja global used with {% call %}:
+
+        {% call cached_fragment('products', role, tags=['products']) %}
+          ...
+        {% endcall %}
+
+    name and key identify the fragment, so key must hold everything the
+    body depends on other than the tags (the viewer's role, a search
+    term). Pass priced=True for fragments showing promotional prices,
+    which also change as promotion windows open and close."""
+    caller = options['caller']
+    tags = tuple(options.get('tags', ()))
+    version = tag_versions(tags)
+    if options.get('priced'):
+        version += (price_index.valid_until(),)
+    cache_key = (name,) + key
+    html = fragment_cache.get(cache_key, version)
+    if html is None:
+        began = time.time()
+        html = unicode(caller())
+        fragment_cache.set(cache_key, version, html, time.time() - began)
+    return Markup(html)
+
+
+class Deferred(object):
+    """Rows computed only when a template iterates over them, so a view
+    can hand over an expensive lookup that a cached fragment may skip."""
+    def __init__(self, f, *args, **kwargs):
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+        self._rows = None
+
+    def __iter__(self):
+        if self._rows is None:
+            self._rows = list(self._f(*self._args, **self._kwargs))
+        return iter(self._rows)
@@ -24,3 +24,10 @@ def flatten_hierarchy(employee, f):
         acc += flatten_hierarchy(report, f)
     return acc
 
+
+def chunked(items, size):
+    """Splits items into lists of at most size elements. Used to keep
+    IN (...) clauses under SQLite's bound parameter limit."""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,287 @@
+import csv
+import datetime
+import json
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import and_, func
+
+from app import app, db
+
+from .models import CommissionStatement, Employee, Job
+
+from archive import find_order
+from reports import AGING_BUCKETS, ar_aging
+
+# Background jobs. A view enqueues a Job row and returns at once;
+# 'manage.py worker' runs a pool of processes that claim queued jobs
+# with a conditional UPDATE, so each job runs once however many workers
+# poll. Jobs that produce a file write it to JOB_RESULTS_DIR, where it can
+# be downloaded until it expires. While a job runs its worker updates
+# heartbeat_at every JOB_HEARTBEAT_SECONDS; a job whose heartbeat is older
+# than JOB_TIMEOUT_SECONDS has lost its worker and is picked up again, up
+# to MAX_ATTEMPTS times. Only the run that holds the claim records the
+# outcome, so a run that was given up on cannot overwrite its successor.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+EXPIRED = 'expired'
+
+MAX_ATTEMPTS = 3
+
+# kind -> (function, download file name or None)
+handlers = {}
+
+def handler(kind, filename=None):
+    """Registers f(params, out, progress) as the handler for kind.
+
+    out is the result file opened for writing when filename is set (a
+    format string over params), otherwise None. progress(fraction,
+    message=None) records how far along the job is; it writes through its
+    own connection, so handlers must not call it while their session
+    holds a write transaction."""
+    def register(f):
+        handlers[kind] = (f, filename)
+        return f
+    return register
+
+
+###############################################################################
+# Queue
+###############################################################################
+def results_dir():
+    return app.config['JOB_RESULTS_DIR']
+
+def result_path(job):
+    return os.path.join(results_dir(), '%i.out' % (job.id))
+
+def job_params(job):
+    return json.loads(job.params)
+
+def job_status(job):
+    return dict(id=job.id,
+                kind=job.kind,
+                status=job.status,
+                progress=job.progress,
+                message=job.message,
+                created_at=job.created_at.isoformat(),
+                finished_at=job.finished_at.isoformat() if job.finished_at else None,
+                expires_at=job.expires_at.isoformat() if job.expires_at else None,
+                result_name=job.result_name)
+
+def enqueue(kind, user, **params):
+    """Queues a job for user and commits it."""
+    if kind not in handlers:
+        raise KeyError(kind)
+    job = Job(kind=kind,
+              params=json.dumps(params),
+              user_id=user.id,
+              status=QUEUED,
+              progress=0.0,
+              attempts=0,
+              created_at=datetime.datetime.now())
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def _set(claimed, **values):
+    """Updates a claimed job row outside the session's transaction, unless
+    the claim has passed to another run. claimed is (job id, worker,
+    attempts) as set by claim(). Returns whether it did."""
+    (job_id, worker, attempts) = claimed
+    table = Job.__table__
+    result = db.get_engine(app).execute(table.update().
+                                        where(and_(table.c.id == job_id,
+                                                   table.c.status == RUNNING,
+                                                   table.c.worker == worker,
+                                                   table.c.attempts == attempts)).
+                                        values(**values))
+    return result.rowcount == 1
+
+
+class Heartbeat(threading.Thread):
+    """Updates a running job's heartbeat_at every interval seconds until
+    stopped, so long jobs that report no progress are not taken for dead."""
+    def __init__(self, claimed, interval):
+        threading.Thread.__init__(self, name='job-%i-heartbeat' % (claimed[0]))
+        self.daemon = True
+        self.claimed = claimed
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with app.app_context():
+                try:
+                    _set(self.claimed, heartbeat_at=datetime.datetime.now())
+                except Exception:
+                    app.logger.exception('Heartbeat for job %i failed' % (self.claimed[0]))
+
+def claim(worker):
+    """Claims the oldest queued job for worker. Returns it, or None when
+    the queue is empty."""
+    table = Job.__table__
+    while True:
+        job = Job.query.filter_by(status=QUEUED).order_by(Job.id).first()
+        if job is None:
+            db.session.rollback()
+            return None
+        now = datetime.datetime.now()
+        result = db.session.execute(table.update().
+                                    where(and_(table.c.id == job.id, table.c.status == QUEUED)).
+                                    values(status=RUNNING, worker=worker, attempts=table.c.attempts + 1,
+                                           started_at=now, heartbeat_at=now, progress=0.0))
+        db.session.commit()
+        if result.rowcount == 1:
+            db.session.refresh(job)
+            return job
+        # Another worker got it first
+
+def run(job):
+    """Runs a claimed job and records how it ended."""
+    (f, filename) = handlers.get(job.kind, (None, None))
+    params = job_params(job)
+    claimed = (job.id, job.worker, job.attempts)
+    def progress(fraction, message=None):
+        _set(claimed, progress=min(max(fraction, 0.0), 1.0), message=message,
+             heartbeat_at=datetime.datetime.now())
+    heartbeat = Heartbeat(claimed, app.config.get('JOB_HEARTBEAT_SECONDS', 30))
+    heartbeat.start()
+    try:
+        if f is None:
+            raise KeyError('No handler for %r' % (job.kind))
+        if filename is None:
+            f(params, None, progress)
+            name = None
+        else:
+            path = result_path(job)
+            # A run that was given up on may still be writing its own copy
+            part = '%s.%i.part' % (path, job.attempts)
+            with open(part, 'wb') as out:
+                f(params, out, progress)
+            os.rename(part, path)
+            name = filename % params
+    except Exception, err:
+        db.session.rollback()
+        app.logger.exception('Job %i (%s) failed' % (job.id, job.kind))
+        _set(claimed, status=FAILED, message=unicode(err)[:255], finished_at=datetime.datetime.now())
+        return False
+    finally:
+        heartbeat.stopped.set()
+    now = datetime.datetime.now()
+    ttl = datetime.timedelta(hours=app.config.get('JOB_RESULT_TTL_HOURS', 24))
+    return _set(claimed, status=DONE, progress=1.0, finished_at=now,
+                result_name=name, expires_at=(now + ttl) if name else None)
+
+def expire_results(now=None):
+    """Deletes result files past their expiry. Returns how many."""
+    if now is None:
+        now = datetime.datetime.now()
+    expired = Job.query.filter(Job.status == DONE, Job.expires_at < now).all()
+    for job in expired:
+        try:
+            os.remove(result_path(job))
+        except OSError:
+            pass
+        job.status = EXPIRED
+    db.session.commit()
+    return len(expired)
+
+def requeue_stalled(now=None):
+    """Puts back jobs whose heartbeat stopped JOB_TIMEOUT_SECONDS ago, or
+    fails them once they have been tried MAX_ATTEMPTS times."""
+    if now is None:
+        now = datetime.datetime.now()
+    table = Job.__table__
+    cutoff = now - datetime.timedelta(seconds=app.config.get('JOB_TIMEOUT_SECONDS', 300))
+    stalled = and_(table.c.status == RUNNING,
+                   func.coalesce(table.c.heartbeat_at, table.c.started_at) < cutoff)
+    db.session.execute(table.update().where(and_(stalled, table.c.attempts >= MAX_ATTEMPTS)).
+                       values(status=FAILED, message='Timed out', finished_at=now))
+    requeued = db.session.execute(table.update().where(stalled).values(status=QUEUED)).rowcount
+    db.session.commit()
+    return requeued
+
+def work(poll=1.0, housekeeping=60):
+    """The loop each worker process runs."""
+    worker = '%s:%i' % (socket.gethostname(), os.getpid())
+    try:
+        os.makedirs(results_dir())
+    except OSError:
+        if not os.path.isdir(results_dir()):
+            raise
+    last_housekeeping = 0
+    while True:
+        if time.time() - last_housekeeping > housekeeping:
+            expire_results()
+            requeue_stalled()
+            last_housekeeping = time.time()
+        job = claim(worker)
+        if job is None:
+            time.sleep(poll)
+            continue
+        run(job)
+        db.session.remove()
+
+
+###############################################################################
+# Handlers
+###############################################################################
+@handler('order_export', filename='order-%(order_id)i.csv')
+def export_order(params, out, progress):
+    """params: order_id, and client_id or salesperson_id to check against."""
+    salesperson_id = params.get('salesperson_id')
+    order = find_order(params['order_id'], client_id=params.get('client_id'),
+                       salesperson_ids=[salesperson_id] if salesperson_id else None)
+    if order is None:
+        raise LookupError('Order %i not found' % (params['order_id']))
+    writer = csv.writer(out)
+    if salesperson_id:
+        writer.writerow(('Timestamp', 'Client', 'Product Manufacturer', 'Product Name', 'Price', 'Quantity'))
+        for item in order.items:
+            writer.writerow((order.timestamp, order.sold_to.username, item.product.manufacturer,
+                             item.product.name, item.product.price, item.product.quantity))
+    else:
+        writer.writerow(('Timestamp', 'Salesperson', 'Product Manufacturer', 'Product Name', 'Price', 'Quantity'))
+        for item in order.items:
+            writer.writerow((order.timestamp, order.sold_by.username, item.product.manufacturer,
+                             item.product.name, item.product.price, item.product.quantity))
+
+@handler('commission_export', filename='commissions-%(start)s-%(end)s.csv')
+def export_commissions(params, out, progress):
+    """params: employee_id, start, end (ISO dates)."""
+    # commissions imports numpy; only the workers that run this load it
+    from commissions import write_statements
+    employee = Employee.query.filter_by(employee_id=params['employee_id']).first()
+    (start, end) = [datetime.datetime.strptime(params[key], '%Y-%m-%d').date() for key in ('start', 'end')]
+    statements = CommissionStatement.query.\
+                 filter_by(period_start=start, period_end=end).\
+                 filter(CommissionStatement.employee_id.in_(employee.subtree_ids())).\
+                 order_by(CommissionStatement.total.desc()).all()
+    write_statements(statements, out)
+
+@handler('aging_export', filename='aging-%(employee_id)i.csv')
+def export_aging(params, out, progress):
+    """params: employee_id."""
+    employee = Employee.query.filter_by(employee_id=params['employee_id']).first()
+    progress(0.1, 'Computing balances')
+    report = ar_aging(employee)
+    progress(0.9, 'Writing %i rows' % (len(report['rows'])))
+    writer = csv.writer(out)
+    writer.writerow(('Salesperson', 'Client', 'Company', 'Open Orders') +
+                    tuple('%s Days' % (bucket) for bucket in AGING_BUCKETS) + ('Balance',))
+    for row in report['rows']:
+        writer.writerow((row['salesperson'], row['client'], row['company'], row['orders']) +
+                        tuple('%.2f' % (amount) for amount in row['buckets']) +
+                        ('%.2f' % (row['balance']),))
+
+@handler('cube_rebuild')
+def rebuild_cube(params, out, progress):
+    import cube
+    progress(0.0, 'Rebuilding the sales cube')
+    cells = cube.rebuild()
+    progress(1.0, '%i cells written' % (cells))
@@ -5,6 +5,9 @@ USERNAME_MIN_LEN = 3
 USERNAME_MAX_LEN = 32
 PASSWORD_MIN_LEN = 10
 
+# Feedback counters that start again from zero when a user is banned
+SINCE_BAN_COUNTS = ('given_since_ban', 'received_since_ban', 'dislikes_since_ban')
+
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -14,6 +17,14 @@ class User(db.Model):
     active = db.Column(db.Boolean, nullable=False)
     banned = db.Column(db.Boolean, default=False)
     last_banning = db.Column(db.DateTime)
+    # Rolling feedback window, kept by feedback.py: the last WINDOW_SIZE
+    # ratings given and received as bits (bit 0 the newest, 1 a like) and
+    # counts since the last banning
+    given_window = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    given_since_ban = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    received_window = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    received_since_ban = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    dislikes_since_ban = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     _authenticated = False 
 
@@ -28,6 +39,8 @@ class User(db.Model):
     def ban(self):
         self.banned = True
         self.last_banning = datetime.datetime.now()
+        for name in SINCE_BAN_COUNTS:
+            setattr(self, name, 0)
         db.session.commit()
     def unban(self):
         self.banned = False 
@@ -56,18 +69,6 @@ class User(db.Model):
     @property
     def dislikes(self):
         return [fb for fb in self.feedback_received if not fb.is_positive]
-    @property
-    def feedback_left_since_banning(self):
-        if self.last_banning is None:
-            return Feedback.query.filter_by(from_user=self.id).limit(9).all()
-        return Feedback.query.\
-               filter(Feedback.from_user==self.id, Feedback.timestamp>self.last_banning).limit(9).all()
-    @property
-    def feedback_received_since_banning(self):
-        if self.last_banning is None:
-            return Feedback.query.filter_by(to_user=self.id).all()
-        return Feedback.query.\
-               filter(Feedback.to_user==self.id, Feedback.timestamp>self.last_banning).all()
 
     
     def __repr__(self):
@@ -87,7 +88,8 @@ class Client(User):
         return '<Client id: %i, username: %r>' % (self.id, self.username)
 
 # XXX Should these be in the DB instead?
-DEFAULT_DIRECTOR_COMMISSION     = 0.05
+# Commission is a percentage, as entered on the employee forms
+DEFAULT_DIRECTOR_COMMISSION     = 5.0
 DEFAULT_DIRECTOR_MAX_DISCOUNT   = 0.20
 
 class Employee(User):
@@ -118,6 +120,20 @@ class Employee(User):
         for r in reports:
             reports.extend(r.all_reports)
         return reports
+    def subtree_ids(self):
+        """Returns the employee_ids of this employee and everyone below
+        them, using one query per level of the management hierarchy."""
+        ids = [self.employee_id]
+        seen = set(ids)
+        frontier = ids
+        while frontier:
+            frontier = [employee_id for (employee_id,) in
+                        db.session.query(Employee.employee_id).
+                        filter(Employee.managed_by.in_(frontier))
+                        if employee_id not in seen]
+            seen.update(frontier)
+            ids.extend(frontier)
+        return ids
 
 
     def __repr__(self):
@@ -130,28 +146,46 @@ class Product(db.Model):
     price = db.Column(db.Float, nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     active = db.Column(db.Boolean, nullable=False)
+    # Units held by unexpired reservations, maintained by reservations.py
+    reserved = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Replenishment settings, see replenishment.py. No reorder point means
+    # the product is never reordered automatically.
+    reorder_point = db.Column(db.Integer, nullable=True)
+    reorder_quantity = db.Column(db.Integer, nullable=True)
+    lead_time_days = db.Column(db.Integer, nullable=True)
 
+    @property
+    def available(self):
+        """Available to promise: on hand minus active holds."""
+        return self.quantity - (self.reserved or 0)
     @property
     def promo_price(self):
-        promo = Promotion.query.filter_by(product_id=self.id).first()
-        if promo is None:
-            return self.price
-        return promo.discount
+        from pricing import current_price
+        return current_price(self.id, self.price)
     @property
     def description(self):
         return '%s - %s' % (self.manufacturer, self.name)
 
+    # Catalog imports upsert by manufacturer and name
+    __table_args__ = (
+        db.Index('ix_product_catalog', 'manufacturer', 'name'),
+    )
+
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    timestamp = db.Column(db.DateTime, nullable=False)
-    client = db.Column(db.Integer, db.ForeignKey('client.client_id'), nullable=False)
-    salesperson = db.Column(db.Integer, db.ForeignKey('employee.employee_id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    client = db.Column(db.Integer, db.ForeignKey('client.client_id'), nullable=False, index=True)
+    salesperson = db.Column(db.Integer, db.ForeignKey('employee.employee_id'), nullable=False, index=True)
     commission = db.Column(db.Float, nullable=False)
 
     sold_by = db.relationship('Employee', backref=db.backref('orders', lazy='dynamic'))
     sold_to = db.relationship('Client', backref=db.backref('orders', lazy='dynamic'))
 
+    # Ids are never reused, so an order placed after the newest ones were
+    # archived cannot take an id the archive already holds
+    __table_args__ = {'sqlite_autoincrement': True}
+
     @property
     def total(self):
         return sum([item.price * item.quantity for item in self.items])
@@ -168,20 +202,129 @@ class OrderItem(db.Model):
     order = db.relationship('Order', backref=db.backref('items', lazy='dynamic'))
     product = db.relationship('Product')
 
+# Orders moved out of the hot tables by archive.py. They live in the
+# attached archive database, keep their ids, and have no foreign keys into
+# the main database since SQLite cannot enforce those across files.
+class ArchivedOrder(db.Model):
+    __tablename__ = 'order'
+    __table_args__ = {'schema': 'archive'}
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timestamp = db.Column(db.DateTime, nullable=False, index=True)
+    client = db.Column(db.Integer, nullable=False, index=True)
+    salesperson = db.Column(db.Integer, nullable=False, index=True)
+    commission = db.Column(db.Float, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    sold_by = db.relationship('Employee', primaryjoin='foreign(ArchivedOrder.salesperson) == Employee.employee_id')
+    sold_to = db.relationship('Client', primaryjoin='foreign(ArchivedOrder.client) == Client.client_id')
+
+    total = Order.total
+    balance = Order.balance
+
+class ArchivedOrderItem(db.Model):
+    __tablename__ = 'order_item'
+    __table_args__ = {'schema': 'archive'}
+    order_id = db.Column(db.Integer, db.ForeignKey('archive.order.id'), primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    price = db.Column(db.Float, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    order = db.relationship('ArchivedOrder', backref=db.backref('items', lazy='dynamic'))
+    product = db.relationship('Product', primaryjoin='foreign(ArchivedOrderItem.product_id) == Product.id')
+
+class ArchivedPayment(db.Model):
+    __tablename__ = 'payment'
+    __table_args__ = {'schema': 'archive'}
+    order_id = db.Column(db.Integer, db.ForeignKey('archive.order.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, primary_key=True)
+    amount = db.Column(db.Float, nullable=False)
+    order = db.relationship('ArchivedOrder', backref=db.backref('payments', lazy='dynamic'))
+
+class Reservation(db.Model):
+    """A time-limited hold on product stock for a client's cart."""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.client_id'), nullable=False)
+    salesperson_id = db.Column(db.Integer, db.ForeignKey('employee.employee_id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    discount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    product = db.relationship('Product')
+
+    __table_args__ = (
+        db.Index('ix_reservation_cart', 'salesperson_id', 'client_id'),
+    )
+
+class PurchaseOrder(db.Model):
+    """A batch of replenishment requests sent to the warehouse."""
+    __tablename__ = 'purchase_order'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+
+class ReplenishmentRequest(db.Model):
+    """A low-stock product waiting to be restocked. A product has at most
+    one request that is 'pending' (not yet sent) or 'ordered' (sent in a
+    purchase order) at a time; it becomes 'received' once stock is raised
+    above the reorder point."""
+    __tablename__ = 'replenishment_request'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.Enum('pending', 'ordered', 'received'), nullable=False)
+    requested_at = db.Column(db.DateTime, nullable=False)
+    expected_at = db.Column(db.DateTime, nullable=True)
+    purchase_order_id = db.Column(db.Integer, db.ForeignKey('purchase_order.id'), nullable=True)
+
+    product = db.relationship('Product')
+    purchase_order = db.relationship('PurchaseOrder', backref=db.backref('requests'))
+
+    __table_args__ = (
+        db.Index('ix_replenishment_status', 'status', 'product_id'),
+    )
+
 class Promotion(db.Model):
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
-    discount = db.Column(db.Float, nullable=False, unique=True)
+    """A promotional price for one product, or a percentage off every
+    product of a manufacturer, optionally limited to a time window."""
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=True, index=True)
+    manufacturer = db.Column(db.String(64), nullable=True, index=True)
+    discount = db.Column(db.Float, nullable=True)       # Promotional price
+    percent_off = db.Column(db.Float, nullable=True)
+    starts_at = db.Column(db.DateTime, nullable=True)   # None: already running
+    ends_at = db.Column(db.DateTime, nullable=True)     # None: until deleted
     product = db.relationship('Product')
 
+    def price_for(self, list_price):
+        if self.discount is not None:
+            return min(self.discount, list_price)
+        return round(list_price * (100 - self.percent_off) / 100.0, 2)
+    def is_running(self, at):
+        return ((self.starts_at is None or self.starts_at <= at) and
+                (self.ends_at is None or self.ends_at > at))
+    @property
+    def scope(self):
+        if self.product_id is not None:
+            return self.product.description
+        return '%s (all products)' % (self.manufacturer)
+
 class Feedback(db.Model):
-    from_user = db.Column(db.String(USERNAME_MAX_LEN), nullable=False, primary_key=True)
-    to_user = db.Column(db.String(USERNAME_MAX_LEN), nullable=False, primary_key=True)
-    timestamp = db.Column(db.DateTime, nullable=False, primary_key=True)
+    """A like or dislike from one user to another. Converted from string
+    user keys by db_repository migration 003."""
+    __table_args__ = (
+        # Feedback received and feedback left, in time order
+        db.Index('ix_feedback_to_user_timestamp', 'to_user', 'timestamp'),
+        db.Index('ix_feedback_from_user_timestamp', 'from_user', 'timestamp'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    from_user = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    to_user = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
     is_positive = db.Column(db.Boolean, nullable=False)
 
-    @property
-    def left_by(self):
-        return User.query.filter_by(id=self.from_user).first()
+    left_by = db.relationship('User', foreign_keys=[from_user])
 
 class Payment(db.Model):
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
@@ -189,3 +332,123 @@ class Payment(db.Model):
     amount = db.Column(db.Float, nullable=False)
     order = db.relationship('Order', backref=db.backref('payments', lazy='dynamic'))
 
+
+class SalesCube(db.Model):
+    """Order lines pre-aggregated by time bucket, product, salesperson and
+    client. Kept up to date by add_order and rebuilt with
+    `manage.py rebuild-cube`."""
+    __tablename__ = 'sales_cube'
+    grain = db.Column(db.Enum('day', 'week', 'month'), primary_key=True)
+    period = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    salesperson_id = db.Column(db.Integer, db.ForeignKey('employee.employee_id'), primary_key=True)
+    client_id = db.Column(db.Integer, db.ForeignKey('client.client_id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    lines = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_sales_cube_product', 'grain', 'product_id', 'period'),
+        db.Index('ix_sales_cube_salesperson', 'grain', 'salesperson_id', 'period'),
+        db.Index('ix_sales_cube_client', 'grain', 'client_id', 'period'),
+    )
+
+class CommissionStatement(db.Model):
+    """Commission owed to one employee for one payout period. own_sales
+    are the employee's own orders; team_sales are the orders of everyone
+    below them in the hierarchy, on which managers and directors earn an
+    override at their own commission rate."""
+    __tablename__ = 'commission_statement'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    period_start = db.Column(db.Date, nullable=False)
+    period_end = db.Column(db.Date, nullable=False)
+    employee_id = db.Column(db.Integer, db.ForeignKey('employee.employee_id'), nullable=False)
+    commission_rate = db.Column(db.Float, nullable=False)
+    own_sales = db.Column(db.Float, nullable=False)
+    own_commission = db.Column(db.Float, nullable=False)
+    team_sales = db.Column(db.Float, nullable=False)
+    override_commission = db.Column(db.Float, nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    employee = db.relationship('Employee')
+
+    __table_args__ = (
+        db.UniqueConstraint('period_start', 'period_end', 'employee_id'),
+    )
+
+class DataVersion(db.Model):
+    """A counter bumped whenever a class of data changes, so caches can
+    tell whether their contents are stale with a single lookup."""
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class Event(db.Model):
+    """An entry in the append-only event log, see events.py. seq is the
+    order events were committed in and is never reused."""
+    __tablename__ = 'event'
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(32), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    data = db.Column(db.Text, nullable=False)       # JSON
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class EventCheckpoint(db.Model):
+    """How far into the event log a projection has been brought."""
+    __tablename__ = 'event_checkpoint'
+    consumer = db.Column(db.String(64), primary_key=True)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class ProductPopularity(db.Model):
+    """Units sold per product overall (scope 'all', scope_id 0), per client
+    and per salesperson. Maintained from the event log by popularity.py."""
+    __tablename__ = 'product_popularity'
+    scope = db.Column(db.Enum('all', 'client', 'salesperson'), primary_key=True)
+    scope_id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_product_popularity_rank', 'scope', 'scope_id', 'quantity'),
+    )
+
+class Change(db.Model):
+    """An insert, update or delete of an order, payment, product or
+    client row, written by the triggers in changes.py. seq is the order
+    the changes were committed in. Payments are identified by order_id."""
+    __tablename__ = 'change'
+    seq = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    entity = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.Enum('insert', 'update', 'delete'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = {'sqlite_autoincrement': True}
+
+class Job(db.Model):
+    """A unit of background work run by 'manage.py worker', see jobs.py.
+    Jobs that produce a file keep it in JOB_RESULTS_DIR until expires_at."""
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False)     # JSON
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    status = db.Column(db.Enum('queued', 'running', 'done', 'failed', 'expired'), nullable=False)
+    progress = db.Column(db.Float, nullable=False, default=0.0)
+    message = db.Column(db.String(255), nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String(64), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)     # Last sign of life from the worker
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True)
+    result_name = db.Column(db.String(128), nullable=True)     # Download file name
+
+    __table_args__ = (
+        db.Index('ix_job_status', 'status', 'id'),
+    )
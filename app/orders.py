@@ -0,0 +1,92 @@
+import datetime
+from collections import defaultdict, OrderedDict
+
+from app import db
+
+from .cache import bump_version, user_version
+from .cube import record_order_lines
+from .models import Order, OrderItem
+
+from events import ORDER_PLACED, record_event
+from replenishment import check_low_stock
+from reservations import take_reserved_stock, take_stock
+
+
+def place_order(salesperson, client, lines=(), reservations=()):
+    """Places an order for client and commits it.
+
+    lines is a list of (product, quantity, discount) taken from on-hand
+    stock; reservations are cart holds converted into order lines. The
+    discount is a percentage. Returns (order, errors), where errors maps a
+    field name to a list of messages in the form flash_errors expects. On
+    any error nothing is committed and order is None."""
+    errors = defaultdict(list)
+    items = OrderedDict()
+    try:
+        order = Order(timestamp=datetime.datetime.now(),
+                      client=client.client_id,
+                      salesperson=salesperson.employee_id,
+                      commission=0.0)
+        db.session.add(order)
+        db.session.flush()
+
+        # Update inventory
+        for (product, quantity, discount) in lines:
+            if quantity == 0:
+                continue
+            if quantity < 0:
+                errors[product.description].append('Invalid Quantity')
+                break
+            if discount > salesperson.max_discount:
+                errors['Discount'].append('Discount cannot exceed %.2f%%' % (salesperson.max_discount))
+                break
+            if product.id in items:
+                errors[product.description].append('Product listed twice')
+                break
+            if not product.active or not take_stock(product.id, quantity):
+                errors[product.description].append('Insufficent Inventory')
+                break
+            items[product.id] = (product, quantity, discount)
+        if not errors:
+            for reservation in reservations:
+                product = reservation.product
+                if product.id in items:
+                    errors[product.description].append('Product listed twice')
+                    break
+                if not take_reserved_stock(reservation):
+                    errors[product.description].append('Reservation has expired')
+                    break
+                items[product.id] = (product, reservation.quantity, reservation.discount)
+
+        # Make sure we don't submit an empty order
+        if not errors and not items:
+            errors['Quantity'].append('At least one item must be selected')
+        if errors:
+            db.session.rollback()
+            return None, errors
+
+        # Add order items
+        cube_lines = []
+        for (product, quantity, discount) in items.values():
+            price = product.promo_price * ((100 - discount)/100.0)
+            db.session.add(OrderItem(order_id=order.id,
+                                     product_id=product.id,
+                                     price=price,
+                                     quantity=quantity))
+            # Employee.commission is a percentage of the discounted line total
+            order.commission += (salesperson.commission/100.0) * price * quantity
+            cube_lines.append((product.id, price, quantity))
+        record_order_lines(order, cube_lines)
+        record_event(ORDER_PLACED, order_id=order.id, client_id=client.client_id,
+                     salesperson_id=salesperson.employee_id,
+                     lines=[list(line) for line in cube_lines])
+        check_low_stock(items.keys())
+        bump_version('orders', 'stock',
+                     user_version('orders', client.user_id),
+                     user_version('orders', salesperson.user_id))
+        db.session.commit()
+    except (Exception), err:
+        db.session.rollback()
+        errors['Database'].append(err)
+        return None, errors
+    return order, errors
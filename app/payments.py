@@ -0,0 +1,183 @@
+import csv
+import datetime
+
+from sqlalchemy import func
+
+from app import db
+
+from .cache import bump_version
+from .models import Employee, Order, OrderItem, Payment
+
+from events import PAYMENT_APPLIED, record_events
+from helpers import chunked
+
+# Remittance line outcomes
+APPLIED = 'applied'     # Payment recorded and the order is now paid in full
+PARTIAL = 'partial'     # Payment recorded but a balance remains
+REJECTED = 'rejected'   # Nothing recorded for this line
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+# Balances are floats, so anything below half a cent counts as paid
+CENT = 0.005
+
+
+class RemittanceLine(object):
+    """One (order_id, amount, timestamp) row from a remittance file and
+    the outcome of applying it."""
+    def __init__(self, line_no, order_id=None, amount=None, timestamp=None):
+        self.line_no = line_no
+        self.order_id = order_id
+        self.amount = amount
+        self.timestamp = timestamp
+        self.status = None
+        self.message = ''
+        self.balance = None
+
+    def reject(self, message):
+        self.status = REJECTED
+        self.message = message
+
+
+def parse_timestamp(value):
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp %r' % (value))
+
+def parse_remittance(fileobj, now=None):
+    """Reads a CSV of order_id,amount[,timestamp] rows. A header row is
+    skipped if present. Lines that cannot be parsed are returned already
+    rejected so they still show up in the reconciliation report."""
+    if now is None:
+        now = datetime.datetime.now()
+    lines = []
+    for line_no, row in enumerate(csv.reader(fileobj), 1):
+        row = [cell.strip() for cell in row]
+        if not any(row):
+            continue
+        if line_no == 1 and not row[0].isdigit():
+            continue
+        line = RemittanceLine(line_no)
+        lines.append(line)
+        if len(row) < 2:
+            line.reject('Expected order_id,amount[,timestamp]')
+            continue
+        try:
+            line.order_id = int(row[0])
+        except ValueError:
+            line.reject('Invalid order id %r' % (row[0]))
+            continue
+        try:
+            line.amount = round(float(row[1]), 2)
+        except ValueError:
+            line.reject('Invalid amount %r' % (row[1]))
+            continue
+        if line.amount < 0.01:
+            line.reject('Amount must be at least $0.01')
+            continue
+        if len(row) > 2 and row[2]:
+            try:
+                line.timestamp = parse_timestamp(row[2])
+            except ValueError, err:
+                line.reject(str(err))
+                continue
+        else:
+            # Payment timestamps are part of the primary key, so undated
+            # lines get distinct timestamps
+            line.timestamp = now + datetime.timedelta(microseconds=line_no)
+    return lines
+
+def outstanding_balances(manager, order_ids):
+    """Returns {order_id: balance} for the given orders that were sold by
+    one of the manager's direct reports. Orders the manager does not own
+    are left out. Uses grouped queries instead of Order.balance."""
+    owned = set()
+    totals = {}
+    paid = {}
+    for chunk in chunked(sorted(order_ids), 500):
+        owned.update(order_id for (order_id,) in
+                     db.session.query(Order.id).
+                     join(Employee, Order.salesperson == Employee.employee_id).
+                     filter(Order.id.in_(chunk),
+                            Employee.managed_by == manager.employee_id))
+        totals.update(db.session.query(OrderItem.order_id,
+                                       func.sum(OrderItem.price * OrderItem.quantity)).
+                      filter(OrderItem.order_id.in_(chunk)).
+                      group_by(OrderItem.order_id))
+        paid.update(db.session.query(Payment.order_id, func.sum(Payment.amount)).
+                    filter(Payment.order_id.in_(chunk)).
+                    group_by(Payment.order_id))
+    return dict((order_id, round((totals.get(order_id) or 0.0) - (paid.get(order_id) or 0.0), 2))
+                for order_id in owned)
+
+def existing_payment_keys(order_ids):
+    keys = set()
+    for chunk in chunked(sorted(order_ids), 500):
+        keys.update(db.session.query(Payment.order_id, Payment.timestamp).
+                    filter(Payment.order_id.in_(chunk)))
+    return keys
+
+def apply_remittance(manager, lines):
+    """Validates every parsed line against the manager's orders and
+    records all accepted payments in a single transaction. Lines are
+    applied in file order, so several lines for one order draw down the
+    same running balance. Returns the lines with their outcomes."""
+    pending = [line for line in lines if line.status is None]
+    order_ids = set(line.order_id for line in pending)
+    balances = outstanding_balances(manager, order_ids)
+    seen = existing_payment_keys(balances.keys())
+
+    rows = []
+    for line in pending:
+        balance = balances.get(line.order_id)
+        if balance is None:
+            line.reject('Unknown order')
+        elif balance < CENT:
+            line.reject('Order has a zero balance')
+        elif line.amount > balance + CENT:
+            line.reject('Payment amount exceeds outstanding balance of $%.2f' % (balance))
+        elif (line.order_id, line.timestamp) in seen:
+            line.reject('Duplicate payment for this order and timestamp')
+        else:
+            balance = round(balance - line.amount, 2)
+            balances[line.order_id] = balance
+            seen.add((line.order_id, line.timestamp))
+            line.balance = balance
+            line.status = APPLIED if balance < CENT else PARTIAL
+            rows.append(dict(order_id=line.order_id,
+                             timestamp=line.timestamp,
+                             amount=line.amount))
+
+    if rows:
+        try:
+            db.session.execute(Payment.__table__.insert(), rows)
+            record_events(PAYMENT_APPLIED, [dict(order_id=row['order_id'], amount=row['amount'])
+                                            for row in rows])
+            bump_version('payments')
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return lines
+
+def reconciliation_summary(lines):
+    """Counts and totals per outcome for the report header."""
+    summary = dict((status, {'count': 0, 'amount': 0.0})
+                   for status in (APPLIED, PARTIAL, REJECTED))
+    for line in lines:
+        summary[line.status]['count'] += 1
+        summary[line.status]['amount'] += line.amount or 0.0
+    return summary
+
+def write_reconciliation(lines, fileobj):
+    writer = csv.writer(fileobj)
+    writer.writerow(('Line', 'Order', 'Amount', 'Timestamp', 'Status', 'Remaining Balance', 'Message'))
+    for line in lines:
+        writer.writerow((line.line_no, line.order_id,
+                         '' if line.amount is None else '%.2f' % (line.amount),
+                         line.timestamp or '', line.status,
+                         '' if line.balance is None else '%.2f' % (line.balance),
+                         line.message))
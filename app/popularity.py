@@ -0,0 +1,61 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, bindparam
+
+from app import db
+
+from .models import Product, ProductPopularity
+
+from events import ORDER_PLACED, Projection, register
+
+SCOPE_ALL = 'all'
+SCOPE_CLIENT = 'client'
+SCOPE_SALESPERSON = 'salesperson'
+
+
+class PopularityProjection(Projection):
+    """Units sold per product overall, per client and per salesperson,
+    kept in ProductPopularity from order_placed events."""
+    name = 'popularity'
+    kinds = (ORDER_PLACED,)
+    version_name = 'popularity'
+
+    def apply(self, events):
+        added = defaultdict(int)
+        for (_seq, _kind, _timestamp, data) in events:
+            for (product_id, _price, quantity) in data['lines']:
+                added[(SCOPE_ALL, 0, product_id)] += quantity
+                added[(SCOPE_CLIENT, data['client_id'], product_id)] += quantity
+                added[(SCOPE_SALESPERSON, data['salesperson_id'], product_id)] += quantity
+        rows = [dict(scope=scope, scope_id=scope_id, product_id=product_id, quantity=quantity)
+                for ((scope, scope_id, product_id), quantity) in added.iteritems()]
+        if not rows:
+            return
+        table = ProductPopularity.__table__
+        # Create the missing rows at zero, then add to every row
+        db.session.execute(table.insert().prefix_with('OR IGNORE'),
+                           [dict(row, quantity=0) for row in rows])
+        db.session.execute(table.update().
+                           where(and_(table.c.scope == bindparam('b_scope'),
+                                      table.c.scope_id == bindparam('b_scope_id'),
+                                      table.c.product_id == bindparam('b_product_id'))).
+                           values(quantity=table.c.quantity + bindparam('b_quantity')),
+                           [dict(b_scope=row['scope'], b_scope_id=row['scope_id'],
+                                 b_product_id=row['product_id'], b_quantity=row['quantity'])
+                            for row in rows])
+
+    def reset(self):
+        db.session.execute(ProductPopularity.__table__.delete())
+
+popularity = register(PopularityProjection())
+
+
+def popular_products(scope, scope_id=0, limit=3):
+    """The limit best selling active products within a scope, best first."""
+    return Product.query.\
+           join(ProductPopularity, ProductPopularity.product_id == Product.id).\
+           filter(ProductPopularity.scope == scope,
+                  ProductPopularity.scope_id == scope_id,
+                  Product.active == True).\
+           order_by(ProductPopularity.quantity.desc(), Product.id).\
+           limit(limit).all()
@@ -0,0 +1,100 @@
+import datetime
+import threading
+
+from flask import g, has_request_context
+from sqlalchemy import or_
+
+from app import db
+
+from .cache import data_versions
+from .models import Product, Promotion
+
+from helpers import chunked
+
+
+class PriceIndex(object):
+    """Maps product ids to their current promotional price.
+
+    The index is compiled from every running promotion at once and then
+    answers lookups from a dict. It is recompiled only when the next
+    promotion starts or ends, or when promotions or products have been
+    edited (seen through data_version, checked at most once per
+    request). Products without a running promotion are not in the index
+    and sell at list price."""
+    def __init__(self):
+        self._prices = {}
+        self._version = None
+        self._valid_until = None
+        self._lock = threading.Lock()
+
+    def compile(self, now=None):
+        """Returns ({product_id: price}, time of the next window boundary
+        or None)."""
+        if now is None:
+            now = datetime.datetime.now()
+        running = Promotion.query.\
+                  filter(or_(Promotion.starts_at == None, Promotion.starts_at <= now)).\
+                  filter(or_(Promotion.ends_at == None, Promotion.ends_at > now)).all()
+
+        product_promotions = [p for p in running if p.product_id is not None]
+        by_manufacturer = {}
+        for promotion in running:
+            if promotion.product_id is None:
+                by_manufacturer.setdefault(promotion.manufacturer, []).append(promotion)
+
+        list_prices = {}
+        for chunk in chunked(set(p.product_id for p in product_promotions), 500):
+            list_prices.update(db.session.query(Product.id, Product.price).
+                               filter(Product.id.in_(chunk)))
+        prices = {}
+        def offer(product_id, price):
+            if product_id not in prices or price < prices[product_id]:
+                prices[product_id] = price
+        for promotion in product_promotions:
+            if promotion.product_id in list_prices:
+                offer(promotion.product_id, promotion.price_for(list_prices[promotion.product_id]))
+        for chunk in chunked(by_manufacturer.keys(), 500):
+            for (product_id, manufacturer, price) in \
+                    db.session.query(Product.id, Product.manufacturer, Product.price).\
+                    filter(Product.manufacturer.in_(chunk)):
+                for promotion in by_manufacturer[manufacturer]:
+                    offer(product_id, promotion.price_for(price))
+
+        upcoming = db.session.query(db.func.min(Promotion.starts_at)).\
+                   filter(Promotion.starts_at > now).scalar()
+        ending = [p.ends_at for p in running if p.ends_at is not None]
+        boundaries = [t for t in [upcoming] + ending if t is not None]
+        return prices, (min(boundaries) if boundaries else None)
+
+    def _stale(self, now):
+        if self._valid_until is not None and now >= self._valid_until:
+            return True
+        if has_request_context():
+            if getattr(g, 'price_index_checked', False):
+                return False
+            g.price_index_checked = True
+        return data_versions('promotions', 'products') != self._version
+
+    def refresh(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        if self._stale(now):
+            with self._lock:
+                version = data_versions('promotions', 'products')
+                (self._prices, self._valid_until) = self.compile(now)
+                self._version = version
+
+    def price(self, product_id, list_price):
+        self.refresh()
+        return self._prices.get(product_id, list_price)
+
+    def valid_until(self):
+        """When the current prices next change on their own, as a
+        promotion starts or ends. None if no such change is scheduled."""
+        self.refresh()
+        return self._valid_until
+
+price_index = PriceIndex()
+
+def current_price(product_id, list_price):
+    return price_index.price(product_id, list_price)
@@ -0,0 +1,100 @@
+import datetime
+
+from sqlalchemy import DateTime, and_, func, literal, or_, select
+
+from app import db
+
+from .cache import bump_version
+from .models import Product, Promotion
+
+from events import BULK_PROMOTION, record_event
+from helpers import chunked
+
+
+def product_criteria(manufacturer=None, min_price=None, max_price=None, product_ids=None):
+    """Returns a list of WHERE clauses, one per chunk of product ids, that
+    select the active products matching every given filter."""
+    product = Product.__table__
+    clause = product.c.active == True
+    if manufacturer:
+        clause = and_(clause, product.c.manufacturer == manufacturer)
+    if min_price is not None:
+        clause = and_(clause, product.c.price >= min_price)
+    if max_price is not None:
+        clause = and_(clause, product.c.price <= max_price)
+    if not product_ids:
+        return [clause]
+    return [and_(clause, product.c.id.in_(chunk)) for chunk in chunked(sorted(product_ids), 500)]
+
+def overlaps(starts_at, ends_at):
+    """Matches product promotions whose window overlaps [starts_at, ends_at)."""
+    promotion = Promotion.__table__
+    conditions = []
+    if ends_at is not None:
+        conditions.append(or_(promotion.c.starts_at == None, promotion.c.starts_at < ends_at))
+    if starts_at is not None:
+        conditions.append(or_(promotion.c.ends_at == None, promotion.c.ends_at > starts_at))
+    return and_(*conditions) if conditions else None
+
+def _delete_promotions(criteria, window=None):
+    product = Product.__table__
+    promotion = Promotion.__table__
+    deleted = 0
+    for clause in criteria:
+        where = promotion.c.product_id.in_(select([product.c.id]).where(clause))
+        if window is not None:
+            where = and_(where, window)
+        deleted += db.session.execute(promotion.delete().where(where)).rowcount
+    return deleted
+
+def apply_bulk_promotion(criteria, percent_off, starts_at=None, ends_at=None):
+    """Gives every matching product a promotional price of percent_off
+    below list price with set-based statements in one transaction.
+    Product promotions overlapping the new window are replaced. Returns
+    the number of products promoted."""
+    product = Product.__table__
+    promotion = Promotion.__table__
+    factor = (100 - percent_off) / 100.0
+    promoted = 0
+    try:
+        _delete_promotions(criteria, overlaps(starts_at, ends_at))
+        for clause in criteria:
+            rows = select([product.c.id,
+                           func.round(product.c.price * factor, 2),
+                           literal(starts_at, type_=DateTime),
+                           literal(ends_at, type_=DateTime)]).where(clause)
+            promoted += db.session.execute(
+                promotion.insert().from_select(['product_id', 'discount', 'starts_at', 'ends_at'],
+                                               rows)).rowcount
+        record_event(BULK_PROMOTION, action='apply', count=promoted, percent_off=percent_off,
+                     starts_at=starts_at, ends_at=ends_at)
+        bump_version('promotions')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return promoted
+
+def clear_bulk_promotion(criteria):
+    """Deletes every product promotion of the matching products in one
+    transaction. Returns the number of promotions deleted."""
+    try:
+        deleted = _delete_promotions(criteria)
+        record_event(BULK_PROMOTION, action='clear', count=deleted)
+        bump_version('promotions')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return deleted
+
+def unpromoted_products(now=None):
+    """Active products with no current or scheduled product promotion,
+    found with an anti-join rather than list membership tests."""
+    if now is None:
+        now = datetime.datetime.now()
+    return Product.query.\
+           outerjoin(Promotion, and_(Promotion.product_id == Product.id,
+                                     or_(Promotion.ends_at == None, Promotion.ends_at > now))).\
+           filter(Product.active == True, Promotion.id == None).\
+           order_by(Product.manufacturer, Product.name).all()
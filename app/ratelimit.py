@@ -0,0 +1,169 @@
+import anydbm
+import fcntl
+import threading
+import time
+from collections import defaultdict
+
+from flask import jsonify, make_response, request, session
+
+from app import app
+
+# Token buckets for the endpoints that are expensive to serve: logins run
+# bcrypt even for unknown users, and likes and dislikes write to the
+# database on a plain GET. RATE_LIMITS maps an endpoint to (burst, refill
+# per minute, methods), where methods lists the HTTP methods that are
+# charged, or is None for all of them; each client IP and each logged in
+# user gets a bucket of its own per endpoint, and a request that finds
+# either bucket empty gets 429.
+#
+# limit_requests() runs first among the before_request hooks and only
+# looks at the request and the session cookie, so a rejected request costs
+# no database or bcrypt work. Buckets live in each process, or in
+# RATE_LIMIT_FILE when set, so that every worker draws on the same ones.
+
+# In-process buckets kept before idle ones are dropped
+MAX_BUCKETS = 10000
+
+
+class TokenBucket(object):
+    """burst tokens, refilled at rate per second, charged for requests
+    with one of methods (all when None). state is (tokens, updated) or
+    None for a bucket that was never used."""
+    def __init__(self, burst, rate, methods=None):
+        self.burst = burst
+        self.rate = rate
+        self.methods = methods
+
+    def applies(self, method):
+        return self.methods is None or method in self.methods
+
+    def take(self, state, now):
+        """Returns (allowed, new state, seconds until the next token)."""
+        if state is None:
+            tokens = float(self.burst)
+        else:
+            (tokens, updated) = state
+            tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return True, (tokens - 1, now), 0
+        return False, (tokens, now), (1 - tokens) / self.rate
+
+
+class MemoryBuckets(object):
+    """Bucket states for this process."""
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def take(self, keys, bucket, now):
+        with self._lock:
+            if len(self._states) > MAX_BUCKETS:
+                self._prune(now)
+            return _take_all(self._states, keys, bucket, now)
+
+    def _prune(self, now):
+        # A bucket idle for an hour has refilled under any sensible limit
+        for (key, (_tokens, updated)) in self._states.items():
+            if now - updated > 3600:
+                del self._states[key]
+
+
+class FileBuckets(object):
+    """Bucket states shared by every process through a dbm file, with
+    access serialised by an exclusive lock on a side file."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def take(self, keys, bucket, now):
+        with self._lock:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    states = anydbm.open(self.path, 'c')
+                    try:
+                        return _take_all(DbmStates(states), keys, bucket, now)
+                    finally:
+                        states.close()
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class DbmStates(object):
+    """The dict interface _take_all needs, over a dbm of 'tokens updated'."""
+    def __init__(self, states):
+        self.states = states
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        if not self.states.has_key(key):
+            return None
+        (tokens, updated) = self.states[key].split()
+        return (float(tokens), float(updated))
+
+    def __setitem__(self, key, state):
+        self.states[key.encode('utf-8')] = '%r %r' % state
+
+
+def _take_all(states, keys, bucket, now):
+    """Takes a token from every key's bucket, or from none of them when one
+    is empty. Returns (allowed, seconds until a retry could succeed)."""
+    results = [(key,) + bucket.take(states.get(key), now) for key in keys]
+    waits = [wait for (_key, allowed, _state, wait) in results if not allowed]
+    if waits:
+        return False, max(waits)
+    for (key, _allowed, state, _wait) in results:
+        states[key] = state
+    return True, 0
+
+
+class RateLimiter(object):
+    """Applies the configured limits and counts what it lets through and
+    what it turns away, per endpoint."""
+    def __init__(self, limits, path=None):
+        self.buckets = dict((endpoint, TokenBucket(burst, per_minute / 60.0, methods))
+                            for (endpoint, (burst, per_minute, methods)) in limits.items())
+        self.store = FileBuckets(path) if path else MemoryBuckets()
+        self._lock = threading.Lock()
+        self.allowed = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    def check(self, endpoint, method, keys):
+        """Returns (allowed, seconds until a retry could succeed)."""
+        bucket = self.buckets.get(endpoint)
+        if bucket is None or not bucket.applies(method):
+            return True, 0
+        keys = ['%s:%s' % (endpoint, key) for key in keys]
+        (allowed, wait) = self.store.take(keys, bucket, time.time())
+        with self._lock:
+            if allowed:
+                self.allowed[endpoint] += 1
+            else:
+                self.rejected[endpoint] += 1
+        return allowed, wait
+
+    def stats(self):
+        with self._lock:
+            return dict((endpoint, dict(allowed=self.allowed[endpoint],
+                                        rejected=self.rejected[endpoint]))
+                        for endpoint in self.buckets)
+
+rate_limiter = RateLimiter(app.config.get('RATE_LIMITS') or {}, app.config.get('RATE_LIMIT_FILE'))
+
+
+def limit_requests():
+    """before_request hook. Keys on the client address and on the user id
+    Flask-Login keeps in the session, which needs no database lookup."""
+    keys = ['ip:%s' % (request.remote_addr)]
+    if session.get('user_id'):
+        keys.append('user:%s' % (session['user_id']))
+    (allowed, wait) = rate_limiter.check(request.endpoint, request.method, keys)
+    if allowed:
+        return None
+    if request.path.startswith('/api/'):
+        response = jsonify(error='Too Many Requests')
+        response.status_code = 429
+    else:
+        response = make_response('Too many requests, please slow down', 429)
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
@@ -0,0 +1,134 @@
+import csv
+import datetime
+import os
+
+from sqlalchemy import and_
+
+from app import db
+
+from .background import start_periodic
+from .models import Product, PurchaseOrder, ReplenishmentRequest
+
+from helpers import chunked
+
+OPEN_STATUSES = ('pending', 'ordered')
+
+
+def reorder_amount(quantity, reorder_point, reorder_quantity):
+    """How many units to ask for. Without an explicit reorder quantity,
+    stock is brought back up to twice the reorder point."""
+    if reorder_quantity:
+        return reorder_quantity
+    return max(2 * reorder_point - quantity, 1)
+
+def open_request_product_ids(product_ids):
+    found = set()
+    for chunk in chunked(product_ids, 500):
+        found.update(product_id for (product_id,) in
+                     db.session.query(ReplenishmentRequest.product_id).
+                     filter(ReplenishmentRequest.status.in_(OPEN_STATUSES),
+                            ReplenishmentRequest.product_id.in_(chunk)))
+    return found
+
+def check_low_stock(product_ids):
+    """Queues a replenishment request for any of the given products that
+    are now at or below their reorder point. Called with the products an
+    order just took stock from, so the catalog is never scanned. Runs in
+    the caller's transaction."""
+    product_ids = list(product_ids)
+    low = []
+    for chunk in chunked(product_ids, 500):
+        low.extend(db.session.query(Product.id, Product.quantity,
+                                    Product.reorder_point, Product.reorder_quantity).
+                   filter(Product.id.in_(chunk),
+                          Product.reorder_point != None,
+                          Product.quantity <= Product.reorder_point))
+    if not low:
+        return 0
+    already_open = open_request_product_ids([row[0] for row in low])
+    now = datetime.datetime.now()
+    rows = [dict(product_id=product_id,
+                 quantity=reorder_amount(quantity, reorder_point, reorder_quantity),
+                 status='pending',
+                 requested_at=now)
+            for (product_id, quantity, reorder_point, reorder_quantity) in low
+            if product_id not in already_open]
+    if rows:
+        db.session.execute(ReplenishmentRequest.__table__.insert(), rows)
+    return len(rows)
+
+def mark_received(product_ids):
+    """Closes open requests for products whose stock is back above the
+    reorder point. Runs in the caller's transaction."""
+    restocked = []
+    for chunk in chunked(list(product_ids), 500):
+        restocked.extend(product_id for (product_id,) in
+                         db.session.query(Product.id).
+                         filter(Product.id.in_(chunk),
+                                Product.quantity > Product.reorder_point))
+    table = ReplenishmentRequest.__table__
+    for chunk in chunked(restocked, 500):
+        db.session.execute(table.update().
+                           where(and_(table.c.product_id.in_(chunk),
+                                      table.c.status.in_(OPEN_STATUSES))).
+                           values(status='received'))
+
+def write_purchase_orders(outbox, batch_size=1000):
+    """Batches pending requests into purchase orders, one CSV file per
+    order dropped into the outbox directory for the warehouse. Files are
+    written under a temporary name and renamed once complete. Returns the
+    number of purchase orders written."""
+    if not os.path.isdir(outbox):
+        os.makedirs(outbox)
+    written = 0
+    table = ReplenishmentRequest.__table__
+    while True:
+        pending = [request_id for (request_id,) in
+                   db.session.query(ReplenishmentRequest.id).
+                   filter(ReplenishmentRequest.status == 'pending').
+                   order_by(ReplenishmentRequest.id).limit(batch_size)]
+        if not pending:
+            return written
+
+        now = datetime.datetime.now()
+        po = PurchaseOrder(created_at=now, filename='')
+        db.session.add(po)
+        db.session.flush()
+        po.filename = 'PO-%06i.csv' % (po.id)
+        path = os.path.join(outbox, po.filename)
+        try:
+            # Claim the requests so a second replenisher cannot send them too
+            db.session.execute(table.update().
+                               where(and_(table.c.id.in_(pending), table.c.status == 'pending')).
+                               values(status='ordered', purchase_order_id=po.id))
+            lines = db.session.query(ReplenishmentRequest, Product).\
+                    join(Product, Product.id == ReplenishmentRequest.product_id).\
+                    filter(ReplenishmentRequest.purchase_order_id == po.id).\
+                    order_by(Product.manufacturer, Product.name).all()
+            if not lines:
+                db.session.rollback()
+                continue
+            with open(path + '.tmp', 'wb') as fout:
+                writer = csv.writer(fout)
+                writer.writerow(('Purchase Order', 'Product ID', 'Manufacturer', 'Product Name',
+                                 'Quantity', 'Expected'))
+                for (request, product) in lines:
+                    request.expected_at = now + datetime.timedelta(days=product.lead_time_days or 0)
+                    writer.writerow((po.id, product.id, product.manufacturer, product.name,
+                                     request.quantity, request.expected_at.strftime('%Y-%m-%d')))
+            os.rename(path + '.tmp', path)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for leftover in (path + '.tmp', path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+        written += 1
+
+def replenish():
+    from app import app
+    return write_purchase_orders(app.config['PURCHASE_ORDER_OUTBOX'])
+
+def start_replenisher(app):
+    start_periodic(app, 'replenisher', app.config.get('REPLENISHMENT_INTERVAL_SECONDS'), replenish)
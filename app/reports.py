@@ -0,0 +1,123 @@
+import datetime
+
+from sqlalchemy import and_, case, func
+
+from app import db
+
+from .cache import VersionedCache, data_versions
+from .models import Client, Employee, Order, OrderItem, Payment
+
+from helpers import chunked
+
+# Balances are floats, so anything below half a cent counts as paid
+CENT = 0.005
+
+
+###############################################################################
+# Accounts receivable aging
+###############################################################################
+AGING_BUCKETS = ('0-30', '31-60', '61-90', '90+')
+
+_aging_cache = VersionedCache()
+
+def employee_names(employee_ids):
+    names = {}
+    for chunk in chunked(employee_ids, 500):
+        names.update(db.session.query(Employee.employee_id, Employee.username).
+                     filter(Employee.employee_id.in_(chunk)))
+    return names
+
+def client_names(client_ids):
+    names = {}
+    for chunk in chunked(client_ids, 500):
+        names.update((client_id, (username, company)) for (client_id, username, company) in
+                     db.session.query(Client.client_id, Client.username, Client.company).
+                     filter(Client.client_id.in_(chunk)))
+    return names
+
+def ar_aging(employee, as_of=None):
+    """Buckets the unpaid balances of every order sold in the employee's
+    subtree by order age. Balances are computed with grouped queries over
+    OrderItem and Payment rather than Order.balance. Returns a dict with
+    one row per (salesperson, client), subtotals per salesperson and a
+    grand total; every row has a 'buckets' list in AGING_BUCKETS order."""
+    if as_of is None:
+        as_of = datetime.datetime.now()
+    salesperson_ids = employee.subtree_ids()
+
+    totals = db.session.query(OrderItem.order_id.label('order_id'),
+                              func.sum(OrderItem.price * OrderItem.quantity).label('total')).\
+             join(Order, Order.id == OrderItem.order_id).\
+             filter(Order.salesperson.in_(salesperson_ids)).\
+             group_by(OrderItem.order_id).subquery()
+    paid = db.session.query(Payment.order_id.label('order_id'),
+                            func.sum(Payment.amount).label('paid')).\
+           join(Order, Order.id == Payment.order_id).\
+           filter(Order.salesperson.in_(salesperson_ids)).\
+           group_by(Payment.order_id).subquery()
+    balance = totals.c.total - func.coalesce(paid.c.paid, 0.0)
+
+    boundaries = [as_of - datetime.timedelta(days=days) for days in (30, 60, 90)]
+    bucket_columns = [
+        func.sum(case([(Order.timestamp >= boundaries[0], balance)], else_=0.0)),
+        func.sum(case([(and_(Order.timestamp < boundaries[0],
+                             Order.timestamp >= boundaries[1]), balance)], else_=0.0)),
+        func.sum(case([(and_(Order.timestamp < boundaries[1],
+                             Order.timestamp >= boundaries[2]), balance)], else_=0.0)),
+        func.sum(case([(Order.timestamp < boundaries[2], balance)], else_=0.0)),
+    ]
+    query = db.session.query(Order.salesperson, Order.client,
+                             func.count(Order.id), func.sum(balance), *bucket_columns).\
+            join(totals, totals.c.order_id == Order.id).\
+            outerjoin(paid, paid.c.order_id == Order.id).\
+            filter(balance > CENT).\
+            group_by(Order.salesperson, Order.client)
+    results = query.all()
+
+    salespeople = employee_names(set(row[0] for row in results))
+    clients = client_names(set(row[1] for row in results))
+
+    def empty_row():
+        return {'orders': 0, 'balance': 0.0, 'buckets': [0.0] * len(AGING_BUCKETS)}
+    def accumulate(acc, row):
+        acc['orders'] += row['orders']
+        acc['balance'] += row['balance']
+        acc['buckets'] = [a + b for (a, b) in zip(acc['buckets'], row['buckets'])]
+
+    rows = []
+    subtotals = {}
+    grand_total = empty_row()
+    for result in results:
+        (salesperson_id, client_id, order_count, total_balance) = result[:4]
+        (username, company) = clients.get(client_id, ('', ''))
+        row = {'salesperson_id': salesperson_id,
+               'salesperson': salespeople.get(salesperson_id, ''),
+               'client_id': client_id,
+               'client': username,
+               'company': company,
+               'orders': order_count,
+               'balance': total_balance,
+               'buckets': list(result[4:])}
+        rows.append(row)
+        if salesperson_id not in subtotals:
+            subtotals[salesperson_id] = empty_row()
+            subtotals[salesperson_id]['salesperson'] = row['salesperson']
+        accumulate(subtotals[salesperson_id], row)
+        accumulate(grand_total, row)
+    rows.sort(key=lambda row: (row['salesperson'], row['client']))
+
+    return {'as_of': as_of,
+            'rows': rows,
+            'subtotals': subtotals,
+            'total': grand_total}
+
+def cached_ar_aging(employee):
+    """ar_aging, cached per employee and day. Entries are dropped as soon
+    as an order, payment or the management hierarchy changes."""
+    key = employee.employee_id
+    version = (datetime.date.today(),) + data_versions('orders', 'payments', 'employees')
+    report = _aging_cache.get(key, version)
+    if report is None:
+        report = ar_aging(employee)
+        _aging_cache.set(key, version, report)
+    return report
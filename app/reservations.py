@@ -0,0 +1,157 @@
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import and_
+
+from app import db
+
+from .background import start_periodic
+from .cache import bump_version
+from .models import Product, Reservation
+
+# Every change to Product.quantity and Product.reserved in here is a
+# single conditional UPDATE, so two checkouts racing for the last units
+# cannot both succeed: the loser's UPDATE matches no row. Reservation rows
+# are likewise claimed by deleting them and checking the row count, so a
+# hold is released, expired or checked out exactly once, and renewed by a
+# conditional UPDATE, so a renewal that loses to the sweeper starts a new
+# hold instead of writing to a deleted row.
+
+
+class ReservationError(Exception):
+    pass
+
+
+def default_ttl():
+    from app import app
+    return datetime.timedelta(minutes=app.config.get('RESERVATION_TTL_MINUTES', 30))
+
+def _update_product(product_id, condition=None, **values):
+    table = Product.__table__
+    where = table.c.id == product_id
+    if condition is not None:
+        where = and_(where, condition)
+    return db.session.execute(table.update().where(where).values(**values)).rowcount == 1
+
+def _claim(reservation_id, condition=None):
+    table = Reservation.__table__
+    where = table.c.id == reservation_id
+    if condition is not None:
+        where = and_(where, condition)
+    return db.session.execute(table.delete().where(where)).rowcount == 1
+
+def _reserve(product_id, quantity):
+    table = Product.__table__
+    return _update_product(product_id,
+                           and_(table.c.active == True,
+                                table.c.quantity - table.c.reserved >= quantity),
+                           reserved=table.c.reserved + quantity)
+
+def take_stock(product_id, quantity):
+    """Removes quantity from on-hand stock if that much is available to
+    promise. Stale holds on the product are released before giving up.
+    Returns False if there is not enough stock."""
+    table = Product.__table__
+    def take():
+        return _update_product(product_id,
+                               table.c.quantity - table.c.reserved >= quantity,
+                               quantity=table.c.quantity - quantity)
+    if take():
+        return True
+    if release_expired(product_id=product_id):
+        return take()
+    return False
+
+def take_reserved_stock(reservation):
+    """Turns a hold into a stock decrement. Returns False if the hold has
+    already expired or been released."""
+    if not _claim(reservation.id, Reservation.expires_at > datetime.datetime.now()):
+        return False
+    table = Product.__table__
+    _update_product(reservation.product_id,
+                    quantity=table.c.quantity - reservation.quantity,
+                    reserved=table.c.reserved - reservation.quantity)
+    return True
+
+def hold(product, quantity, client, salesperson, discount=0, ttl=None):
+    """Reserves stock for a client's cart. Holding a product that is
+    already in the cart adds to the existing hold and renews it. Runs in
+    the caller's transaction."""
+    if quantity < 1:
+        raise ReservationError('Quantity must be at least 1')
+    if not _reserve(product.id, quantity):
+        release_expired(product_id=product.id)
+        if not _reserve(product.id, quantity):
+            raise ReservationError('Insufficent Inventory')
+
+    now = datetime.datetime.now()
+    expires_at = now + (ttl or default_ttl())
+    table = Reservation.__table__
+    renewed = db.session.execute(table.update().
+                                 where(and_(table.c.product_id == product.id,
+                                            table.c.client_id == client.client_id,
+                                            table.c.salesperson_id == salesperson.employee_id)).
+                                 values(quantity=table.c.quantity + quantity,
+                                        discount=discount,
+                                        expires_at=expires_at)).rowcount
+    if not renewed:
+        db.session.add(Reservation(product_id=product.id,
+                                   client_id=client.client_id,
+                                   salesperson_id=salesperson.employee_id,
+                                   quantity=quantity,
+                                   discount=discount,
+                                   created_at=now,
+                                   expires_at=expires_at))
+    bump_version('stock')
+
+def release(reservation):
+    """Gives a hold's stock back. Runs in the caller's transaction."""
+    if not _claim(reservation.id):
+        return False
+    table = Product.__table__
+    _update_product(reservation.product_id,
+                    reserved=table.c.reserved - reservation.quantity)
+    bump_version('stock')
+    return True
+
+def release_expired(now=None, product_id=None, batch_size=500):
+    """Releases up to batch_size expired holds, optionally only for one
+    product. Runs in the caller's transaction. Returns how many holds were
+    released."""
+    if now is None:
+        now = datetime.datetime.now()
+    query = db.session.query(Reservation.id, Reservation.product_id, Reservation.quantity).\
+            filter(Reservation.expires_at <= now)
+    if product_id is not None:
+        query = query.filter(Reservation.product_id == product_id)
+    released = defaultdict(int)
+    count = 0
+    for (reservation_id, reserved_product_id, quantity) in query.limit(batch_size).all():
+        if _claim(reservation_id):
+            released[reserved_product_id] += quantity
+            count += 1
+    table = Product.__table__
+    for (reserved_product_id, quantity) in released.items():
+        _update_product(reserved_product_id, reserved=table.c.reserved - quantity)
+    if count:
+        bump_version('stock')
+    return count
+
+def sweep(batch_size=500):
+    """Releases every expired hold, committing one batch at a time."""
+    total = 0
+    while True:
+        try:
+            count = release_expired(batch_size=batch_size)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        total += count
+        if count < batch_size:
+            return total
+
+def start_sweeper(app):
+    """Starts this process's sweeper thread. Several processes may each
+    run one; claiming holds by row count keeps that safe."""
+    start_periodic(app, 'reservation-sweeper', app.config.get('RESERVATION_SWEEP_SECONDS'), sweep)
@@ -0,0 +1,131 @@
+import threading
+from contextlib import contextmanager
+from functools import partial, wraps
+
+from flask import _app_ctx_stack
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.sql.expression import UpdateBase
+
+try:
+    from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
+except ImportError:
+    from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession as SignallingSession
+
+# Read/write routing. Views that only read declare it with @read_only and
+# their queries go to a second engine: a read-only connection to the same
+# SQLite file, which runs in WAL mode so those readers work from a
+# snapshot and never block order and payment writes. Anything that writes
+# goes to the primary, and once a session has written it stays on the
+# primary so it reads its own writes.
+#
+# SQLALCHEMY_READ_ROUTING turns this on. SQLALCHEMY_READ_DATABASE_URI may
+# point the reads at a replica file instead of the primary database.
+# SQLALCHEMY_ATTACH ({schema: path}) names further SQLite files to ATTACH
+# to every connection of both engines, so models declared in those
+# schemas can be queried and joined like any other table.
+
+_read_engines = {}
+_lock = threading.Lock()
+
+
+def _use_wal(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+def _read_only_connection(dbapi_connection, connection_record):
+    # pysqlite only opens transactions before writes; take over so each
+    # session reads from a single snapshot
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = ON')
+    cursor.close()
+
+def _begin_snapshot(connection):
+    connection.execute('BEGIN')
+
+def attach_databases(app, engine):
+    """ATTACHes the SQLALCHEMY_ATTACH files to each new connection."""
+    attached = sorted((app.config.get('SQLALCHEMY_ATTACH') or {}).items())
+    if not attached or engine.dialect.name != 'sqlite':
+        return
+    def attach(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for (schema, path) in attached:
+            cursor.execute('ATTACH DATABASE ? AS "%s"' % (schema), (path,))
+        cursor.close()
+    event.listen(engine, 'connect', attach)
+
+def use_wal(engine):
+    """Puts the primary SQLite database in WAL mode so readers do not
+    block the writer."""
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _use_wal)
+
+def read_engine(app):
+    """The app's read engine, or None when routing is off."""
+    if not app.config.get('SQLALCHEMY_READ_ROUTING'):
+        return None
+    engine = _read_engines.get(app)
+    if engine is None:
+        with _lock:
+            engine = _read_engines.get(app)
+            if engine is None:
+                uri = app.config.get('SQLALCHEMY_READ_DATABASE_URI') or \
+                      app.config['SQLALCHEMY_DATABASE_URI']
+                engine = create_engine(uri)
+                attach_databases(app, engine)
+                if engine.dialect.name == 'sqlite':
+                    event.listen(engine, 'connect', _read_only_connection)
+                    event.listen(engine, 'begin', _begin_snapshot)
+                _read_engines[app] = engine
+    return engine
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the read engine while read_only is set
+    and it has not written anything yet."""
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.routing_app = db.get_app()
+        self.read_only = False
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        if self.read_only and not self.wrote:
+            engine = read_engine(self.routing_app)
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with RoutingSession as its session class."""
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', getattr(_app_ctx_stack, '__ident_func__', None))
+        return orm.scoped_session(partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+
+@contextmanager
+def reading(session):
+    """Routes session's queries to the read engine for the duration."""
+    session = session()
+    previous = session.read_only
+    session.read_only = True
+    try:
+        yield
+    finally:
+        session.read_only = previous
+
+def read_only(view):
+    """View decorator declaring that the view only reads, so it can be
+    served from the read engine."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        from app import db
+        with reading(db.session):
+            return view(*args, **kwargs)
+    return wrapped
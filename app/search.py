@@ -0,0 +1,281 @@
+import bisect
+import heapq
+import re
+import threading
+
+from flask import g, has_request_context
+
+from app import db
+
+from .cache import data_versions
+from .models import Client, Product
+
+from helpers import chunked
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Result limits for search pages and typeahead suggestions
+SEARCH_RESULTS = 100
+TYPEAHEAD_RESULTS = 10
+CLIENTS_PER_PAGE = 50
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+class PrefixIndex(object):
+    """An in-memory inverted index from tokens to document ids.
+
+    Every query term matches the tokens it is a prefix of, found by
+    bisecting a sorted list of the distinct tokens, and a document must
+    match every term. Results are ranked by how many terms matched a
+    whole token and then by the document's sort key. Documents are any
+    hashable ids; the caller keeps whatever else it needs about them."""
+    def __init__(self):
+        self._postings = {}     # token -> set of ids
+        self._tokens = []       # sorted distinct tokens
+        self._docs = {}         # id -> (sort key, frozenset of tokens)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def load(self, docs):
+        """Replaces the whole index with (id, text, sort_key) triples."""
+        postings = {}
+        entries = {}
+        for (doc_id, text, sort_key) in docs:
+            tokens = frozenset(tokenize(text))
+            entries[doc_id] = (sort_key, tokens)
+            for token in tokens:
+                postings.setdefault(token, set()).add(doc_id)
+        tokens = sorted(postings)
+        with self._lock:
+            (self._postings, self._tokens, self._docs) = (postings, tokens, entries)
+
+    def add(self, doc_id, text, sort_key=None):
+        """Indexes a document, replacing any earlier version of it."""
+        with self._lock:
+            self._remove(doc_id)
+            tokens = frozenset(tokenize(text))
+            self._docs[doc_id] = (sort_key, tokens)
+            for token in tokens:
+                if token not in self._postings:
+                    self._postings[token] = set()
+                    bisect.insort(self._tokens, token)
+                self._postings[token].add(doc_id)
+
+    def remove(self, doc_id):
+        with self._lock:
+            self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self._docs.pop(doc_id, None)
+        if entry is None:
+            return
+        for token in entry[1]:
+            ids = self._postings[token]
+            ids.discard(doc_id)
+            if not ids:
+                del self._postings[token]
+                del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def _matching(self, term):
+        start = bisect.bisect_left(self._tokens, term)
+        ids = set()
+        for token in self._tokens[start:]:
+            if not token.startswith(term):
+                break
+            ids.update(self._postings[token])
+        return ids
+
+    def search(self, query, accept=None, limit=None):
+        """Returns the ids matching every term of query, best first.
+        accept, if given, is called with each candidate id to filter
+        them before ranking."""
+        terms = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not terms:
+            return []
+        with self._lock:
+            # Longer terms tend to match fewer ids, so start with those
+            candidates = None
+            for term in terms:
+                ids = self._matching(term)
+                candidates = ids if candidates is None else candidates & ids
+                if not candidates:
+                    return []
+            if accept is not None:
+                candidates = [doc_id for doc_id in candidates if accept(doc_id)]
+            docs = self._docs
+            exact = [self._postings.get(term, ()) for term in terms]
+            ranked = ((-sum(doc_id in ids for ids in exact), docs[doc_id][0], doc_id)
+                      for doc_id in candidates)
+            if limit is None:
+                return [doc_id for (_score, _key, doc_id) in sorted(ranked)]
+            return [doc_id for (_score, _key, doc_id) in heapq.nsmallest(limit, ranked)]
+
+    def ordered(self, accept=None):
+        """Returns every id, or those accept allows, by sort key."""
+        with self._lock:
+            entries = [(sort_key, doc_id) for (doc_id, (sort_key, _tokens)) in self._docs.items()
+                       if accept is None or accept(doc_id)]
+        entries.sort()
+        return [doc_id for (_sort_key, doc_id) in entries]
+
+
+def load_ranked(query, id_column, ids, limit=None):
+    """Loads the rows of query whose id_column is in the ranked list ids,
+    keeping the ranking. Rows the query filters out are skipped, and ids
+    are fetched a chunk at a time until limit rows have been found."""
+    found = []
+    for chunk in chunked(ids, 500):
+        rows = dict((getattr(row, id_column.key), row)
+                    for row in query.filter(id_column.in_(chunk)))
+        found.extend(rows[doc_id] for doc_id in chunk if doc_id in rows)
+        if limit is not None and len(found) >= limit:
+            return found[:limit]
+    return found
+
+
+class TableSearch(object):
+    """Keeps a PrefixIndex over one table current.
+
+    The index is built from the table on first use and kept current by
+    update() in the process that edits a row. Other processes notice the
+    table's data version has moved (checked at most once per request)
+    and rebuild. Subclasses say which rows to load and how to index one;
+    meta holds a small value per id to filter results on."""
+    version_name = None
+
+    def __init__(self):
+        self.index = PrefixIndex()
+        self.meta = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+    def rows(self):
+        raise NotImplementedError
+
+    def document(self, row):
+        """Returns (id, text, sort_key, meta) for a row or model instance."""
+        raise NotImplementedError
+
+    def _stale(self):
+        if self._version is None:
+            return True
+        if has_request_context():
+            flag = '%s_search_checked' % (self.version_name)
+            if getattr(g, flag, False):
+                return False
+            setattr(g, flag, True)
+        return data_versions(self.version_name) != self._version
+
+    def refresh(self):
+        if not self._stale():
+            return
+        with self._lock:
+            version = data_versions(self.version_name)
+            if version == self._version:
+                return
+            meta = {}
+            def docs():
+                for row in self.rows():
+                    (doc_id, text, sort_key, value) = self.document(row)
+                    meta[doc_id] = value
+                    yield (doc_id, text, sort_key)
+            self.index.load(docs())
+            self.meta = meta
+            self._version = version
+
+    def update(self, obj):
+        """Reindexes a row after its change has been committed. If no
+        other process changed the table in the meantime the index stays
+        current without a rebuild."""
+        (doc_id, text, sort_key, value) = self.document(obj)
+        self.index.add(doc_id, text, sort_key)
+        self.meta[doc_id] = value
+        with self._lock:
+            version = data_versions(self.version_name)
+            if self._version is not None and version == (self._version[0] + 1,):
+                self._version = version
+
+    def search(self, query, accept=None, limit=None):
+        """Returns matching ids, best first."""
+        self.refresh()
+        return self.index.search(query, accept=accept, limit=limit)
+
+    def ordered(self, accept=None):
+        """Returns every id, optionally filtered, in sort key order."""
+        self.refresh()
+        return self.index.ordered(accept)
+
+
+class ProductSearch(TableSearch):
+    """Search over product manufacturer and name. meta is the active
+    flag. Stock levels change with every order so they are not indexed;
+    filter on them when loading rows."""
+    version_name = 'products'
+
+    def rows(self):
+        return db.session.query(Product.id, Product.manufacturer,
+                                Product.name, Product.active).yield_per(1000)
+
+    def document(self, product):
+        return (product.id, '%s %s' % (product.manufacturer, product.name),
+                (product.manufacturer.lower(), product.name.lower()), product.active)
+
+    def active_ids(self, query, active_only=True, limit=None):
+        self.refresh()
+        accept = self.meta.get if active_only else None
+        return self.search(query, accept=accept, limit=limit)
+
+product_search = ProductSearch()
+
+def find_products(query, active_only=True, in_stock=False, limit=None):
+    """Searches the catalog and loads the matching products, best first.
+    in_stock leaves out products with nothing available to promise."""
+    rows = Product.query
+    if in_stock:
+        rows = rows.filter(Product.quantity - Product.reserved > 0)
+        ids = product_search.active_ids(query, active_only)
+    else:
+        ids = product_search.active_ids(query, active_only, limit=limit)
+    return load_ranked(rows, Product.id, ids, limit)
+
+
+class ClientSearch(TableSearch):
+    """Search over client company and username. meta is the client's
+    salesperson, so results can be limited to one part of the management
+    hierarchy without touching the database."""
+    version_name = 'clients'
+
+    def rows(self):
+        return db.session.query(Client.client_id, Client.company,
+                                Client.username, Client.salesperson_id).\
+               select_from(Client).yield_per(1000)
+
+    def document(self, client):
+        return (client.client_id, '%s %s' % (client.company, client.username),
+                (client.company.lower(), client.username.lower()), client.salesperson_id)
+
+    def visible_ids(self, employee, query=None, limit=None):
+        """Ranked ids of the clients of employee and everyone below them,
+        or all of them in directory order when there is no query."""
+        salespeople = set(employee.subtree_ids())
+        self.refresh()
+        meta = self.meta
+        accept = lambda client_id: meta.get(client_id) in salespeople
+        if query:
+            return self.search(query, accept=accept, limit=limit)
+        return self.ordered(accept=accept)[:limit]
+
+client_search = ClientSearch()
+
+def find_clients(employee, query=None, page=1, per_page=CLIENTS_PER_PAGE):
+    """Returns (clients on the page, total number of matches) from the
+    clients visible to employee."""
+    ids = client_search.visible_ids(employee, query)
+    start = (page - 1) * per_page
+    rows = Client.query.options(db.joinedload('salesperson'))
+    return load_ranked(rows, Client.client_id, ids[start:start + per_page]), len(ids)
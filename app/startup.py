@@ -0,0 +1,94 @@
+import __builtin__
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Startup profiling. Set PROFILE_STARTUP=1 in the environment (or run
+# 'manage.py profile-startup') to have a worker print how long each
+# initialization phase and each module import took, and how long it was
+# until the first response went out. This module is imported before
+# anything else in the app so the import hook sees every import, and so
+# it must not import the app itself.
+
+ENABLED = bool(os.environ.get('PROFILE_STARTUP'))
+
+
+class StartupProfiler(object):
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []        # (name, seconds)
+        self.imports = []       # (module, seconds including its own imports, depth)
+        self._depth = 0
+        self._original_import = None
+        self._lock = threading.Lock()
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - began))
+
+    def install_import_hook(self):
+        """Times every module the first time it is imported."""
+        original = self._original_import = __builtin__.__import__
+        profiler = self
+        def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+            if name in sys.modules:
+                return original(name, globals, locals, fromlist, level)
+            profiler._depth += 1
+            began = time.time()
+            try:
+                return original(name, globals, locals, fromlist, level)
+            finally:
+                profiler._depth -= 1
+                profiler.imports.append((name, time.time() - began, profiler._depth))
+        __builtin__.__import__ = timed_import
+
+    def remove_import_hook(self):
+        if self._original_import is not None:
+            __builtin__.__import__ = self._original_import
+            self._original_import = None
+
+    def report(self, out=None, top=25):
+        out = out or sys.stderr
+        with self._lock:
+            if self.reported:
+                return
+            self.reported = True
+        self.remove_import_hook()
+        print >>out, 'Startup profile (pid %i)' % (os.getpid())
+        for (name, seconds) in self.phases:
+            print >>out, '  %-32s %8.1f ms' % (name, seconds * 1000)
+        print >>out, '  %-32s %8.1f ms' % ('total until now', (time.time() - self.started) * 1000)
+        # Only outermost imports add up; nested ones are shown for detail
+        print >>out, 'Slowest imports (inclusive):'
+        for (name, seconds, depth) in sorted(self.imports, key=lambda i: -i[1])[:top]:
+            print >>out, '  %-40s %8.1f ms%s' % (name, seconds * 1000, '' if depth == 0 else '  (nested)')
+
+profiler = StartupProfiler()
+if ENABLED:
+    profiler.install_import_hook()
+
+@contextmanager
+def phase(name):
+    if not ENABLED:
+        yield
+        return
+    with profiler.phase(name):
+        yield
+
+def report_on_first_response(app):
+    """Prints the profile once the worker has served its first request."""
+    if not ENABLED:
+        return
+    def first_response(response):
+        if not profiler.reported:
+            profiler.phases.append(('until first response', time.time() - profiler.started))
+            profiler.report()
+        return response
+    app.after_request(first_response)
@@ -0,0 +1,31 @@
+// Fills the <datalist> of any input with a data-typeahead attribute from
+// the JSON endpoint it names. The endpoint is called with ?q=<text> and
+// returns {"results": [{"label": ...}, ...]}.
+$(function() {
+  $('input[data-typeahead]').each(function() {
+    var input = $(this);
+    var list = $('#' + input.attr('list'));
+    var pending = null;
+    var last = null;
+    input.on('input', function() {
+      var q = $.trim(input.val());
+      if (q === last) {
+        return;
+      }
+      last = q;
+      if (pending !== null) {
+        pending.abort();
+      }
+      if (q.length === 0) {
+        list.empty();
+        return;
+      }
+      pending = $.getJSON(input.data('typeahead'), {q: q}, function(data) {
+        list.empty();
+        $.each(data.results, function(i, result) {
+          list.append($('<option>').attr('value', result.label));
+        });
+      });
+    });
+  });
+});
@@ -1,23 +1,56 @@
 import datetime
-import StringIO
-import csv
+import os
 from functools import wraps
 from collections import defaultdict
 
-from flask import abort, flash, g, redirect, render_template, request, session, url_for, make_response 
+from flask import abort, flash, g, jsonify, redirect, render_template, request, send_file, session, url_for
 from flask.ext.login import current_user, login_required, login_user, logout_user
+from sqlalchemy import or_
 
 from app import app, bcrypt, db, login_manager
 
 from .forms import (
 
-    AddClientForm, AddEmployeeForm, ClientForm, CreateUserForm, EditClientForm, EditEmployeeForm, EmployeeForm, LoginForm,
-    OrderForm, PaymentForm, ProductForm, PromotionForm, ReorderProductForm, IntegerField
+    AddClientForm, AddEmployeeForm, BatchPaymentForm, BulkPromotionForm, CatalogImportForm, ClientForm, CreateUserForm, EditClientForm, EditEmployeeForm, EmployeeForm, HoldForm, LoginForm,
+    ManufacturerPromotionForm, OrderForm, PaymentForm, ProductForm, PromotionForm, ReorderProductForm, IntegerField
 
 )
-from .models import Client, Employee, Feedback, Payment, Product, Promotion, Order, OrderItem, User
+from .models import (
+    Client, CommissionStatement, Employee, Job, Payment, Product, Promotion, Order, OrderItem,
+    ReplenishmentRequest, Reservation, User
+)
 
+from .api import (
+    ApiError, OrderScope, api_view, change_args, change_feed, create_orders, get_clients, get_orders,
+    get_products, id_list, list_clients, list_orders, list_products, page_args
+)
+from .archive import ensure_archive, find_order
+from .background import start_periodic
+from .cache import bump_version, user_version
+from .catalog import import_catalog
+from .changes import ensure_change_log
+from .conditional import conditional, stamps
+from .events import (
+    PAYMENT_APPLIED, PROMOTION_DELETED, PROMOTION_SAVED, STOCK_RECEIVED, consume_all, record_event
+)
+from .feedback import HISTORY_PER_PAGE, feedback_history, feedback_summary, submit_feedback
+from .fragments import Deferred, cached_fragment, fragment_cache
+from .jobs import enqueue, job_status, result_path
+from .ratelimit import limit_requests, rate_limiter
+from .routing import read_only
+from .cube import DIMENSIONS, GRAINS, dimension_labels, query_cube
 from helpers import add_error, flash_errors, flash_form_errors, flatten_hierarchy
+from orders import place_order
+from payments import apply_remittance, parse_remittance, reconciliation_summary
+from popularity import SCOPE_ALL, SCOPE_CLIENT, SCOPE_SALESPERSON, popular_products
+from promotions import apply_bulk_promotion, clear_bulk_promotion, product_criteria, unpromoted_products
+from replenishment import mark_received, start_replenisher
+from reports import AGING_BUCKETS, cached_ar_aging
+from reservations import ReservationError, hold, release, start_sweeper
+from search import (
+    CLIENTS_PER_PAGE, SEARCH_RESULTS, TYPEAHEAD_RESULTS, client_search, find_clients, find_products,
+    load_ranked, product_search
+)
 
 
 ###############################################################################
@@ -31,22 +64,44 @@ def load_user(username):
 def check_if_banned():
     if not current_user.is_authenticated():
         return
-    if current_user.is_employee and current_user.employee.title == 'Salesperson':
-        # Salespeople get banned if they have 9 dislikes
-        if len([fb for fb in current_user.feedback_received_since_banning if not fb.is_positive]) >= 9:
-            current_user.ban()
-    elif not current_user.is_employee:
-        # Client gets banned if they have 2 dislikes
-        if len([fb for fb in current_user.feedback_received_since_banning if not fb.is_positive]) >= 2:
-            current_user.ban()
-
+    # The ban rules run as feedback is written, see feedback.py
     if current_user.banned:
         flash("You've been banned")
         logout_user()
 
+app.jinja_env.globals.update(cached_fragment=cached_fragment, user_version=user_version)
+
 if None not in app.before_request_funcs:
     app.before_request_funcs[None] = []
 app.before_request_funcs[None].append(check_if_banned)
+# Ahead of every other hook, so rejected requests never reach the database
+app.before_request_funcs[None].insert(0, limit_requests)
+
+@app.before_first_request
+def start_background_tasks():
+    ensure_archive()
+    ensure_change_log()
+    start_sweeper(app)
+    start_replenisher(app)
+    product_search.refresh()
+    client_search.refresh()
+    start_periodic(app, 'event-consumer', app.config.get('EVENT_CONSUMER_INTERVAL_SECONDS'), consume_all)
+
+# Checked in place of a missing user's hash, made on first use so that it
+# has the configured number of rounds
+_missing_user_hash = []
+
+def password_matches(user, password):
+    """Checks password against user's hash. When there is no such user a
+    throwaway hash is checked instead, so the time taken does not tell
+    whether the username exists."""
+    if not _missing_user_hash:
+        _missing_user_hash.append(bcrypt.generate_password_hash(os.urandom(16).encode('hex')))
+    saved_hash = user.password_hash if user is not None else _missing_user_hash[0]
+    try:
+        return bcrypt.check_password_hash(saved_hash, password or '') and user is not None
+    except Exception:
+        return False
 
 @app.route('/login/', methods=['GET', 'POST'])
 def login():
@@ -55,16 +110,10 @@ def login():
         # We check the hash even if the user does not exist so that
         # we do not leak hints about the validity of a username
         user = db.session.query(User).filter_by(username=form.username.data).first()
-        saved_hash = ''
-        if user is not None:
-            saved_hash = user.password_hash
-        try:
-            if bcrypt.check_password_hash(saved_hash, form.password.data):
-                current_user._authenticated = True
-                login_user(user, remember=True)
-                return redirect(request.args.get('next') or url_for('dashboard'))
-        except:
-            pass
+        if password_matches(user, form.password.data):
+            current_user._authenticated = True
+            login_user(user, remember=True)
+            return redirect(request.args.get('next') or url_for('dashboard'))
         flash('Invalid credentials')
     return render_template('login.html', form=form)
 
@@ -94,8 +143,15 @@ def employees_only(titles=None):
 ###############################################################################
 # Dashboard 
 ###############################################################################
+def dashboard_resources():
+    if current_user.is_employee and current_user.employee.title != 'Salesperson':
+        return ['team']
+    return ['catalog', 'orders', 'popularity']
+
 @app.route('/')
 @login_required
+@read_only
+@conditional(dashboard_resources)
 def dashboard():
     if current_user.is_employee:
         return employee_dashboard()
@@ -106,9 +162,10 @@ def employee_dashboard():
     if emp is None:
         abort(404)
     if emp.title == 'Salesperson':
-        popular_products = popular_salesperson_products(emp)
+        products = Deferred(popular_salesperson_products, emp)
         return render_template('salesperson_dashboard.html',
-                               products=popular_products)
+                               employee=emp,
+                               products=products)
     else:
         direct_reports = sorted(emp.direct_reports,
                                 key=lambda employee: employee.sales_total)
@@ -123,7 +180,7 @@ def client_dashboard():
     cli = Client.query.filter_by(user_id=current_user.id).first()
     if cli is None:
         abort(404)
-    products = popular_customer_products(cli.client_id)
+    products = Deferred(popular_customer_products, cli.client_id)
     return render_template('client_dashboard.html',
                            title='Home',
                            products=products)
@@ -163,7 +220,10 @@ def fire_employee(employee_id):
     for cli in emp_cli:
     	cli.salesperson_id = new_salesperson.employee_id
     emp.active = False
+    bump_version('clients', 'employees')
     db.session.commit()
+    for cli in emp_cli:
+        client_search.update(cli)
     flash('Employee Fired!')
     return redirect(url_for('employees'))
                            
@@ -229,6 +289,7 @@ def add_employee():
             user.commission = form.commission.data
             user.max_discount = form.max_discount.data
             db.session.add(user)
+            bump_version('employees')
             db.session.commit()
             flash('Employee added successfully')
             return redirect('/employees/')
@@ -257,6 +318,7 @@ def manager_edit_employee(employee_id):
         emp.title = form.title.data
         emp.commission = new_commission
         emp.max_discount = new_max_discount
+        bump_version('employees')
         db.session.commit()
         flash('Employee updated successfully')
         return redirect('/employees/')
@@ -278,6 +340,7 @@ def director_edit_employee(employee_id):
         emp.title = form.title.data
         emp.commission = new_commission
         emp.max_discount = new_max_discount
+        bump_version('employees')
         db.session.commit()
         flash('Employee updated successfully')
         return redirect('/employees/')
@@ -293,10 +356,29 @@ def director_edit_employee(employee_id):
 @login_required
 @employees_only()
 def clients():
-    clients = flatten_hierarchy(current_user.employee,
-                                lambda employee: employee.clients)
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    (clients, total) = find_clients(current_user.employee, q, page)
     title = 'All Clients'
-    return render_template('clients.html', title=title, clients=clients)
+    return render_template('clients.html', title=title, clients=clients,
+                           q=q, page=page, total=total,
+                           pages=(total + CLIENTS_PER_PAGE - 1) // CLIENTS_PER_PAGE)
+
+@app.route('/clients/search/')
+@login_required
+@employees_only()
+def search_clients():
+    """Typeahead for the client directory."""
+    q = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', TYPEAHEAD_RESULTS, type=int), SEARCH_RESULTS)
+    ids = client_search.visible_ids(current_user.employee, q, limit=limit) if q else []
+    clients = load_ranked(Client.query, Client.client_id, ids)
+    return jsonify(results=[dict(id=client.client_id,
+                                 label=client.company,
+                                 company=client.company,
+                                 username=client.username,
+                                 salesperson_id=client.salesperson_id)
+                            for client in clients])
 
 
 
@@ -332,7 +414,9 @@ def edit_client(client_id):
     new_salesperson = form.salesperson_id.data
     if form.validate_on_submit():
         cli.salesperson_id = new_salesperson 
+        bump_version('clients')
         db.session.commit()
+        client_search.update(cli)
         flash('Client updated successfully')
         return redirect('/clients/')
  
@@ -361,7 +445,9 @@ def add_client():
         cli.company = form.company.data
         cli.salesperson_id = form.salesperson_id.data
         db.session.add(cli)
+        bump_version('clients')
         db.session.commit()
+        client_search.update(cli)
         flash('Client added successfully')
         return redirect(url_for('clients'))
     flash_form_errors(form)
@@ -377,6 +463,7 @@ def add_client():
 @app.route('/sales/')
 @employees_only()
 @login_required
+@read_only
 def sales():
     emp = current_user.employee
     order_ids = flatten_hierarchy(emp,
@@ -391,6 +478,8 @@ def sales():
 ###############################################################################
 @app.route('/products/')
 @login_required
+@read_only
+@conditional('catalog')
 def products():
     if current_user.is_employee:
         return employee_products()
@@ -400,23 +489,49 @@ def employee_products():
     emp = Employee.query.filter_by(user_id=current_user.id).first()
     if emp is None:
         abort(503)
-    all_products = Product.query.all()
-    if emp.title == 'Director':
-        products = all_products
+    q = request.args.get('q', '').strip()
+    if q:
+        products = Deferred(find_products, q, active_only=(emp.title != 'Director'),
+                            limit=SEARCH_RESULTS)
+    elif emp.title == 'Director':
+        products = Product.query
     else:
-        products = [p for p in all_products if p.active]
+        products = Product.query.filter_by(active=True)
     return render_template('employee_products.html',
                            title='Products',
                            employee=emp,
-                           products=products)
+                           products=products,
+                           q=q)
 def client_products():
     cli = Client.query.filter_by(user_id=current_user.id).first()
     if cli is None:
         abort(503)
-    products = Product.query.filter_by(active=True).all()
+    q = request.args.get('q', '').strip()
+    if q:
+        products = Deferred(find_products, q, limit=SEARCH_RESULTS)
+    else:
+        products = Product.query.filter_by(active=True)
     return render_template('client_products.html',
                            title='Products',
-                           products=products)
+                           products=products,
+                           q=q)
+
+@app.route('/products/search/')
+@login_required
+def search_products():
+    """Typeahead for the product search boxes."""
+    q = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', TYPEAHEAD_RESULTS, type=int), SEARCH_RESULTS)
+    active_only = not (current_user.is_employee and current_user.employee.title == 'Director')
+    products = find_products(q, active_only=active_only,
+                             in_stock=bool(request.args.get('in_stock')), limit=limit)
+    return jsonify(results=[dict(id=product.id,
+                                 label=product.description,
+                                 manufacturer=product.manufacturer,
+                                 name=product.name,
+                                 price=round(product.promo_price, 2),
+                                 available=product.available)
+                            for product in products])
 
 @app.route('/product/reorder/<int:product_id>/', methods=['GET', 'POST'])
 @login_required
@@ -431,8 +546,17 @@ def reorder_product(product_id):
         if new_quantity < product.quantity:
             flash('New quantity must be greater than current quantity')
         else:
+            record_event(STOCK_RECEIVED, product_id=product.id, quantity=new_quantity,
+                         added=new_quantity - product.quantity)
             product.quantity = new_quantity
+            product.reorder_point = form.reorder_point.data
+            product.reorder_quantity = form.reorder_quantity.data
+            product.lead_time_days = form.lead_time_days.data
+            db.session.flush()
+            mark_received([product.id])
+            bump_version('products')
             db.session.commit()
+            product_search.update(product)
             flash('Product quantity updated')
             return redirect(url_for('products'))
     flash_form_errors(form)
@@ -441,6 +565,37 @@ def reorder_product(product_id):
                            form=form,
                            product=product)
 
+@app.route('/products/import/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Director'])
+def import_products():
+    form = CatalogImportForm()
+    if form.validate_on_submit():
+        try:
+            result = import_catalog(form.catalog.data.stream)
+        except (Exception), err:
+            flash('Error - Database : %s' % (err))
+        else:
+            return render_template('catalog_import_report.html',
+                                   title='Catalog Import',
+                                   result=result)
+    flash_form_errors(form)
+    return render_template('import_products.html',
+                           title='Import Catalog',
+                           form=form)
+
+@app.route('/products/low-stock/')
+@login_required
+@employees_only(['Director'])
+def low_stock():
+    requests = db.session.query(ReplenishmentRequest).\
+               filter(ReplenishmentRequest.status.in_(('pending', 'ordered'))).\
+               options(db.joinedload('product')).\
+               order_by(ReplenishmentRequest.requested_at).all()
+    return render_template('low_stock.html',
+                           title='Low Stock',
+                           requests=requests)
+
 @employees_only(['Director'])
 @login_required
 @app.route('/products/add/', methods=['GET', 'POST'])
@@ -453,7 +608,9 @@ def add_product():
                           quantity=form.quantity.data,
                           active=True)
         db.session.add(product)
+        bump_version('products')
         db.session.commit()
+        product_search.update(product)
         flash('Product added')
         return redirect(url_for('products'))
 
@@ -464,68 +621,178 @@ def add_product():
 ###############################################################################
 # Promotions
 ###############################################################################
-@employees_only()
-@login_required
 @app.route('/promotions/')
+@login_required
+@employees_only()
+@read_only
+@conditional('promotions')
 def promotions():
-    promotions = Promotion.query.all()
+    now = datetime.datetime.now()
+    promotions = Promotion.query.\
+                 filter(or_(Promotion.ends_at == None, Promotion.ends_at > now)).\
+                 options(db.joinedload('product')).\
+                 order_by(Promotion.starts_at, Promotion.id)
     return render_template('promotions.html',
                            title='All Promotions',
+                           now=now,
                            promotions=promotions)
 
-@employees_only(['Manager'])
-@login_required
 @app.route('/promotions/add/')
+@login_required
+@employees_only(['Manager'])
 def select_add_promotion():
-    all_products = Product.query.filter_by(active=True).all()
-    promoted_products = [p.product for p in Promotion.query.all()]
-    products = [p for p in all_products if p not in promoted_products]
+    products = unpromoted_products()
     return render_template('select_add_promotion.html',
                            title='Select Product',
                            products=products)
 
-@employees_only(['Manager'])
-@login_required
+def check_promotion_window(form):
+    if (form.starts_at.data is not None and form.ends_at.data is not None and
+            form.ends_at.data <= form.starts_at.data):
+        flash('A promotion must end after it starts')
+        return False
+    return True
+
+def save_promotion(form, product, promotion):
+    discount = float(form.discount.data)
+    if discount > product.price:
+        flash('Discount price cannot be greater than list price')
+    elif discount <= 0:
+        flash('Discount price must be at least $0.01')
+    elif check_promotion_window(form):
+        if promotion is None:
+            promotion = Promotion(product_id=product.id)
+            db.session.add(promotion)
+        promotion.discount = discount
+        promotion.starts_at = form.starts_at.data
+        promotion.ends_at = form.ends_at.data
+        db.session.flush()
+        record_event(PROMOTION_SAVED, promotion_id=promotion.id, product_id=product.id,
+                     discount=discount, starts_at=promotion.starts_at, ends_at=promotion.ends_at)
+        bump_version('promotions')
+        db.session.commit()
+        flash('Promotion updated')
+        return True
+    return False
+
 @app.route('/promotions/add/<int:product_id>/', methods=['GET', 'POST'])
-@app.route('/promotions/edit/<int:product_id>/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Manager'])
 def add_promotion(product_id):
     form = PromotionForm()
     product = Product.query.filter_by(id=product_id).first()
-    current_promotion = Promotion.query.filter_by(product_id=product.id).first()
     if product is None:
         abort(404)
     if form.validate_on_submit():
-        discount = float(form.discount.data)
-        if discount > product.price:
-            flash('Discount price cannot be greater than list price')
-        elif discount <= 0:
-            flash('Discount price must be at least $0.01')
-        else:
-            if current_promotion is None:
-                current_promotion = Promotion()
-                current_promotion.product_id = product_id
-                current_promotion.discount = discount
-                db.session.add(current_promotion)
-            else:
-                current_promotion.discount = discount
-            db.session.commit()
-            flash('Promotion updated')
+        if save_promotion(form, product, None):
             return redirect(url_for('promotions'))
     flash_form_errors(form)
     return render_template('add_promotion.html',
                            title='Promotion for %s - %s' % (product.manufacturer, product.name),
                            product=product,
-                           current_promotion=current_promotion,
+                           current_promotion=None,
                            form=form)
 
+@app.route('/promotions/edit/<int:promotion_id>/', methods=['GET', 'POST'])
+@login_required
 @employees_only(['Manager'])
+def edit_promotion(promotion_id):
+    promotion = Promotion.query.filter_by(id=promotion_id).first()
+    if promotion is None:
+        abort(404)
+    if promotion.product_id is None:
+        return edit_manufacturer_promotion(promotion)
+    product = promotion.product
+    form = PromotionForm(obj=promotion)
+    if form.validate_on_submit():
+        if save_promotion(form, product, promotion):
+            return redirect(url_for('promotions'))
+    flash_form_errors(form)
+    return render_template('add_promotion.html',
+                           title='Promotion for %s - %s' % (product.manufacturer, product.name),
+                           product=product,
+                           current_promotion=promotion,
+                           form=form)
+
+@app.route('/promotions/add/manufacturer/', methods=['GET', 'POST'])
 @login_required
-@app.route('/promotions/delete/<int:product_id>/', methods=['GET', 'POST'])
-def delete_promotion(product_id):
-    promo = Promotion.query.filter_by(product_id=product_id).first()
+@employees_only(['Manager'])
+def add_manufacturer_promotion():
+    return edit_manufacturer_promotion(None)
+
+def edit_manufacturer_promotion(promotion):
+    form = ManufacturerPromotionForm(obj=promotion)
+    form.manufacturer.choices = [(m, m) for (m,) in
+                                 db.session.query(Product.manufacturer).
+                                 filter_by(active=True).distinct().order_by(Product.manufacturer)]
+    if form.validate_on_submit() and check_promotion_window(form):
+        if promotion is None:
+            promotion = Promotion()
+            db.session.add(promotion)
+        promotion.manufacturer = form.manufacturer.data
+        promotion.percent_off = float(form.percent_off.data)
+        promotion.starts_at = form.starts_at.data
+        promotion.ends_at = form.ends_at.data
+        db.session.flush()
+        record_event(PROMOTION_SAVED, promotion_id=promotion.id, manufacturer=promotion.manufacturer,
+                     percent_off=promotion.percent_off, starts_at=promotion.starts_at,
+                     ends_at=promotion.ends_at)
+        bump_version('promotions')
+        db.session.commit()
+        flash('Promotion updated')
+        return redirect(url_for('promotions'))
+    flash_form_errors(form)
+    return render_template('add_manufacturer_promotion.html',
+                           title='Manufacturer Promotion',
+                           current_promotion=promotion,
+                           form=form)
+
+def optional_float(value):
+    return None if value is None else float(value)
+
+@app.route('/promotions/bulk/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Manager'])
+def bulk_promotion():
+    form = BulkPromotionForm()
+    form.manufacturer.choices = [('', 'Any')] + [(m, m) for (m,) in
+                                                 db.session.query(Product.manufacturer).
+                                                 filter_by(active=True).distinct().
+                                                 order_by(Product.manufacturer)]
+    if form.validate_on_submit() and check_promotion_window(form):
+        ids = [i.strip() for i in (form.product_ids.data or '').split(',') if i.strip()]
+        if not all(i.isdigit() for i in ids):
+            flash('Product IDs must be numbers separated by commas')
+        elif form.action.data == 'apply' and form.percent_off.data is None:
+            flash('Enter the percentage to take off')
+        else:
+            criteria = product_criteria(manufacturer=form.manufacturer.data,
+                                        min_price=optional_float(form.min_price.data),
+                                        max_price=optional_float(form.max_price.data),
+                                        product_ids=[int(i) for i in ids])
+            if form.action.data == 'apply':
+                count = apply_bulk_promotion(criteria, float(form.percent_off.data),
+                                             form.starts_at.data, form.ends_at.data)
+                flash('Promotion applied to %i products' % (count))
+            else:
+                count = clear_bulk_promotion(criteria)
+                flash('%i promotions deleted' % (count))
+            return redirect(url_for('promotions'))
+    flash_form_errors(form)
+    return render_template('bulk_promotion.html',
+                           title='Bulk Promotion',
+                           form=form)
+
+@app.route('/promotions/delete/<int:promotion_id>/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Manager'])
+def delete_promotion(promotion_id):
+    promo = Promotion.query.filter_by(id=promotion_id).first()
     if promo is None:
         abort(404)
     db.session.delete(promo)
+    record_event(PROMOTION_DELETED, promotion_id=promotion_id)
+    bump_version('promotions')
     db.session.commit()
     flash('Promotion deleted')
     return redirect(url_for('promotions'))
@@ -563,17 +830,15 @@ def view_order(order_id):
     return view_client_order(current_user.client, order_id)
 
 def view_employee_order(employee, order_id):
-    all_orders = flatten_hierarchy(employee, lambda e: e.orders)
-    matches = [order for order in all_orders if order.id == order_id]
-    if matches == []:
+    order = find_order(order_id, salesperson_ids=employee.subtree_ids())
+    if order is None:
         abort(404)
-    order = matches[0]
     return render_template('employee_view_order.html',
                            title='Order Details',
                            order=order)
 
 def view_client_order(client, order_id):
-    order = Order.query.filter(Order.id==order_id).filter(Order.client==client.client_id).first()
+    order = find_order(order_id, client_id=client.client_id)
     if order is None:
         abort(404)
     return render_template('client_view_order.html',
@@ -590,70 +855,36 @@ def add_order(client_id):
         abort(404)
 
     class ThisOrderForm(OrderForm): pass
-    products = Product.query.filter_by(active=True).filter(Product.quantity>0).all()
+    q = request.args.get('q', '').strip()
+    if q:
+        products = find_products(q, in_stock=True, limit=SEARCH_RESULTS)
+    else:
+        products = Product.query.filter_by(active=True).\
+                   filter(Product.quantity - Product.reserved > 0).all()
     for product in products:
         setattr(ThisOrderForm, str(product.id) + '_quantity', IntegerField('Item Quantity'))
         setattr(ThisOrderForm, str(product.id) + '_discount', IntegerField('Item Discount'))
     form = ThisOrderForm()
     errors = defaultdict(list)
     if form.validate_on_submit():
-        try:
-            salesperson = current_user.employee
-            # Add a new order
-            order = Order(timestamp=datetime.datetime.now(),
-                          client=client_id,
-                          salesperson=salesperson.employee_id,
-                          commission=0.0)
-                          #commission=current_user.employee.commission)
-            db.session.add(order)
-
-            # Update inventory and add order items
-            item_count = 0
-            for (field, value) in form.data.items():
-                if not field.endswith('_quantity'):
-                    continue
-                id_str, _underscore, _quantity = field.partition('_')
-                quantity = value
-                if quantity == 0:
-                    continue
-                if not id_str.isdigit():
-                    errors['Form ID'].append('Invalid ID')
-                    break
-                discount = form.data[id_str + '_discount']
-                max_discount = current_user.employee.max_discount
-                if discount > max_discount:
-                    errors['Discount'].append('Discount cannot exceed %.2f%%' % (max_discount))
-                    break
-                product_id = int(id_str)
-                product = Product.query.filter_by(id=product_id).first()
-                if product is None:
-                   errors[product.description].append('Invalid Item')
-                   break
-                if product.quantity < quantity:
-                    errors[product.description].append('Insufficent Inventory')
-                    break
-                product.quantity -= quantity
-                price = product.promo_price * ((100 - discount)/100.0)
-                db.session.add(OrderItem(order_id=order.id,
-                                         product_id=product.id,
-                                         price=price,
-                                         quantity=quantity))
-                order.commission += salesperson.commission * ((100 - discount)/100.0) * price
-                item_count += 1
-
-            # Make sure we don't submit an empty order
-            if not errors and item_count == 0:
-                errors['Quantity'].append('At least one item must be selected')
-
-            # Attempt to commit changes
-            if errors:
-                db.session.rollback()
-            else:
-                db.session.commit()
+        products_by_id = dict((product.id, product) for product in products)
+        lines = []
+        for (field, value) in form.data.items():
+            if not field.endswith('_quantity'):
+                continue
+            id_str, _underscore, _quantity = field.partition('_')
+            quantity = value
+            if quantity == 0:
+                continue
+            if not id_str.isdigit() or int(id_str) not in products_by_id:
+                errors['Form ID'].append('Invalid ID')
+                break
+            discount = form.data[id_str + '_discount']
+            lines.append((products_by_id[int(id_str)], quantity, discount))
+        if not errors:
+            (order, errors) = place_order(current_user.employee, client, lines)
+            if order is not None:
                 flash('Order placed')
-        except (Exception), err:
-            errors['Database'].append(err)
-            db.session.rollback()
 
     flash_errors(errors)
     flash_form_errors(form)
@@ -661,7 +892,87 @@ def add_order(client_id):
                            title='Place New Order',
                            client=client,
                            products=products,
-                           form=form)
+                           form=form,
+                           q=q)
+
+###############################################################################
+# Cart - stock reservations
+###############################################################################
+def cart_client(client_id):
+    client = Client.query.filter_by(client_id=client_id,
+                                    salesperson_id=current_user.employee.employee_id).first()
+    if client is None:
+        abort(404)
+    return client
+
+def cart_reservations(client):
+    return Reservation.query.filter_by(client_id=client.client_id,
+                                       salesperson_id=current_user.employee.employee_id).\
+           filter(Reservation.expires_at > datetime.datetime.now()).\
+           order_by(Reservation.created_at).all()
+
+@app.route('/cart/<int:client_id>/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Salesperson'])
+def cart(client_id):
+    client = cart_client(client_id)
+    form = HoldForm()
+    products = Product.query.filter_by(active=True).\
+               filter(Product.quantity - Product.reserved > 0).\
+               order_by(Product.manufacturer, Product.name).all()
+    form.product_id.choices = [(p.id, '%s (%i available)' % (p.description, p.available))
+                               for p in products]
+    if form.validate_on_submit():
+        product = Product.query.filter_by(id=form.product_id.data).first()
+        if form.discount.data > current_user.employee.max_discount:
+            flash('Discount cannot exceed %.2f%%' % (current_user.employee.max_discount))
+        else:
+            try:
+                hold(product, form.quantity.data, client, current_user.employee,
+                     discount=form.discount.data)
+                db.session.commit()
+                flash('Item added to cart')
+                return redirect(url_for('cart', client_id=client_id))
+            except ReservationError, err:
+                db.session.rollback()
+                flash('Error - %s : %s' % (product.description, err))
+    flash_form_errors(form)
+    return render_template('cart.html',
+                           title='Cart for %s' % (client.username),
+                           client=client,
+                           reservations=cart_reservations(client),
+                           form=form,
+                           checkout_form=OrderForm())
+
+@app.route('/cart/<int:client_id>/remove/<int:reservation_id>/')
+@login_required
+@employees_only(['Salesperson'])
+def remove_from_cart(client_id, reservation_id):
+    client = cart_client(client_id)
+    reservation = Reservation.query.filter_by(id=reservation_id,
+                                              client_id=client.client_id,
+                                              salesperson_id=current_user.employee.employee_id).first()
+    if reservation is None:
+        abort(404)
+    release(reservation)
+    db.session.commit()
+    flash('Item removed from cart')
+    return redirect(url_for('cart', client_id=client_id))
+
+@app.route('/cart/<int:client_id>/checkout/', methods=['POST'])
+@login_required
+@employees_only(['Salesperson'])
+def checkout(client_id):
+    client = cart_client(client_id)
+    form = OrderForm()
+    if form.validate_on_submit():
+        (order, errors) = place_order(current_user.employee, client,
+                                      reservations=cart_reservations(client))
+        flash_errors(errors)
+        if order is not None:
+            flash('Order placed')
+            return redirect(url_for('view_order', order_id=order.id))
+    return redirect(url_for('cart', client_id=client_id))
 
 @login_required
 @app.route('/orders/export/<int:order_id>/')
@@ -669,42 +980,34 @@ def export_order(order_id):
     if current_user.is_employee and current_user.employee.title != 'Salesperson':
         abort(404)
     elif current_user.is_employee:
-        order = Order.query.filter(Order.id==order_id, Order.salesperson==current_user.employee.employee_id).first()
+        owner = dict(salesperson_id=current_user.employee.employee_id)
+        order = find_order(order_id, salesperson_ids=[owner['salesperson_id']])
     else:
-        order = Order.query.filter(Order.id==order_id, Order.client==current_user.client.client_id).first()
+        owner = dict(client_id=current_user.client.client_id)
+        order = find_order(order_id, client_id=owner['client_id'])
     if order is None:
         abort(404)
-
-    f = StringIO.StringIO()
-    writer = csv.writer(f)
-    if current_user.employee:
-        writer.writerow(('Timestamp', 'Client', 'Product Manufacturer', 'Product Name', 'Price', 'Quantity'))
-        for item in order.items:
-            writer.writerow((order.timestamp, order.sold_to.username, item.product.manufacturer,
-                             item.product.name, item.product.price, item.product.quantity))
-    else:
-        writer.writerow(('Timestamp', 'Salesperson', 'Product Manufacturer', 'Product Name', 'Price', 'Quantity'))
-        for item in order.items:
-            writer.writerow((order.timestamp, order.sold_by.username, item.product.manufacturer,
-                             item.product.name, item.product.price, item.product.quantity))
-
-    response = make_response(f.getvalue())
-    response.headers["Content-Disposition"] = "attachment;filename=orders.csv"
-    f.close()
-    return response
+    enqueue('order_export', current_user, order_id=order_id, **owner)
+    flash('Your export is being prepared')
+    return redirect(url_for('jobs'))
 
 ###############################################################################
 # Feedback - Likes/Dislikes 
 ###############################################################################
 @login_required
 @app.route('/feedback/')
+@read_only
+@conditional('feedback')
 def feedback():
-    likes = current_user.likes
-    dislikes = current_user.dislikes
+    page = max(request.args.get('page', 1, type=int), 1)
+    summary = feedback_summary(current_user.id)
+    history = feedback_history(current_user.id, page)
     return render_template('feedback.html',
                            title='Feedback',
-                           likes=likes,
-                           dislikes=dislikes)
+                           summary=summary,
+                           history=history,
+                           page=page,
+                           pages=(summary['total'] + HISTORY_PER_PAGE - 1) // HISTORY_PER_PAGE)
 
 @login_required
 @employees_only(['Salesperson'])
@@ -714,14 +1017,8 @@ def like_client(client_user_id):
     client = Client.query.filter_by(user_id=client_user_id, salesperson_id=emp.employee_id).first()
     if client is None:
         abort(404)
-    db.session.add(Feedback(from_user=emp.user_id, to_user=client.user_id,
-                           timestamp=datetime.datetime.now(), is_positive=True))
-    db.session.commit()
+    submit_feedback(emp.user_id, client.user_id, True)
     flash('Like added')
-    last9 = emp.feedback_left_since_banning 
-    if len(last9) == 9 and (False not in last9 or True not in last9):
-        emp.ban()
-
     return redirect(url_for('clients'))
                            
 @login_required
@@ -732,14 +1029,8 @@ def dislike_client(client_user_id):
     client = Client.query.filter_by(user_id=client_user_id, salesperson_id=emp.employee_id).first()
     if client is None:
         abort(404)
-    db.session.add(Feedback(from_user=emp.user_id, to_user=client.user_id,
-                           timestamp=datetime.datetime.now(), is_positive=False))
-    db.session.commit()
+    submit_feedback(emp.user_id, client.user_id, False)
     flash('Disike added')
-    last9 = emp.feedback_left_since_banning 
-    if len(last9) == 9 and (False not in last9 or True not in last9):
-        emp.ban()
-
     return redirect(url_for('clients'))
 
 
@@ -749,14 +1040,8 @@ def like_salesperson():
     if current_user.is_employee:
         abort(404)
     client = current_user.client
-    db.session.add(Feedback(from_user=client.user_id, to_user=client.salesperson.user_id,
-                           timestamp=datetime.datetime.now(), is_positive=True))
-    db.session.commit()
+    submit_feedback(client.user_id, client.salesperson.user_id, True)
     flash('Like added')
-    last9 = client.feedback_left_since_banning 
-    if len(last9) == 9 and (False not in last9 or True not in last9):
-        client.ban()
-
     return redirect('/')
 
 @login_required
@@ -765,14 +1050,8 @@ def dislike_salesperson():
     if current_user.is_employee:
         abort(404)
     client = current_user.client
-    db.session.add(Feedback(from_user=client.user_id, to_user=client.salesperson.user_id,
-                           timestamp=datetime.datetime.now(), is_positive=False))
-    db.session.commit()
+    submit_feedback(client.user_id, client.salesperson.user_id, False)
     flash('Disike added')
-    last9 = client.feedback_left_since_banning 
-    if len(last9) == 9 and (False not in last9 or True not in last9):
-        client.ban()
-
     return redirect('/')
 
 ###############################################################################
@@ -828,20 +1107,23 @@ def apply_payment(order_id):
         abort(404)
 
     # Make sure this order has not already been paid
-    if order.balance <= 0:
+    balance = order.balance
+    if balance <= 0:
         flash('Payment not applied. This order has a zero balance')
         return redirect(url_for('orders'))
 
     # Record payment
     form = PaymentForm()
     if form.validate_on_submit():
-        if form.amount.data > order.balance:
+        if form.amount.data > balance:
             flash('Payment amount exceeds outstanding balance')
         else:
             payment = Payment(order_id=order_id,
                               amount=form.amount.data,
                               timestamp=datetime.datetime.now())
             db.session.add(payment)
+            record_event(PAYMENT_APPLIED, order_id=order_id, amount=payment.amount)
+            bump_version('payments')
             db.session.commit()
             flash('Payment added')
             return redirect(url_for('orders'))
@@ -850,34 +1132,292 @@ def apply_payment(order_id):
                            title='Make Payment',
                            form=form)
 
+@app.route('/orders/pay/batch/', methods=['GET', 'POST'])
+@login_required
+@employees_only(['Manager'])
+def apply_payment_batch():
+    form = BatchPaymentForm()
+    if form.validate_on_submit():
+        lines = parse_remittance(form.remittance.data.stream)
+        try:
+            apply_remittance(current_user.employee, lines)
+        except (Exception), err:
+            flash('Error - Database : %s' % (err))
+        else:
+            return render_template('batch_payment_report.html',
+                                   title='Payment Reconciliation',
+                                   lines=lines,
+                                   summary=reconciliation_summary(lines))
+    flash_form_errors(form)
+    return render_template('add_batch_payment.html',
+                           title='Apply Remittance File',
+                           form=form)
+
+###############################################################################
+# Reports
+###############################################################################
+@app.route('/versions/')
+@login_required
+@read_only
+def versions():
+    """Current ETags of the resources behind the cacheable pages, so a
+    client can poll cheaply and only reload a page when its tag moves."""
+    resources = ['catalog', 'promotions', 'orders', 'feedback']
+    if current_user.is_employee and current_user.employee.title != 'Salesperson':
+        resources.append('team')
+    return jsonify(stamps(resources, current_user.id))
+
+@app.route('/metrics/')
+@login_required
+@employees_only(['Director'])
+def metrics():
+    return jsonify(fragment_cache=fragment_cache.stats(),
+                   rate_limits=rate_limiter.stats())
+
+def aging_employee():
+    """The current employee, or someone below them chosen with ?employee_id=."""
+    emp = current_user.employee
+    employee_id = request.args.get('employee_id', type=int)
+    if employee_id is not None and employee_id != emp.employee_id:
+        if employee_id not in emp.subtree_ids():
+            abort(404)
+        emp = Employee.query.filter_by(employee_id=employee_id).first()
+    return emp
+
+@app.route('/reports/aging/')
+@login_required
+@employees_only(['Manager', 'Director'])
+@read_only
+def ar_aging_report():
+    emp = aging_employee()
+    report = cached_ar_aging(emp)
+    return render_template('ar_aging.html',
+                           title='Accounts Receivable Aging',
+                           employee=emp,
+                           buckets=AGING_BUCKETS,
+                           report=report)
+
+@app.route('/reports/aging/export/')
+@login_required
+@employees_only(['Manager', 'Director'])
+def export_ar_aging():
+    enqueue('aging_export', current_user, employee_id=aging_employee().employee_id)
+    flash('Your export is being prepared')
+    return redirect(url_for('jobs'))
+
+def parse_date(value, default):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return default
+
+@app.route('/reports/sales/')
+@login_required
+@employees_only()
+@read_only
+def sales_report():
+    emp = current_user.employee
+    today = datetime.date.today()
+    grain = request.args.get('grain', 'day')
+    if grain not in GRAINS:
+        grain = 'day'
+    start = parse_date(request.args.get('start'), today - datetime.timedelta(days=30))
+    end = parse_date(request.args.get('end'), today)
+    dimensions = [d for d in DIMENSIONS if d in request.args.getlist('by')]
+    rows = query_cube(grain, start, end, dimensions,
+                      salesperson_ids=emp.subtree_ids(),
+                      product_id=request.args.get('product_id', type=int),
+                      client_id=request.args.get('client_id', type=int))
+    return render_template('sales_cube.html',
+                           title='Sales History',
+                           grains=GRAINS,
+                           all_dimensions=DIMENSIONS,
+                           grain=grain,
+                           start=start,
+                           end=end,
+                           dimensions=dimensions,
+                           labels=dimension_labels(rows, dimensions),
+                           rows=rows)
+
+@app.route('/reports/sales/rebuild/', methods=['POST'])
+@login_required
+@employees_only(['Director'])
+def rebuild_sales_cube():
+    enqueue('cube_rebuild', current_user)
+    flash('The sales history will be rebuilt in the background')
+    return redirect(url_for('jobs'))
+
+def commission_statements(emp):
+    """Returns (periods, selected period, statements) for the employee's
+    subtree. The period is chosen with start/end query arguments and
+    defaults to the most recent payout run."""
+    periods = db.session.query(CommissionStatement.period_start, CommissionStatement.period_end).\
+              distinct().order_by(CommissionStatement.period_start.desc()).all()
+    start = parse_date(request.args.get('start'), None)
+    end = parse_date(request.args.get('end'), None)
+    if (start, end) not in periods:
+        if not periods:
+            return periods, None, []
+        (start, end) = periods[0]
+    statements = CommissionStatement.query.\
+                 filter_by(period_start=start, period_end=end).\
+                 filter(CommissionStatement.employee_id.in_(emp.subtree_ids())).\
+                 order_by(CommissionStatement.total.desc()).all()
+    return periods, (start, end), statements
+
+@app.route('/reports/commissions/')
+@login_required
+@employees_only(['Manager', 'Director'])
+@read_only
+def commission_report():
+    (periods, period, statements) = commission_statements(current_user.employee)
+    return render_template('commissions.html',
+                           title='Commission Statements',
+                           periods=periods,
+                           period=period,
+                           statements=statements)
+
+@app.route('/reports/commissions/export/')
+@login_required
+@employees_only(['Manager', 'Director'])
+def export_commissions():
+    (periods, period, statements) = commission_statements(current_user.employee)
+    if period is None:
+        abort(404)
+    enqueue('commission_export', current_user, employee_id=current_user.employee.employee_id,
+            start=period[0].isoformat(), end=period[1].isoformat())
+    flash('Your export is being prepared')
+    return redirect(url_for('jobs'))
+
+###############################################################################
+# Background jobs
+###############################################################################
+def user_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if job is None:
+        abort(404)
+    return job
+
+@app.route('/jobs/')
+@login_required
+def jobs():
+    job_list = Job.query.filter_by(user_id=current_user.id).order_by(Job.id.desc()).limit(50).all()
+    return render_template('jobs.html',
+                           title='Downloads',
+                           jobs=job_list,
+                           pending=any(job.status in ('queued', 'running') for job in job_list))
+
+@app.route('/jobs/<int:job_id>/')
+@login_required
+def job_progress(job_id):
+    """Status and progress of one job, for polling."""
+    job = user_job(job_id)
+    status = job_status(job)
+    if job.status == 'done' and job.result_name:
+        status['download_url'] = url_for('download_job', job_id=job.id)
+    return jsonify(status)
+
+@app.route('/jobs/<int:job_id>/download/')
+@login_required
+def download_job(job_id):
+    job = user_job(job_id)
+    if job.status == 'expired':
+        abort(410)
+    if job.status != 'done' or not job.result_name:
+        abort(404)
+    return send_file(result_path(job), as_attachment=True, attachment_filename=job.result_name)
+
 ###############################################################################
 # Popular Products Helpers 
 ###############################################################################
 def popular_customer_products(customer_id):
-    all_counter = defaultdict(int)
-    cust_counter = defaultdict(int)
-    for item in OrderItem.query.all():
-        if item.product.active:
-            all_counter[item.product_id] += item.quantity
-            if item.order and item.order.client == customer_id:
-                cust_counter[item.product_id] += item.quantity
-
-    if len(cust_counter) >= 3:
-       counter = cust_counter
-    else:
-       counter = all_counter
-
-    product_ids = [k for (k, v) in sorted(counter.items(), key=lambda (k, v): v)][:3]
-    return [p for p in Product.query.all() if p.id in product_ids]
+    """The client's three best sellers, or the overall ones for clients
+    who have bought fewer than three products."""
+    products = popular_products(SCOPE_CLIENT, customer_id)
+    if len(products) < 3:
+        products = popular_products(SCOPE_ALL)
+    return products
 
 def popular_salesperson_products(employee):
-    counter = defaultdict(int) 
-    for order in employee.orders:
-        for item in order.items:
-            if item.product.active:
-                counter[item.product.id] += item.quantity
-    popular = sorted(counter.keys(), 
-                     key=lambda item_id: counter[item_id],
-                     reverse=True)[:3]
-    return Product.query.filter(Product.id.in_(tuple(popular))).all()
+    return popular_products(SCOPE_SALESPERSON, employee.employee_id)
+
+###############################################################################
+# JSON API v1
+###############################################################################
+@app.errorhandler(400)
+@app.errorhandler(401)
+@app.errorhandler(404)
+@app.errorhandler(405)
+def api_error(err):
+    if not request.path.startswith('/api/'):
+        return err
+    response = jsonify(error=err.name)
+    response.status_code = err.code
+    return response
 
+@app.route('/api/v1/login', methods=['POST'])
+def api_login():
+    data = request.get_json(silent=True) or {}
+    user = db.session.query(User).filter_by(username=data.get('username')).first()
+    if not password_matches(user, data.get('password')) or not user.is_active():
+        response = jsonify(error='Invalid credentials')
+        response.status_code = 401
+        return response
+    login_user(user, remember=True)
+    return jsonify(user_id=user.id, username=user.username, is_employee=user.is_employee)
+
+@app.route('/api/v1/products')
+@api_view
+def api_products():
+    """?ids=1,2,3 fetches a batch; otherwise pages through the catalog
+    with ?cursor=&limit=."""
+    ids = id_list()
+    if ids is not None:
+        return get_products(ids)
+    return list_products(*page_args())
+
+@app.route('/api/v1/clients')
+@api_view
+@employees_only()
+def api_clients():
+    """Clients of the current employee's part of the hierarchy, by
+    ?ids=, by search ?q= or paged with ?cursor=&limit=."""
+    ids = id_list()
+    if ids is not None:
+        return get_clients(current_user.employee, ids)
+    (cursor, limit) = page_args()
+    return list_clients(current_user.employee, cursor, limit, request.args.get('q', '').strip())
+
+@app.route('/api/v1/orders', methods=['GET', 'POST'])
+@api_view
+def api_orders():
+    """GET fetches orders by ?ids= or pages through them with
+    ?cursor=&limit=. POST places a batch of orders for a salesperson:
+    {"orders": [{"client_id": 1, "lines": [{"product_id": 2,
+    "quantity": 3, "discount": 0}]}]}."""
+    if request.method == 'POST':
+        if not current_user.is_employee or current_user.employee.title != 'Salesperson':
+            abort(401)
+        data = request.get_json(silent=True)
+        if data is None:
+            raise ApiError('Expected a JSON body')
+        results = create_orders(current_user.employee, data.get('orders'))
+        created = len([result for result in results if 'order_id' in result])
+        return dict(results=results, created=created), (201 if created else 400)
+    scope = OrderScope(current_user)
+    ids = id_list()
+    if ids is not None:
+        return get_orders(scope, ids)
+    return list_orders(scope, *page_args())
+
+@app.route('/api/v1/changes')
+@api_view
+@employees_only(['Director'])
+@read_only
+def api_changes():
+    """Inserts, updates and deletes of orders, payments, products and
+    clients after ?since=<cursor>, in commit order, up to ?limit= at a
+    time. ?wait=<seconds> long-polls: an empty feed is held open until
+    something changes. Start from since=0 and pass back the cursor of
+    each response to resume exactly where the last one stopped."""
+    return change_feed(*change_args())
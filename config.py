@@ -6,8 +6,68 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 # Specify SQLite parameters for SQLAlchemy
 SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % (os.path.join(basedir, 'app.db'))
 
+# Report pages read through a separate read-only connection (routing.py).
+# The read URI defaults to the primary database; point it at a replica
+# file to move report reads off the primary altogether.
+SQLALCHEMY_READ_ROUTING = True
+SQLALCHEMY_READ_DATABASE_URI = None
+
+# Fully paid orders older than ARCHIVE_AFTER_DAYS are moved into this file
+# by 'manage.py archive'. It is attached to every connection as the
+# 'archive' schema, see archive.py.
+ARCHIVE_DATABASE = os.path.join(basedir, 'archive.db')
+ARCHIVE_AFTER_DAYS = 365
+SQLALCHEMY_ATTACH = {'archive': ARCHIVE_DATABASE}
+
 # Set the locate of SQLAlchemy migration files
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 
 WTF_CSRF_ENABLED = True
 SECRET_KEY = 'not enough entropy'
+
+# Stock reservations (cart holds)
+RESERVATION_TTL_MINUTES = 30
+RESERVATION_SWEEP_SECONDS = 60
+
+# Replenishment: purchase orders are written as CSV files to the outbox
+PURCHASE_ORDER_OUTBOX = os.path.join(basedir, 'outbox')
+REPLENISHMENT_INTERVAL_SECONDS = 300
+
+# How often each web worker brings the event log projections up to date,
+# see events.py
+EVENT_CONSUMER_INTERVAL_SECONDS = 10
+
+# Background jobs run by 'manage.py worker', see jobs.py. Result files are
+# kept for JOB_RESULT_TTL_HOURS. A running job's worker updates its
+# heartbeat every JOB_HEARTBEAT_SECONDS; a job with no heartbeat for
+# JOB_TIMEOUT_SECONDS is assumed to have lost its worker and is retried.
+JOB_RESULTS_DIR = os.path.join(basedir, 'tmp', 'jobs')
+JOB_RESULT_TTL_HOURS = 24
+JOB_HEARTBEAT_SECONDS = 30
+JOB_TIMEOUT_SECONDS = 300
+
+# Likes and dislikes that arrive while another is being written are
+# committed together, up to FEEDBACK_BATCH_SIZE rows at a time, see
+# feedback.py. A size of 1 or None writes each one in its own request.
+FEEDBACK_BATCH_SIZE = 200
+
+# Token buckets for expensive endpoints, see ratelimit.py: endpoint ->
+# (burst, refill per minute, methods charged or None for all), applied to
+# each client IP and each logged in user. Only login attempts are charged,
+# not the login page itself. RATE_LIMIT_FILE shares the buckets between
+# worker processes; None keeps them per process.
+RATE_LIMITS = {
+    'login': (10, 10, ('POST',)),
+    'api_login': (10, 10, ('POST',)),
+    'like_client': (30, 30, None),
+    'dislike_client': (30, 30, None),
+    'like_salesperson': (5, 5, None),
+    'dislike_salesperson': (5, 5, None),
+}
+RATE_LIMIT_FILE = None
+
+# Rendered template fragments kept in memory per process, see fragments.py
+FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+
+# Compiled Jinja templates, shared by all workers. None disables the cache.
+TEMPLATE_BYTECODE_CACHE = os.path.join(basedir, 'tmp', 'jinja')
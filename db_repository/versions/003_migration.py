@@ -0,0 +1,72 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+feedback = Table('feedback', pre_meta,
+    Column('from_user', String(length=32), primary_key=True, nullable=False),
+    Column('to_user', String(length=32), primary_key=True, nullable=False),
+    Column('timestamp', DateTime, primary_key=True, nullable=False),
+    Column('is_positive', Boolean, nullable=False),
+)
+
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+feedback = Table('feedback', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('from_user', Integer, ForeignKey('user.id'), nullable=False),
+    Column('to_user', Integer, ForeignKey('user.id'), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('is_positive', Boolean, nullable=False),
+)
+Index('ix_feedback_to_user_timestamp', feedback.c.to_user, feedback.c.timestamp)
+Index('ix_feedback_from_user_timestamp', feedback.c.from_user, feedback.c.timestamp)
+
+# The views stored user ids in the string columns, but rows written before
+# user ids existed hold user names. Each value is matched against both;
+# rows whose users no longer exist cannot be keyed and are dropped.
+USER_ID = """coalesce((SELECT id FROM user WHERE CAST(id AS TEXT) = {0}),
+                      (SELECT id FROM user WHERE username = {0}))"""
+
+UPGRADE = """INSERT INTO feedback (from_user, to_user, timestamp, is_positive)
+SELECT from_user, to_user, timestamp, is_positive FROM
+  (SELECT {0} AS from_user, {1} AS to_user, timestamp, is_positive
+   FROM feedback_old)
+WHERE from_user IS NOT NULL AND to_user IS NOT NULL
+ORDER BY timestamp""".format(USER_ID.format('feedback_old.from_user'),
+                             USER_ID.format('feedback_old.to_user'))
+
+DOWNGRADE = """INSERT OR IGNORE INTO feedback (from_user, to_user, timestamp, is_positive)
+SELECT CAST(from_user AS TEXT), CAST(to_user AS TEXT), timestamp, is_positive
+FROM feedback_old"""
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # SQLite cannot change a column's type or a table's primary key in
+    # place, so the table is rebuilt
+    (old, new) = (pre_meta.tables['feedback'], post_meta.tables['feedback'])
+    old.rename('feedback_old')
+    new.create()
+    migrate_engine.execute(UPGRADE)
+    migrate_engine.execute('DROP TABLE feedback_old')
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    (old, new) = (post_meta.tables['feedback'], pre_meta.tables['feedback'])
+    # The indexes would move with the renamed table
+    for index in old.indexes:
+        index.drop()
+    old.rename('feedback_old')
+    new.create()
+    migrate_engine.execute(DOWNGRADE)
+    migrate_engine.execute('DROP TABLE feedback_old')
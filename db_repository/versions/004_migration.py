@@ -0,0 +1,43 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+
+# Follow-up: the columns start at zero; run
+# 'manage.py rebuild-feedback-windows' after upgrading to fill them in from
+# the feedback table.
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('username', String(length=32)),
+    Column('password_hash', Binary(length=60), nullable=False),
+    Column('is_employee', Boolean, nullable=False),
+    Column('active', Boolean, nullable=False),
+    Column('banned', Boolean, default=ColumnDefault(False)),
+    Column('last_banning', DateTime),
+    Column('given_window', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+    Column('given_since_ban', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+    Column('received_window', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+    Column('received_since_ban', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+    Column('dislikes_since_ban', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+)
+
+WINDOW_COLUMNS = ('given_window', 'given_since_ban', 'received_window', 'received_since_ban', 'dislikes_since_ban')
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in WINDOW_COLUMNS:
+        post_meta.tables['user'].columns[name].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in WINDOW_COLUMNS:
+        post_meta.tables['user'].columns[name].drop()
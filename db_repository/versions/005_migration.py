@@ -0,0 +1,49 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('reserved', Integer, nullable=False, default=ColumnDefault(0), server_default='0'),
+)
+
+client = Table('client', post_meta,
+    Column('client_id', Integer, primary_key=True, nullable=False),
+)
+
+employee = Table('employee', post_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+reservation = Table('reservation', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('product_id', Integer, ForeignKey('product.id'), nullable=False, index=True),
+    Column('client_id', Integer, ForeignKey('client.client_id'), nullable=False),
+    Column('salesperson_id', Integer, ForeignKey('employee.employee_id'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    Column('discount', Integer, nullable=False, default=ColumnDefault(0)),
+    Column('created_at', DateTime, nullable=False),
+    Column('expires_at', DateTime, nullable=False, index=True),
+)
+Index('ix_reservation_cart', reservation.c.salesperson_id, reservation.c.client_id)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # No holds exist yet, so every product starts with nothing reserved
+    post_meta.tables['product'].columns['reserved'].create()
+    post_meta.tables['reservation'].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['reservation'].drop()
+    post_meta.tables['product'].columns['reserved'].drop()
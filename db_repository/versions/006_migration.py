@@ -0,0 +1,54 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('reorder_point', Integer),
+    Column('reorder_quantity', Integer),
+    Column('lead_time_days', Integer),
+)
+
+purchase_order = Table('purchase_order', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('filename', String(length=255), nullable=False),
+)
+
+replenishment_request = Table('replenishment_request', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('product_id', Integer, ForeignKey('product.id'), nullable=False),
+    Column('quantity', Integer, nullable=False),
+    Column('status', Enum('pending', 'ordered', 'received'), nullable=False),
+    Column('requested_at', DateTime, nullable=False),
+    Column('expected_at', DateTime),
+    Column('purchase_order_id', Integer, ForeignKey('purchase_order.id')),
+)
+Index('ix_replenishment_status', replenishment_request.c.status, replenishment_request.c.product_id)
+
+REORDER_COLUMNS = ('reorder_point', 'reorder_quantity', 'lead_time_days')
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # Without a reorder point a product is never reordered automatically,
+    # so existing products keep their current behaviour
+    for name in REORDER_COLUMNS:
+        post_meta.tables['product'].columns[name].create()
+    post_meta.tables['purchase_order'].create(checkfirst=True)
+    post_meta.tables['replenishment_request'].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['replenishment_request'].drop()
+    post_meta.tables['purchase_order'].drop()
+    for name in REORDER_COLUMNS:
+        post_meta.tables['product'].columns[name].drop()
@@ -0,0 +1,70 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', pre_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+promotion = Table('promotion', pre_meta,
+    Column('product_id', Integer, ForeignKey('product.id'), primary_key=True, nullable=False),
+    Column('discount', Float, nullable=False, unique=True),
+)
+
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+promotion = Table('promotion', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('product_id', Integer, ForeignKey('product.id'), index=True),
+    Column('manufacturer', String(length=64), index=True),
+    Column('discount', Float),
+    Column('percent_off', Float),
+    Column('starts_at', DateTime),
+    Column('ends_at', DateTime),
+)
+
+# Existing promotions become open-ended promotional prices for their product
+UPGRADE = """INSERT INTO promotion (product_id, discount)
+SELECT product_id, discount FROM promotion_old ORDER BY product_id"""
+
+# The old table holds one price per product and no manufacturer-wide or
+# scheduled promotions. The latest promotion of each product is kept;
+# manufacturer promotions, and prices already taken by another product,
+# are lost.
+DOWNGRADE = """INSERT OR IGNORE INTO promotion (product_id, discount)
+SELECT product_id, discount FROM promotion_old
+WHERE id IN (SELECT max(id) FROM promotion_old
+             WHERE product_id IS NOT NULL AND discount IS NOT NULL
+             GROUP BY product_id)"""
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # SQLite cannot change a table's primary key in place, so the table is
+    # rebuilt and the live promotions copied across
+    (old, new) = (pre_meta.tables['promotion'], post_meta.tables['promotion'])
+    old.rename('promotion_old')
+    new.create()
+    migrate_engine.execute(UPGRADE)
+    migrate_engine.execute('DROP TABLE promotion_old')
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    (old, new) = (post_meta.tables['promotion'], pre_meta.tables['promotion'])
+    # The indexes would move with the renamed table
+    for index in old.indexes:
+        index.drop()
+    old.rename('promotion_old')
+    new.create()
+    migrate_engine.execute(DOWNGRADE)
+    migrate_engine.execute('DROP TABLE promotion_old')
@@ -0,0 +1,42 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+job = Table('job', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('kind', String(length=32), nullable=False),
+    Column('params', Text, nullable=False),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False, index=True),
+    Column('status', Enum('queued', 'running', 'done', 'failed', 'expired'), nullable=False),
+    Column('progress', Float, nullable=False, default=ColumnDefault(0.0)),
+    Column('message', String(length=255)),
+    Column('attempts', Integer, nullable=False, default=ColumnDefault(0)),
+    Column('worker', String(length=64)),
+    Column('created_at', DateTime, nullable=False),
+    Column('started_at', DateTime),
+    Column('finished_at', DateTime),
+    Column('expires_at', DateTime),
+    Column('result_name', String(length=128)),
+)
+Index('ix_job_status', job.c.status, job.c.id)
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['job'].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['job'].drop()
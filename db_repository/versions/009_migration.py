@@ -0,0 +1,53 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+client = Table('client', post_meta,
+    Column('client_id', Integer, primary_key=True, nullable=False),
+)
+
+employee = Table('employee', post_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+order = Table('order', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('client', Integer, ForeignKey('client.client_id'), nullable=False),
+    Column('salesperson', Integer, ForeignKey('employee.employee_id'), nullable=False),
+    Column('commission', Float, nullable=False),
+)
+ORDER_INDEXES = (
+    Index('ix_order_timestamp', order.c.timestamp),
+    Index('ix_order_client', order.c.client),
+    Index('ix_order_salesperson', order.c.salesperson),
+)
+
+data_version = Table('data_version', post_meta,
+    Column('name', String(length=64), primary_key=True, nullable=False),
+    Column('version', Integer, nullable=False, default=ColumnDefault(0)),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # No row reads as version 0, so the table can start out empty
+    post_meta.tables['data_version'].create(checkfirst=True)
+    for index in ORDER_INDEXES:
+        index.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for index in ORDER_INDEXES:
+        index.drop()
+    post_meta.tables['data_version'].drop()
@@ -0,0 +1,50 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+
+# Follow-up: the cube starts out empty; run 'manage.py rebuild-cube' after
+# upgrading to fill it in from the existing orders.
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+client = Table('client', post_meta,
+    Column('client_id', Integer, primary_key=True, nullable=False),
+)
+
+employee = Table('employee', post_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+sales_cube = Table('sales_cube', post_meta,
+    Column('grain', Enum('day', 'week', 'month'), primary_key=True, nullable=False),
+    Column('period', Date, primary_key=True, nullable=False),
+    Column('product_id', Integer, ForeignKey('product.id'), primary_key=True, nullable=False),
+    Column('salesperson_id', Integer, ForeignKey('employee.employee_id'), primary_key=True, nullable=False),
+    Column('client_id', Integer, ForeignKey('client.client_id'), primary_key=True, nullable=False),
+    Column('quantity', Integer, nullable=False, default=ColumnDefault(0)),
+    Column('revenue', Float, nullable=False, default=ColumnDefault(0.0)),
+    Column('lines', Integer, nullable=False, default=ColumnDefault(0)),
+)
+Index('ix_sales_cube_product', sales_cube.c.grain, sales_cube.c.product_id, sales_cube.c.period)
+Index('ix_sales_cube_salesperson', sales_cube.c.grain, sales_cube.c.salesperson_id, sales_cube.c.period)
+Index('ix_sales_cube_client', sales_cube.c.grain, sales_cube.c.client_id, sales_cube.c.period)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['sales_cube'].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['sales_cube'].drop()
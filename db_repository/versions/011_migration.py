@@ -0,0 +1,40 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+employee = Table('employee', post_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+commission_statement = Table('commission_statement', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('period_start', Date, nullable=False),
+    Column('period_end', Date, nullable=False),
+    Column('employee_id', Integer, ForeignKey('employee.employee_id'), nullable=False),
+    Column('commission_rate', Float, nullable=False),
+    Column('own_sales', Float, nullable=False),
+    Column('own_commission', Float, nullable=False),
+    Column('team_sales', Float, nullable=False),
+    Column('override_commission', Float, nullable=False),
+    Column('total', Float, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    UniqueConstraint('period_start', 'period_end', 'employee_id'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['commission_statement'].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['commission_statement'].drop()
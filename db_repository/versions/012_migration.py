@@ -0,0 +1,56 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+
+# Follow-up: the log starts out empty; run 'manage.py consume-events --seed'
+# after upgrading, before any new order is placed, to turn the existing
+# orders into events and fill in product_popularity from them.
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+event = Table('event', post_meta,
+    Column('seq', Integer, primary_key=True, nullable=False),
+    Column('kind', String(length=32), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('data', Text, nullable=False),
+    sqlite_autoincrement=True,
+)
+
+event_checkpoint = Table('event_checkpoint', post_meta,
+    Column('consumer', String(length=64), primary_key=True, nullable=False),
+    Column('position', Integer, nullable=False, default=ColumnDefault(0)),
+    Column('updated_at', DateTime, nullable=False),
+)
+
+product_popularity = Table('product_popularity', post_meta,
+    Column('scope', Enum('all', 'client', 'salesperson'), primary_key=True, nullable=False),
+    Column('scope_id', Integer, primary_key=True, nullable=False),
+    Column('product_id', Integer, ForeignKey('product.id'), primary_key=True, nullable=False),
+    Column('quantity', Integer, nullable=False, default=ColumnDefault(0)),
+)
+Index('ix_product_popularity_rank', product_popularity.c.scope, product_popularity.c.scope_id,
+      product_popularity.c.quantity)
+
+TABLES = ('event', 'event_checkpoint', 'product_popularity')
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in TABLES:
+        post_meta.tables[name].create(checkfirst=True)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for name in reversed(TABLES):
+        post_meta.tables[name].drop()
@@ -0,0 +1,28 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+product = Table('product', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('manufacturer', String(length=64), nullable=False),
+    Column('name', String(length=64), nullable=False),
+)
+catalog = Index('ix_product_catalog', product.c.manufacturer, product.c.name)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    catalog.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    catalog.drop()
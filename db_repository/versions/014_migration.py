@@ -0,0 +1,100 @@
+import os
+
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+
+from config import ARCHIVE_DATABASE
+
+pre_meta = MetaData()
+post_meta = MetaData()
+client = Table('client', pre_meta,
+    Column('client_id', Integer, primary_key=True, nullable=False),
+)
+
+employee = Table('employee', pre_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+order = Table('order', pre_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime, nullable=False, index=True),
+    Column('client', Integer, ForeignKey('client.client_id'), nullable=False, index=True),
+    Column('salesperson', Integer, ForeignKey('employee.employee_id'), nullable=False, index=True),
+    Column('commission', Float, nullable=False),
+)
+
+client = Table('client', post_meta,
+    Column('client_id', Integer, primary_key=True, nullable=False),
+)
+
+employee = Table('employee', post_meta,
+    Column('employee_id', Integer, primary_key=True, nullable=False),
+)
+
+order = Table('order', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('timestamp', DateTime, nullable=False, index=True),
+    Column('client', Integer, ForeignKey('client.client_id'), nullable=False, index=True),
+    Column('salesperson', Integer, ForeignKey('employee.employee_id'), nullable=False, index=True),
+    Column('commission', Float, nullable=False),
+    sqlite_autoincrement=True,
+)
+
+COPY = """INSERT INTO "order" (id, timestamp, client, salesperson, commission)
+SELECT id, timestamp, client, salesperson, commission FROM order_old ORDER BY id"""
+
+# Copying the orders starts the sequence at the highest hot id, but orders
+# above it may already have been archived and must not be handed out again
+SEED = """INSERT INTO sqlite_sequence (name, seq)
+SELECT 'order', seq FROM (SELECT max(id) AS seq FROM
+                          (SELECT id FROM main."order" UNION ALL SELECT id FROM archive."order"))
+WHERE seq IS NOT NULL"""
+
+def rebuild(connection, old, new):
+    """Rebuilds the order table from old to new."""
+    # Leave order_item, payment and reservation referring to "order" rather
+    # than following the rename to order_old
+    connection.execute('PRAGMA legacy_alter_table = ON')
+    # The indexes would move with the renamed table
+    for index in old.indexes:
+        index.drop(bind=connection)
+    connection.execute('ALTER TABLE "order" RENAME TO order_old')
+    new.create(bind=connection)
+    connection.execute(COPY)
+    connection.execute('DROP TABLE order_old')
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # Without AUTOINCREMENT SQLite hands out max(id) + 1, which reuses the
+    # ids of orders once the highest of them have been archived. The
+    # pragma holds per connection, so everything runs on one.
+    connection = migrate_engine.connect()
+    try:
+        rebuild(connection, pre_meta.tables['order'], post_meta.tables['order'])
+        if os.path.exists(ARCHIVE_DATABASE):
+            connection.execute('ATTACH DATABASE ? AS archive', ARCHIVE_DATABASE)
+            archived = connection.execute("SELECT count(*) FROM archive.sqlite_master "
+                                          "WHERE type = 'table' AND name = 'order'").scalar()
+            if archived:
+                connection.execute("DELETE FROM sqlite_sequence WHERE name = 'order'")
+                connection.execute(SEED)
+            connection.execute('DETACH DATABASE archive')
+    finally:
+        connection.close()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    connection = migrate_engine.connect()
+    try:
+        rebuild(connection, post_meta.tables['order'], pre_meta.tables['order'])
+    finally:
+        connection.close()
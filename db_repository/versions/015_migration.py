@@ -0,0 +1,59 @@
+import os
+
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+
+from config import ARCHIVE_DATABASE
+
+pre_meta = MetaData()
+post_meta = MetaData()
+
+# Directors made by 'manage.py createadmin' got a rate of 0.05, meant as a
+# fraction, while Employee.commission is a percentage
+DIRECTOR_RATES = """UPDATE employee SET commission = commission * 100
+WHERE title = 'Director' AND commission = 0.05"""
+
+# Orders stored the rate as a fraction of the line price, discounted a
+# second time and regardless of quantity. They are recomputed from their
+# lines at the salesperson's current rate.
+ORDER_COMMISSIONS = """UPDATE %(schema)s."order"
+SET commission = (SELECT employee.commission FROM main.employee
+                  WHERE employee.employee_id = %(schema)s."order".salesperson) / 100.0 *
+                 coalesce((SELECT sum(price * quantity) FROM %(schema)s.order_item
+                           WHERE order_item.order_id = %(schema)s."order".id), 0)
+WHERE EXISTS (SELECT 1 FROM main.employee
+              WHERE employee.employee_id = %(schema)s."order".salesperson)"""
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    connection = migrate_engine.connect()
+    try:
+        with connection.begin():
+            connection.execute(DIRECTOR_RATES)
+            connection.execute(ORDER_COMMISSIONS % dict(schema='main'))
+        if os.path.exists(ARCHIVE_DATABASE):
+            connection.execute('ATTACH DATABASE ? AS archive', ARCHIVE_DATABASE)
+            archived = connection.execute("SELECT count(*) FROM archive.sqlite_master "
+                                          "WHERE type = 'table' AND name = 'order'").scalar()
+            if archived:
+                connection.execute(ORDER_COMMISSIONS % dict(schema='archive'))
+            connection.execute('DETACH DATABASE archive')
+    finally:
+        connection.close()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # The old order commissions cannot be recovered and are left as they
+    # are; only the default director rate goes back
+    migrate_engine.execute("UPDATE employee SET commission = commission / 100 "
+                           "WHERE title = 'Director' AND commission = 5.0")
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
-from flask.ext.script import Command, Manager, Shell
+import datetime
+import os
+import sys
+import time
 
-from app import app, bcrypt, db, forms, models
+from flask.ext.script import Command, Manager, Option, Shell
+
+from app import (
+    app, archive, bcrypt, catalog, commissions, cube, db, events, feedback, forms, jobs, models, payments,
+    replenishment, reservations
+)
 
 manager = Manager(app)
 def _make_context():
@@ -47,10 +55,290 @@ class CreateAdminScript(Command):
 
         print 'Admin added'
 
+class ApplyPaymentsScript(Command):
+    """Applies a remittance CSV of order_id,amount[,timestamp] lines on
+    behalf of a manager and prints the reconciliation report."""
+    option_list = (
+        Option('--manager', '-m', dest='username', required=True),
+        Option('--file', '-f', dest='path', required=True),
+        Option('--report', '-r', dest='report', default=None),
+    )
+
+    def run(self, username, path, report):
+        employee = models.Employee.query.filter_by(username=username).first()
+        if employee is None or employee.title != 'Manager':
+            print 'No manager named %r' % (username)
+            return 1
+
+        with open(path, 'rb') as fin:
+            lines = payments.parse_remittance(fin)
+        payments.apply_remittance(employee, lines)
+
+        if report is None:
+            payments.write_reconciliation(lines, sys.stdout)
+        else:
+            with open(report, 'wb') as fout:
+                payments.write_reconciliation(lines, fout)
+        for (status, totals) in sorted(payments.reconciliation_summary(lines).items()):
+            print '%-8s %6i lines  $%.2f' % (status, totals['count'], totals['amount'])
+
+class RebuildCubeScript(Command):
+    """Recomputes the sales cube from the order tables."""
+    def run(self):
+        cells = cube.rebuild()
+        print 'Sales cube rebuilt with %i cells' % (cells)
+
+class BenchmarkCubeScript(Command):
+    """Compares a sales cube query with aggregating OrderItem directly."""
+    option_list = (
+        Option('--grain', '-g', dest='grain', default='week', choices=cube.GRAINS),
+        Option('--days', '-d', dest='days', type=int, default=365),
+        Option('--repeat', '-n', dest='repeat', type=int, default=5),
+    )
+
+    def run(self, grain, days, repeat):
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=days)
+        (cube_time, base_time, rows) = cube.benchmark(grain, start, end, repeat=repeat)
+        print '%i %s buckets x product x salesperson x client, %s to %s' % (rows, grain, start, end)
+        print 'sales cube:  %8.2f ms' % (cube_time * 1000)
+        print 'order items: %8.2f ms' % (base_time * 1000)
+        if cube_time > 0:
+            print 'speedup:     %8.1fx' % (base_time / cube_time)
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+class PayoutsScript(Command):
+    """Computes commission statements for every employee for a period
+    (inclusive dates) and optionally exports them as CSV."""
+    option_list = (
+        Option('--start', '-s', dest='start', type=_parse_date, required=True),
+        Option('--end', '-e', dest='end', type=_parse_date, required=True),
+        Option('--export', '-x', dest='export', default=None),
+    )
+
+    def run(self, start, end, export):
+        began = datetime.datetime.now()
+        statements = commissions.run_payouts(start, end)
+        elapsed = datetime.datetime.now() - began
+        print '%i statements for %s to %s written in %s' % (len(statements), start, end, elapsed)
+
+        if export is not None:
+            rows = models.CommissionStatement.query.\
+                   filter_by(period_start=start, period_end=end).\
+                   order_by(models.CommissionStatement.employee_id).all()
+            with open(export, 'wb') as fout:
+                commissions.write_statements(rows, fout)
+            print 'Exported to', export
+
+class SweepReservationsScript(Command):
+    """Releases expired cart holds. Runs once, or forever with --every."""
+    option_list = (
+        Option('--every', '-e', dest='every', type=int, default=None,
+               help='Seconds between sweeps'),
+    )
+
+    def run(self, every):
+        while True:
+            released = reservations.sweep()
+            print '%s released %i expired holds' % (datetime.datetime.now(), released)
+            if not every:
+                break
+            time.sleep(every)
+
+class ReplenishScript(Command):
+    """Writes pending replenishment requests to purchase order files in
+    the outbox. Runs once, or forever with --every."""
+    option_list = (
+        Option('--every', '-e', dest='every', type=int, default=None,
+               help='Seconds between runs'),
+    )
+
+    def run(self, every):
+        while True:
+            written = replenishment.replenish()
+            print '%s wrote %i purchase orders to %s' % (datetime.datetime.now(), written,
+                                                         app.config['PURCHASE_ORDER_OUTBOX'])
+            if not every:
+                break
+            time.sleep(every)
+
+class ImportCatalogScript(Command):
+    """Upserts products from a supplier sheet of
+    manufacturer,name,quantity[,price] rows and reports rejected rows."""
+    option_list = (
+        Option('--file', '-f', dest='path', required=True),
+        Option('--report', '-r', dest='report', default=None),
+        Option('--chunk-size', '-c', dest='chunk_size', type=int, default=catalog.CHUNK_SIZE),
+    )
+
+    def run(self, path, report, chunk_size):
+        began = time.time()
+        with open(path, 'rb') as fin:
+            result = catalog.import_catalog(fin, chunk_size=chunk_size)
+        elapsed = time.time() - began
+
+        for status in catalog.STATUSES:
+            print '%-9s %7i rows' % (status, result.counts[status])
+        print '%i rows imported in %.2f s' % (result.total, elapsed)
+        if result.rejected:
+            if report is None:
+                catalog.write_import_report(result, sys.stdout)
+            else:
+                with open(report, 'wb') as fout:
+                    catalog.write_import_report(result, fout)
+                print 'Rejected rows written to', report
+
+class ArchiveScript(Command):
+    """Moves fully paid orders older than ARCHIVE_AFTER_DAYS (or --days)
+    into the archive database. Each chunk commits on its own, so the
+    command can be stopped at any time and run again to carry on."""
+    option_list = (
+        Option('--days', '-d', dest='days', type=int, default=None),
+        Option('--chunk-size', '-c', dest='chunk_size', type=int, default=archive.CHUNK_SIZE),
+        Option('--limit', '-l', dest='limit', type=int, default=None,
+               help='Most orders to archive in this run'),
+    )
+
+    def run(self, days, chunk_size, limit):
+        before = archive.archive_cutoff(days)
+        began = time.time()
+        def progress(scanned, archived):
+            print '%8i orders scanned, %8i archived' % (scanned, archived)
+        (scanned, archived) = archive.archive_orders(before, chunk_size=chunk_size,
+                                                     limit=limit, progress=progress)
+        print '%i of %i orders placed before %s archived in %.2f s' % (archived, scanned, before,
+                                                                       time.time() - began)
+
+class RebuildFeedbackWindowsScript(Command):
+    """Recomputes every user's rolling feedback window and counts from the
+    feedback table."""
+    def run(self):
+        users = feedback.rebuild_windows()
+        print 'Feedback windows rebuilt for %i users' % (users)
+
+class ConsumeEventsScript(Command):
+    """Brings the event log projections up to date. Runs once, or forever
+    with --every. --replay rebuilds a projection from the start of the
+    log; --seed first turns the existing orders into events, for a
+    database that predates the log."""
+    option_list = (
+        Option('--every', '-e', dest='every', type=int, default=None,
+               help='Seconds between runs'),
+        Option('--replay', '-r', dest='replay', action='append', default=[],
+               choices=events.projections.keys()),
+        Option('--seed', '-s', dest='seed', action='store_true', default=False),
+    )
+
+    def run(self, every, replay, seed):
+        if seed:
+            print 'Seeded the log with %i order events' % (events.seed_orders())
+        for name in replay:
+            began = time.time()
+            applied = events.replay(events.projections[name])
+            print '%s rebuilt from %i events in %.2f s' % (name, applied, time.time() - began)
+        while True:
+            for (name, applied) in sorted(events.consume_all().items()):
+                print '%s %s: %i events applied, at seq %i' % (datetime.datetime.now(), name, applied,
+                                                               events.checkpoint(name))
+            if not every:
+                break
+            time.sleep(every)
+
+def _work(poll):
+    # Connections must not be shared with the parent process
+    db.get_engine(app).dispose()
+    with app.app_context():
+        jobs.work(poll=poll)
+
+class WorkerScript(Command):
+    """Runs queued background jobs in a pool of worker processes until
+    interrupted."""
+    option_list = (
+        Option('--processes', '-p', dest='processes', type=int, default=2),
+        Option('--poll', dest='poll', type=float, default=1.0,
+               help='Seconds between checks of an empty queue'),
+    )
+
+    def run(self, processes, poll):
+        import multiprocessing
+
+        workers = []
+        print 'Starting %i workers' % (processes)
+        try:
+            while True:
+                workers = [worker for worker in workers if worker.is_alive()]
+                while len(workers) < processes:
+                    worker = multiprocessing.Process(target=_work, args=(poll,))
+                    worker.daemon = True
+                    worker.start()
+                    workers.append(worker)
+                time.sleep(5)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+
+class PrecompileScript(Command):
+    """Compiles every template into the bytecode cache and the Python
+    sources to .pyc, and builds the model forms, so new workers start
+    without doing any of it."""
+    def run(self):
+        import compileall
+
+        began = time.time()
+        compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), quiet=True)
+        print 'Python sources compiled in %.2f s' % (time.time() - began)
+
+        if app.jinja_env.bytecode_cache is None:
+            print 'TEMPLATE_BYTECODE_CACHE is not set; templates not precompiled'
+        else:
+            began = time.time()
+            names = app.jinja_env.list_templates()
+            for name in names:
+                app.jinja_env.get_template(name)
+            print '%i templates compiled in %.2f s' % (len(names), time.time() - began)
+
+        began = time.time()
+        for form in forms.LAZY_FORMS:
+            form.form_class()
+        print '%i model forms built in %.2f s' % (len(forms.LAZY_FORMS), time.time() - began)
+
+class ProfileStartupScript(Command):
+    """Starts a fresh interpreter with the startup profiler on, serves one
+    request from it and prints where the time went."""
+    option_list = (
+        Option('--path', '-p', dest='path', default='/login/'),
+    )
+
+    def run(self, path):
+        import subprocess
+
+        script = ('import time; began = time.time()\n'
+                  'from app import app\n'
+                  'app.test_client().get(%r)\n'
+                  'print "time to first response: %%.1f ms" %% ((time.time() - began) * 1000)\n' % (path))
+        env = dict(os.environ, PROFILE_STARTUP='1')
+        return subprocess.call([sys.executable, '-c', script], env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+
 
 manager = Manager(app)
 manager.add_command("shell", Shell(make_context=_make_context))
 manager.add_command("createadmin", CreateAdminScript())
+manager.add_command("apply-payments", ApplyPaymentsScript())
+manager.add_command("rebuild-cube", RebuildCubeScript())
+manager.add_command("bench-cube", BenchmarkCubeScript())
+manager.add_command("payouts", PayoutsScript())
+manager.add_command("sweep-reservations", SweepReservationsScript())
+manager.add_command("replenish", ReplenishScript())
+manager.add_command("import-catalog", ImportCatalogScript())
+manager.add_command("archive", ArchiveScript())
+manager.add_command("rebuild-feedback-windows", RebuildFeedbackWindowsScript())
+manager.add_command("consume-events", ConsumeEventsScript())
+manager.add_command("worker", WorkerScript())
+manager.add_command("precompile", PrecompileScript())
+manager.add_command("profile-startup", ProfileStartupScript())
 
 if __name__ == "__main__":
     manager.run()